@@ -1,9 +1,19 @@
-from cs import CloudStack
+from cs import CloudStackException
 
 from heat.engine import properties
 from heat.engine import resource
 from gettext import gettext as _
 
+from ..common import cache
+from ..common import capacity
+from ..common import client
+from ..common import ippool
+from ..common import jobs
+from ..common import metrics
+from ..common import retry
+from ..common import scheduler
+from ..common import trace
+
 __author__ = 'cima'
 
 
@@ -12,16 +22,19 @@ class CloudstackAddress(resource.Resource):
         API_ENDPOINT,
         API_KEY,
         API_SECRET,
-        VPC_ID) = (
+        VPC_ID,
+        POOLED) = (
         'api_endpoint',
         'api_key',
         'api_secret',
-        'vpc_id')
+        'vpc_id',
+        'pooled')
 
     properties_schema = {
         API_ENDPOINT: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Cloudstack API endpoint'),
+            description=_('Cloudstack API endpoint, or a comma separated list '
+                          'of the management servers of a cluster'),
             required=True
         ),
         API_KEY: properties.Schema(
@@ -38,63 +51,152 @@ class CloudstackAddress(resource.Resource):
             data_type=properties.Schema.STRING,
             description=_('VPC ID'),
             required=True
+        ),
+        POOLED: properties.Schema(
+            data_type=properties.Schema.BOOLEAN,
+            description=_('Take the address from the address pool of the '
+                          'VPC and return it there when deleted'),
+            required=False,
+            default=False,
+            update_allowed=True
         )
     }
 
     def _get_cloudstack(self):
-        cs = CloudStack(endpoint=self.properties.get(self.API_ENDPOINT),
-                        key=self.properties.get(self.API_KEY),
-                        secret=self.properties.get(self.API_SECRET))
-        return cs
-
+        return metrics.instrument(client.get_client(
+            endpoint=self.properties.get(self.API_ENDPOINT),
+            key=self.properties.get(self.API_KEY),
+            secret=self.properties.get(self.API_SECRET)), self)
+
+    def _show_resource(self):
+        def load():
+            address = self._get_cloudstack().listPublicIpAddresses(
+                id=self.resource_id)
+            if address:
+                return address['publicipaddress'][0]
+
+        return cache.get_cache().fetch('publicipaddress', self.resource_id,
+                                       load)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('publicipaddress', self.resource_id)
+
+    def _claim(self, cs, vpcid):
+        pool = ippool.get_pool()
+        try:
+            while True:
+                try:
+                    return pool.claim(cs, vpcid)
+                except CloudStackException as e:
+                    if not retry.not_found(e):
+                        raise e
+                    # released meanwhile, try the next one
+        finally:
+            pool.refill(cs, vpcid)
+
+    @trace.traced('create')
     def handle_create(self):
+        capacity.preflight(self)
         cs = self._get_cloudstack()
 
         vpcid = self.properties.get(self.VPC_ID)
 
+        if self.properties.get(self.POOLED):
+            address_id = self._claim(cs, vpcid)
+            if address_id is not None:
+                self.resource_id_set(address_id)
+                return address_id
+
         address = cs.associateIpAddress(vpcid=vpcid)
 
         self.resource_id_set(address['id'])
+        jobs.start(self, cs, 'create_jobid', address)
         return address['id']
 
+    @scheduler.scheduled('create')
     def check_create_complete(self, _compute_id):
-        # TODO: Add more sofisticated condition
+        address = jobs.poll(self, self._get_cloudstack(), 'create_jobid')
+        if address is None:
+            return False
+        cache.get_cache().put('publicipaddress', self.resource_id,
+                              address.get('ipaddress'))
         return True
 
+    @trace.traced('update')
     def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
-        # TODO
-        pass
+        # pooled only decides on delete whether the address goes back to the
+        # pool, the new value takes effect without any API call
+        self._invalidate()
 
-    def check_update_complete(self):
-        # TODO
-        pass
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        return True
+
+    def _release(self, cs):
+        """Return the address to the pool, disassociate it if it is full."""
+        if ippool.get_pool().release(cs, self.properties.get(self.VPC_ID),
+                                     self.resource_id):
+            return
+        res = cs.disassociateIpAddress(id=self.resource_id)
+        jobs.start(self, cs, 'delete_jobid', res)
 
+    @trace.traced('delete')
     def handle_delete(self):
         cs = self._get_cloudstack()
 
         if self.resource_id is None:
             return
 
-        cs.disassociateIpAddress(id=self.resource_id)
-
+        self._invalidate()
+        if not self.properties.get(self.POOLED):
+            res = cs.disassociateIpAddress(id=self.resource_id)
+            jobs.start(self, cs, 'delete_jobid', res)
+            return
+        try:
+            address = self._show_resource()
+        except CloudStackException as e:
+            if retry.not_found(e):
+                return
+            raise e
+        if address is None:
+            return
+        if address.get('isstaticnat'):
+            # a pooled address must not stay mapped to a VM of this stack,
+            # the static NAT resource leaves that to the address
+            self._invalidate()
+            res = cs.disableStaticNat(ipaddressid=self.resource_id)
+            if jobs.start(self, cs, 'nat_jobid', res):
+                return
+        self._release(cs)
+
+    @scheduler.scheduled('delete')
     def check_delete_complete(self, _compute_id):
-        # TODO: Add more sofisticated condition
-        return True
-
-    def _resolve_attribute(self, name):
         cs = self._get_cloudstack()
+        if 'nat_jobid' in self.data():
+            try:
+                if jobs.poll(self, cs, 'nat_jobid') is None:
+                    return False
+            except jobs.AsyncJobFailed:
+                # never pool an address which may still be mapped
+                self.data_delete('nat_jobid')
+                res = cs.disassociateIpAddress(id=self.resource_id)
+                jobs.start(self, cs, 'delete_jobid', res)
+                return False
+            self._release(cs)
+        res = jobs.poll(self, cs, 'delete_jobid')
+        return res is not None
 
-        address = cs.listPublicIpAddresses(id=self.resource_id)
+    def _resolve_attribute(self, name):
+        address = self._show_resource()
         if address:
-            if name == 'id':
-                return address['publicipaddress'][0]['id']
-            if name == 'ipaddress':
-                return address['publicipaddress'][0]['ipaddress']
-            return getattr(address, name)
+            if name == 'show':
+                return address
+            return address.get(name)
 
     attributes_schema = {
         'id': _('id'),
-        'ipaddress': _('ipaddress')
+        'ipaddress': _('ipaddress'),
+        'show': _('All attributes of the public IP address')
     }
 
 
@@ -1,10 +1,21 @@
-from cs import CloudStack
 from cs import CloudStackException
 
+from heat.common import exception
 from heat.engine import properties
 from heat.engine import resource
 from gettext import gettext as _
 
+from ..common import cache
+from ..common import capacity
+from ..common import catalog
+from ..common import client
+from ..common import jobs
+from ..common import metrics
+from ..common import retry
+from ..common import scheduler
+from ..common import topology
+from ..common import trace
+
 __author__ = 'cima'
 
 
@@ -36,7 +47,8 @@ class CloudstackNetwork(resource.Resource):
     properties_schema = {
         API_ENDPOINT: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Cloudstack API endpoint'),
+            description=_('Cloudstack API endpoint, or a comma separated list '
+                          'of the management servers of a cluster'),
             required=True
         ),
         API_KEY: properties.Schema(
@@ -52,21 +64,23 @@ class CloudstackNetwork(resource.Resource):
         NAME: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('The name of the network'),
-            required=True
+            required=True,
+            update_allowed=True
         ),
         DISPLAY_TEXT: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('The displaytext for the network'),
-            required=True
+            required=True,
+            update_allowed=True
         ),
         ZONE_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('The zone id'),
+            description=_('The zone name or id'),
             required=True
         ),
         NETWORK_OFFERING_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('The network offering id'),
+            description=_('The network offering name or id'),
             required=True
         ),
         VPC_ID: properties.Schema(
@@ -77,7 +91,8 @@ class CloudstackNetwork(resource.Resource):
         ACL_ID: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('ACL id'),
-            required=True
+            required=True,
+            update_allowed=True
         ),
         GATEWAY: properties.Schema(
             data_type=properties.Schema.STRING,
@@ -91,18 +106,41 @@ class CloudstackNetwork(resource.Resource):
         )
     }
 
+    def validate(self):
+        super(CloudstackNetwork, self).validate()
+        # checked offline for the whole stack, before any API call
+        problems = topology.problems(self)
+        if problems:
+            raise exception.StackValidationFailed(
+                message='; '.join(problems))
+
     def _get_cloudstack(self):
-        cs = CloudStack(endpoint=self.properties.get(self.API_ENDPOINT),
-                        key=self.properties.get(self.API_KEY),
-                        secret=self.properties.get(self.API_SECRET))
-        return cs
+        return metrics.instrument(client.get_client(
+            endpoint=self.properties.get(self.API_ENDPOINT),
+            key=self.properties.get(self.API_KEY),
+            secret=self.properties.get(self.API_SECRET)), self)
+
+    def _show_resource(self):
+        def load():
+            network = self._get_cloudstack().listNetworks(id=self.resource_id)
+            if network:
+                return network['network'][0]
 
+        return cache.get_cache().fetch('network', self.resource_id, load)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('network', self.resource_id)
+
+    @trace.traced('create')
     def handle_create(self):
+        capacity.preflight(self)
         cs = self._get_cloudstack()
 
         displaytext = self.properties.get(self.DISPLAY_TEXT)
-        zoneid = self.properties.get(self.ZONE_ID)
-        networkofferingid = self.properties.get(self.NETWORK_OFFERING_ID)
+        zoneid = catalog.resolve(cs, 'zone', self.properties.get(self.ZONE_ID))
+        networkofferingid = catalog.resolve(
+            cs, 'networkoffering',
+            self.properties.get(self.NETWORK_OFFERING_ID))
         vpcid = self.properties.get(self.VPC_ID)
         name = self.properties.get(self.NAME)
         gateway = self.properties.get(self.GATEWAY)
@@ -123,60 +161,77 @@ class CloudstackNetwork(resource.Resource):
         self.resource_id_set(network['network']['id'])
         return network['network']['id']
 
+    @scheduler.scheduled('create')
     def check_create_complete(self, _compute_id):
         cs = self._get_cloudstack()
 
         network = cs.listNetworks(id=self.resource_id)
         if network:
+            cache.get_cache().put('network', self.resource_id,
+                                  network['network'][0])
             return True
 
         return False
 
+    @trace.traced('update')
     def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
-        # TODO
-        pass
-
-    def check_update_complete(self):
-        # TODO
-        pass
+        self._invalidate()
+        if not prop_diff:
+            return
 
+        cs = self._get_cloudstack()
+        responses = []
+        params = {}
+        if self.NAME in prop_diff:
+            params['name'] = prop_diff[self.NAME]
+        if self.DISPLAY_TEXT in prop_diff:
+            params['displaytext'] = prop_diff[self.DISPLAY_TEXT]
+        if params:
+            responses.append(cs.updateNetwork(id=self.resource_id, **params))
+        if self.ACL_ID in prop_diff:
+            responses.append(cs.replaceNetworkACLList(
+                aclid=prop_diff[self.ACL_ID],
+                networkid=self.resource_id))
+        jobs.start_many(self, cs, 'update_jobids', responses)
+
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        return jobs.poll_many(self, self._get_cloudstack(), 'update_jobids')
+
+    @trace.traced('delete')
     def handle_delete(self):
         cs = self._get_cloudstack()
 
         if self.resource_id is None:
             return
+        self._invalidate()
         try:
-            cs.deleteNetwork(id=self.resource_id)
-        except CloudStackException as e:
-            raise e
-
-    def check_delete_complete(self, _compute_id):
-        cs = self._get_cloudstack()
-        network = None
-        try:
-            network = cs.listNetworks(id=self.resource_id)
+            res = cs.deleteNetwork(id=self.resource_id)
+            jobs.start(self, cs, 'delete_jobid', res)
         except CloudStackException as e:
-            if e.args[2]['errorcode'] == 431:
+            if retry.not_found(e):
                 # Resource cannot be found
                 # One thing less...
-                return True
+                return
             raise e
-        if network:
-            return False
-        else:
-            return True
 
-    def _resolve_attribute(self, name):
-        cs = self._get_cloudstack()
+    @scheduler.scheduled('delete')
+    def check_delete_complete(self, _compute_id):
+        res = jobs.poll(self, self._get_cloudstack(), 'delete_jobid')
+        return res is not None
 
-        network = cs.listNetworks(id=self.resource_id)
+    def _resolve_attribute(self, name):
+        network = self._show_resource()
         if network:
-            if name == 'id':
-                return network['network'][0]['id']
-            return getattr(network, name)
+            if name == 'show':
+                return network
+            return network.get(name)
 
     attributes_schema = {
-        'id': _('id')
+        'id': _('id'),
+        'cidr': _('Network CIDR'),
+        'state': _('state'),
+        'show': _('All attributes of the network')
     }
 
 
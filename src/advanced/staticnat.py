@@ -1,9 +1,16 @@
-from cs import CloudStack
+import json
 
 from heat.engine import properties
 from heat.engine import resource
 from gettext import gettext as _
 
+from ..common import cache
+from ..common import client
+from ..common import jobs
+from ..common import metrics
+from ..common import scheduler
+from ..common import trace
+
 __author__ = 'cima'
 
 
@@ -25,7 +32,8 @@ class CloudstackStaticNAT(resource.Resource):
     properties_schema = {
         API_ENDPOINT: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Cloudstack API endpoint'),
+            description=_('Cloudstack API endpoint, or a comma separated list '
+                          'of the management servers of a cluster'),
             required=True
         ),
         API_KEY: properties.Schema(
@@ -46,21 +54,40 @@ class CloudstackStaticNAT(resource.Resource):
         VIRTUAL_MACHINE_ID: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('VM ID'),
-            required=True
+            required=True,
+            update_allowed=True
         ),
         NETWORK_ID: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('Network ID'),
-            required=False
+            required=False,
+            update_allowed=True
         )
     }
 
     def _get_cloudstack(self):
-        cs = CloudStack(endpoint=self.properties.get(self.API_ENDPOINT),
-                        key=self.properties.get(self.API_KEY),
-                        secret=self.properties.get(self.API_SECRET))
-        return cs
+        return metrics.instrument(client.get_client(
+            endpoint=self.properties.get(self.API_ENDPOINT),
+            key=self.properties.get(self.API_KEY),
+            secret=self.properties.get(self.API_SECRET)), self)
+
+    def _show_resource(self):
+        # the NAT rule is an attribute of the public IP address
+        ipaddressid = self.properties.get(self.IP_ADDRESS_ID)
+
+        def load():
+            address = self._get_cloudstack().listPublicIpAddresses(
+                id=ipaddressid)
+            if address:
+                return address['publicipaddress'][0]
+
+        return cache.get_cache().fetch('publicipaddress', ipaddressid, load)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('publicipaddress',
+                                     self.properties.get(self.IP_ADDRESS_ID))
 
+    @trace.traced('create')
     def handle_create(self):
         cs = self._get_cloudstack()
 
@@ -68,35 +95,76 @@ class CloudstackStaticNAT(resource.Resource):
         ipaddressid = self.properties.get(self.IP_ADDRESS_ID)
         networkid = self.properties.get(self.NETWORK_ID)
 
-        cs.enableStaticNat(
+        self._invalidate()
+        res = cs.enableStaticNat(
             ipaddressid=ipaddressid,
             virtualmachineid=virtualmachineid,
             networkid=networkid)
+        # enableStaticNat is synchronous on most CloudStack versions,
+        # track the job only if the server handed one out
+        jobs.start(self, cs, 'create_jobid', res)
 
         return ipaddressid
 
+    @scheduler.scheduled('create')
     def check_create_complete(self, _compute_id):
-        # TODO: Add more sofisticated condition
-        return True
+        res = jobs.poll(self, self._get_cloudstack(), 'create_jobid')
+        return res is not None
 
+    @trace.traced('update')
     def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
-        # TODO
-        pass
-
-    def check_update_complete(self):
-        # TODO
-        pass
+        self._invalidate()
+        if not prop_diff:
+            return
+        # an address maps to one VM at a time, the old mapping goes first
+        mapping = {}
+        for name, param in ((self.VIRTUAL_MACHINE_ID, 'virtualmachineid'),
+                            (self.NETWORK_ID, 'networkid')):
+            mapping[param] = prop_diff[name] if name in prop_diff \
+                else self.properties.get(name)
+        self.data_set('update_mapping', json.dumps(mapping))
+        cs = self._get_cloudstack()
+        res = cs.disableStaticNat(
+            ipaddressid=self.properties.get(self.IP_ADDRESS_ID))
+        jobs.start(self, cs, 'update_jobid', res)
 
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        cs = self._get_cloudstack()
+        if jobs.poll(self, cs, 'update_jobid') is None:
+            return False
+        mapping = self.data().get('update_mapping')
+        if mapping is None:
+            return True
+        self.data_delete('update_mapping')
+        self._invalidate()
+        res = cs.enableStaticNat(
+            ipaddressid=self.properties.get(self.IP_ADDRESS_ID),
+            **json.loads(mapping))
+        return jobs.start(self, cs, 'update_jobid', res) is None
+
+    @trace.traced('delete')
     def handle_delete(self):
         # Nothing to do here as NAT resource does not have id
-        pass
+        self._invalidate()
 
+    @scheduler.scheduled('delete')
     def check_delete_complete(self, _compute_id):
         # TODO: Add more sofisticated condition
         return True
 
     def _resolve_attribute(self, name):
-        pass
+        address = self._show_resource()
+        if address:
+            if name == 'show':
+                return address
+            return address.get(name)
+
+    attributes_schema = {
+        'ipaddress': _('Public IP address'),
+        'virtualmachineid': _('id of the VM the address is mapped to'),
+        'show': _('All attributes of the public IP address')
+    }
 
 
 def resource_mapping():
@@ -1,10 +1,21 @@
-from cs import CloudStack
 from cs import CloudStackException
 
+from heat.common import exception
 from heat.engine import properties
 from heat.engine import resource
 from gettext import gettext as _
 
+from ..common import cache
+from ..common import capacity
+from ..common import catalog
+from ..common import client
+from ..common import jobs
+from ..common import metrics
+from ..common import retry
+from ..common import scheduler
+from ..common import topology
+from ..common import trace
+
 __author__ = 'cima'
 
 
@@ -30,7 +41,8 @@ class CloudstackVPC(resource.Resource):
     properties_schema = {
         API_ENDPOINT: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Cloudstack API endpoint'),
+            description=_('Cloudstack API endpoint, or a comma separated list '
+                          'of the management servers of a cluster'),
             required=True
         ),
         API_KEY: properties.Schema(
@@ -46,21 +58,23 @@ class CloudstackVPC(resource.Resource):
         NAME: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('VPC name'),
-            required=True
+            required=True,
+            update_allowed=True
         ),
         DISPLAY_TEXT: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('VPC display text'),
-            required=True
+            required=True,
+            update_allowed=True
         ),
         ZONE_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Zone id'),
+            description=_('Zone name or id'),
             required=True
         ),
         VPC_OFFERING_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('VPC offering id'),
+            description=_('VPC offering name or id'),
             required=True
         ),
         CIDR: properties.Schema(
@@ -70,17 +84,39 @@ class CloudstackVPC(resource.Resource):
         )
     }
 
+    def validate(self):
+        super(CloudstackVPC, self).validate()
+        # checked offline for the whole stack, before any API call
+        problems = topology.problems(self)
+        if problems:
+            raise exception.StackValidationFailed(
+                message='; '.join(problems))
+
     def _get_cloudstack(self):
-        cs = CloudStack(endpoint=self.properties.get(self.API_ENDPOINT),
-                        key=self.properties.get(self.API_KEY),
-                        secret=self.properties.get(self.API_SECRET))
-        return cs
+        return metrics.instrument(client.get_client(
+            endpoint=self.properties.get(self.API_ENDPOINT),
+            key=self.properties.get(self.API_KEY),
+            secret=self.properties.get(self.API_SECRET)), self)
+
+    def _show_resource(self):
+        def load():
+            vpc = self._get_cloudstack().listVPCs(id=self.resource_id)
+            if vpc:
+                return vpc['vpc'][0]
+
+        return cache.get_cache().fetch('vpc', self.resource_id, load)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('vpc', self.resource_id)
 
+    @trace.traced('create')
     def handle_create(self):
+        capacity.preflight(self)
         cs = self._get_cloudstack()
 
-        zoneid = self.properties.get(self.ZONE_ID)
-        vpcofferingid = self.properties.get(self.VPC_OFFERING_ID)
+        zoneid = catalog.resolve(cs, 'zone', self.properties.get(self.ZONE_ID))
+        vpcofferingid = catalog.resolve(
+            cs, 'vpcoffering', self.properties.get(self.VPC_OFFERING_ID))
         name = self.properties.get(self.NAME)
         displaytext = self.properties.get(self.DISPLAY_TEXT)
         cidr = self.properties.get(self.CIDR)
@@ -94,62 +130,72 @@ class CloudstackVPC(resource.Resource):
         )
 
         self.resource_id_set(vpc['id'])
+        jobs.start(self, cs, 'create_jobid', vpc)
         return vpc['id']
 
+    @scheduler.scheduled('create')
     def check_create_complete(self, _compute_id):
-        cs = self._get_cloudstack()
-
-        vpc = cs.listVPCs(id=self.resource_id)
-        if vpc:
-            return True
-
-        return False
+        vpc = jobs.poll(self, self._get_cloudstack(), 'create_jobid')
+        if vpc is None:
+            return False
+        cache.get_cache().put('vpc', self.resource_id, vpc.get('vpc'))
+        return True
 
+    @trace.traced('update')
     def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
-        # TODO
-        pass
-
-    def check_update_complete(self):
-        # TODO
-        pass
+        self._invalidate()
+        if not prop_diff:
+            return
 
+        cs = self._get_cloudstack()
+        params = {}
+        if self.NAME in prop_diff:
+            params['name'] = prop_diff[self.NAME]
+        if self.DISPLAY_TEXT in prop_diff:
+            params['displaytext'] = prop_diff[self.DISPLAY_TEXT]
+        if params:
+            res = cs.updateVPC(id=self.resource_id, **params)
+            jobs.start(self, cs, 'update_jobid', res)
+
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        res = jobs.poll(self, self._get_cloudstack(), 'update_jobid')
+        return res is not None
+
+    @trace.traced('delete')
     def handle_delete(self):
         cs = self._get_cloudstack()
 
         if self.resource_id is None:
             return
+        self._invalidate()
         try:
-            cs.deleteVPC(id=self.resource_id)
-        except CloudStackException as e:
-            raise e
-
-    def check_delete_complete(self, _compute_id):
-        cs = self._get_cloudstack()
-        vpc = None
-        try:
-            vpc = cs.listVPCs(id=self.resource_id)
+            res = cs.deleteVPC(id=self.resource_id)
+            jobs.start(self, cs, 'delete_jobid', res)
         except CloudStackException as e:
-            if e.args[2]['errorcode'] == 431:
+            if retry.not_found(e):
                 # Resource cannot be found
                 # One thing less...
-                return True
+                return
             raise e
-        if vpc:
-            return False
-        else:
-            return True
 
-    def _resolve_attribute(self, name):
-        cs = self._get_cloudstack()
+    @scheduler.scheduled('delete')
+    def check_delete_complete(self, _compute_id):
+        res = jobs.poll(self, self._get_cloudstack(), 'delete_jobid')
+        return res is not None
 
-        vpc = cs.listVPCs(id=self.resource_id)
+    def _resolve_attribute(self, name):
+        vpc = self._show_resource()
         if vpc:
-            if name == 'id':
-                return vpc['vpc'][0]['id']
-            return getattr(vpc, name)
+            if name == 'show':
+                return vpc
+            return vpc.get(name)
 
     attributes_schema = {
-        'id': _('id')
+        'id': _('id'),
+        'cidr': _('VPC CIDR'),
+        'state': _('state'),
+        'show': _('All attributes of the VPC')
     }
 
 
@@ -1,10 +1,20 @@
-from cs import CloudStack
 from cs import CloudStackException
 
 from heat.engine import properties
 from heat.engine import resource
 from gettext import gettext as _
-from time import sleep
+import time
+
+from ..common import cache
+from ..common import client
+from ..common import jobs
+from ..common import metrics
+from ..common import pool
+from ..common import retry
+from ..common import sgrules
+from ..common import scheduler
+from ..common import trace
+from ..common.config import CONF
 
 __author__ = 'cima'
 
@@ -25,7 +35,8 @@ class CloudstackSecurityGroup(resource.Resource):
     properties_schema = {
         API_ENDPOINT: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Cloudstack API endpoint'),
+            description=_('Cloudstack API endpoint, or a comma separated list '
+                          'of the management servers of a cluster'),
             required=True
         ),
         API_KEY: properties.Schema(
@@ -46,16 +57,29 @@ class CloudstackSecurityGroup(resource.Resource):
         RULES: properties.Schema(
             data_type=properties.Schema.LIST,
             description=_('List of ingress / egress rules'),
-            required=False
+            required=False,
+            update_allowed=True
         )
     }
 
     def _get_cloudstack(self):
-        cs = CloudStack(endpoint=self.properties.get(self.API_ENDPOINT),
-                        key=self.properties.get(self.API_KEY),
-                        secret=self.properties.get(self.API_SECRET))
-        return cs
+        return metrics.instrument(client.get_client(
+            endpoint=self.properties.get(self.API_ENDPOINT),
+            key=self.properties.get(self.API_KEY),
+            secret=self.properties.get(self.API_SECRET)), self)
 
+    def _show_resource(self):
+        def load():
+            sg = self._get_cloudstack().listSecurityGroups(id=self.resource_id)
+            if sg:
+                return sg['securitygroup'][0]
+
+        return cache.get_cache().fetch('securitygroup', self.resource_id, load)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('securitygroup', self.resource_id)
+
+    @trace.traced('create')
     def handle_create(self):
         cs = self._get_cloudstack()
 
@@ -65,65 +89,122 @@ class CloudstackSecurityGroup(resource.Resource):
         sg = cs.createSecurityGroup(name=name)
 
         sg_id = sg['securitygroup']['id']
+        self.resource_id_set(sg_id)
 
-        for rule in rules:
-            if rule.get('direction', 'ingress') == 'ingress':
-                cs.authorizeSecurityGroupIngress(
-                    securitygroupid=sg_id,
-                    startport=rule.get('startport', None),
-                    endport=rule.get('endport', None),
-                    cidrlist=rule.get('cidr', '0.0.0.0/0'),
-                    protocol=rule.get('protocol', 'tcp'))
-            elif rule.get('direction', 'ingress') == 'egress':
-                cs.authorizeSecurityGroupEgress(
-                    securitygroupid=sg_id,
-                    startport=rule.get('startport', None),
-                    endport=rule.get('endport', None),
-                    cidrlist=rule.get('cidr', '0.0.0.0/0'),
-                    protocol=rule.get('protocol', 'tcp'))
+        self._change_rules(cs, sgrules.group_rules(rules or []), [])
 
-        self.resource_id_set(sg_id)
         return sg_id
 
+    def _change_rules(self, cs, authorize, revoke):
+        """Concurrently authorize (direction, params) and revoke
+        (direction, ruleid) rules, tracking their jobs."""
+        def call(change):
+            action, direction, params = change
+            command = '%sSecurityGroup%s' % (action, direction.capitalize())
+            if action == 'authorize':
+                return getattr(cs, command)(securitygroupid=self.resource_id,
+                                            **params)
+            return getattr(cs, command)(id=params)
+
+        changes = ([('revoke', direction, ruleid)
+                    for direction, ruleid in revoke] +
+                   [('authorize', direction, params)
+                    for direction, params in authorize])
+        responses = pool.map(call, changes,
+                             size=CONF.cloudstack.sg_rule_workers)
+        jobs.start_many(self, cs, 'rule_jobids', responses)
+
+    @scheduler.scheduled('create')
     def check_create_complete(self, _compute_id):
         cs = self._get_cloudstack()
 
+        if not jobs.poll_many(self, cs, 'rule_jobids'):
+            return False
+
         sg = cs.listSecurityGroups(id=self.resource_id)
         if sg:
+            cache.get_cache().put('securitygroup', self.resource_id,
+                                  sg['securitygroup'][0])
             return True
 
         return False
 
+    @trace.traced('update')
     def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
-        # TODO
-        pass
-
-    def check_update_complete(self):
-        # TODO
-        pass
+        self._invalidate()
+        if not prop_diff or self.RULES not in prop_diff:
+            return
 
-    def handle_delete(self):
         cs = self._get_cloudstack()
+        sg = cs.listSecurityGroups(id=self.resource_id)['securitygroup'][0]
+        authorize, revoke = sgrules.diff(sg, prop_diff[self.RULES] or [])
+        self._change_rules(cs, authorize, revoke)
 
-        if self.resource_id is None:
-            return
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        return jobs.poll_many(self, self._get_cloudstack(), 'rule_jobids')
+
+    def _try_delete(self, cs, deadline=None):
         try:
             cs.deleteSecurityGroup(id=self.resource_id)
         except CloudStackException as e:
-            if e.args[2]['errorcode'] == 536:
+            if retry.in_use(e):
                 # Delete failed - cannot delete group when
                 # it's in use by virtual machines
-                # just wait for a while and try again
-                sleep(10)
-                self.handle_delete()
+                if deadline is not None and time.time() >= deadline:
+                    raise e
+                return False
+            if retry.not_found(e):
+                # Resource cannot be found
+                return True
+            raise e
+        return True
+
+    def _schedule_delete(self, attempt):
+        now = time.time()
+        delay = retry.get_policy().delay(retry.IN_USE, attempt)
+        self.data_set('delete_attempt', str(attempt))
+        self.data_set('delete_failed_at', str(now))
+        self.data_set('delete_retry_at', str(now + delay))
+
+    @trace.traced('delete')
+    def handle_delete(self):
+        cs = self._get_cloudstack()
 
+        if self.resource_id is None:
+            return
+        self._invalidate()
+        if not self._try_delete(cs):
+            # retried from check_delete_complete once the VMs are gone
+            deadline = time.time() + CONF.cloudstack.sg_delete_timeout
+            self.data_set('delete_deadline', str(deadline))
+            self._schedule_delete(1)
+
+    @scheduler.scheduled('delete')
     def check_delete_complete(self, _compute_id):
         cs = self._get_cloudstack()
+        data = self.data()
+        if 'delete_retry_at' in data:
+            if time.time() < float(data['delete_retry_at']):
+                return False
+            # checks come late rather than early, account for the time the
+            # attempt was actually delayed by
+            retry.get_policy().retried(
+                retry.IN_USE, 'deleteSecurityGroup',
+                time.time() - float(data.get('delete_failed_at',
+                                             data['delete_retry_at'])))
+            if not self._try_delete(cs, float(data['delete_deadline'])):
+                self._schedule_delete(int(data['delete_attempt']) + 1)
+                return False
+            for key in ('delete_attempt', 'delete_failed_at',
+                        'delete_retry_at', 'delete_deadline'):
+                self.data_delete(key)
+
         sg = None
         try:
             sg = cs.listSecurityGroups(id=self.resource_id)
         except CloudStackException as e:
-            if e.args[2]['errorcode'] == 431:
+            if retry.not_found(e):
                 # Resource cannot be found
                 # One thing less...
                 return True
@@ -133,16 +214,15 @@ class CloudstackSecurityGroup(resource.Resource):
             return True
 
     def _resolve_attribute(self, name):
-        cs = self._get_cloudstack()
-
-        sg = cs.listSecurityGroups(id=self.resource_id)
+        sg = self._show_resource()
         if sg:
-            if name == 'id':
-                return sg['securitygroup'][0]['id']
-            return getattr(sg, name)
+            if name == 'show':
+                return sg
+            return sg.get(name)
 
     attributes_schema = {
-        'id': _('id')
+        'id': _('id'),
+        'show': _('All attributes of the security group')
     }
 
 
@@ -1,13 +1,33 @@
-from cs import CloudStack
 from cs import CloudStackException
 
+from heat.common import exception
+from heat.engine import constraints
 from heat.engine import properties
 from heat.engine import resource
 from gettext import gettext as _
-from base64 import b64encode
+import json
+import logging
+import requests
+
+from ..common import cache
+from ..common import capacity
+from ..common import catalog
+from ..common import client
+from ..common import jobs
+from ..common import metrics
+from ..common import poller
+from ..common import retry
+from ..common import scheduler
+from ..common import topology
+from ..common import trace
+from ..common import userdata
+from ..common import warmpool
+from ..common.config import CONF
 
 __author__ = 'cima'
 
+LOG = logging.getLogger(__name__)
+
 
 class CloudstackVirtualMachine(resource.Resource):
     PROPERTIES = (
@@ -22,7 +42,8 @@ class CloudstackVirtualMachine(resource.Resource):
         KEY_PAIR,
         SECURITY_GROUP_IDS,
         NETWORK_IDS,
-        IPADDRESS) = (
+        IPADDRESS,
+        WARM_POOL) = (
         'api_endpoint',
         'api_key',
         'api_secret',
@@ -34,12 +55,14 @@ class CloudstackVirtualMachine(resource.Resource):
         'key_pair',
         'security_group_ids',
         'network_ids',
-        'ipaddress')
+        'ipaddress',
+        'warm_pool')
 
     properties_schema = {
         API_ENDPOINT: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Cloudstack API endpoint'),
+            description=_('Cloudstack API endpoint, or a comma separated list '
+                          'of the management servers of a cluster'),
             required=True
         ),
         API_KEY: properties.Schema(
@@ -55,27 +78,30 @@ class CloudstackVirtualMachine(resource.Resource):
         NAME: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('Virtual machine hostname'),
-            required=False
+            required=False,
+            update_allowed=True
         ),
         SERVICE_OFFERING_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Service offering ID'),
-            required=True
+            description=_('Service offering name or ID'),
+            required=True,
+            update_allowed=True
         ),
         TEMPLATE_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Template ID'),
+            description=_('Template name or ID'),
             required=True
         ),
         ZONE_ID: properties.Schema(
             data_type=properties.Schema.STRING,
-            description=_('Zone ID'),
+            description=_('Zone name or ID'),
             required=True
         ),
         USER_DATA: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('User data script'),
-            required=False
+            required=False,
+            update_allowed=True
         ),
         KEY_PAIR: properties.Schema(
             data_type=properties.Schema.STRING,
@@ -85,157 +111,465 @@ class CloudstackVirtualMachine(resource.Resource):
         SECURITY_GROUP_IDS: properties.Schema(
             data_type=properties.Schema.LIST,
             description=_('List of security group ids'),
-            required=False
+            required=False,
+            update_allowed=True
         ),
         NETWORK_IDS: properties.Schema(
             data_type=properties.Schema.LIST,
             description=_('List of network ids'),
-            required=False
+            required=False,
+            update_allowed=True
         ),
         IPADDRESS: properties.Schema(
             data_type=properties.Schema.STRING,
             description=_('VM IP address'),
             required=False
+        ),
+        WARM_POOL: properties.Schema(
+            data_type=properties.Schema.INTEGER,
+            description=_('Number of stopped VMs kept deployed for VMs with '
+                          'the same zone, template, offering, networks and '
+                          'keypair, which are then created by starting one '
+                          'of them'),
+            required=False,
+            default=0,
+            update_allowed=True,
+            constraints=[constraints.Range(min=0)]
         )
     }
 
-    def _get_cloudstack(self, method='get'):
-        cs = CloudStack(endpoint=self.properties.get(self.API_ENDPOINT),
-                        key=self.properties.get(self.API_KEY),
-                        secret=self.properties.get(self.API_SECRET),
-                        method=method)
-        return cs
-
-    def handle_create(self):
-        # use post to be able to inject up to 64k user data
-        cs = self._get_cloudstack(method='post')
+    def validate(self):
+        super(CloudstackVirtualMachine, self).validate()
+        # checked offline for the whole stack, before any API call
+        problems = topology.problems(self)
+        if problems:
+            raise exception.StackValidationFailed(
+                message='; '.join(problems))
 
+    def _get_cloudstack(self, method='get'):
+        return metrics.instrument(client.get_client(
+            endpoint=self.properties.get(self.API_ENDPOINT),
+            key=self.properties.get(self.API_KEY),
+            secret=self.properties.get(self.API_SECRET),
+            method=method), self)
+
+    def _poll_vm(self):
+        # batched with the status queries of every other VM of the engine
+        vm = poller.get_poller().state(self._get_cloudstack(method='post'),
+                                       self.resource_id)
+        if vm is poller.PENDING:
+            return None
+        return vm
+
+    def _forget_vm(self):
+        poller.get_poller().forget(self._get_cloudstack(method='post'),
+                                   self.resource_id)
+
+    def _show_resource(self):
+        def load():
+            vm = self._get_cloudstack().listVirtualMachines(
+                id=self.resource_id)
+            if vm:
+                return vm['virtualmachine'][0]
+
+        return cache.get_cache().fetch('virtualmachine', self.resource_id,
+                                       load)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('virtualmachine', self.resource_id)
+
+    def _pool_params(self):
+        # everything which cannot be changed on a stopped VM
+        cs = self._get_cloudstack()
         params = {}
 
-        params['serviceofferingid'] = self.properties.get(
-            self.SERVICE_OFFERING_ID)
-        params['templateid'] = self.properties.get(self.TEMPLATE_ID)
-        params['zoneid'] = self.properties.get(self.ZONE_ID)
-
-        if self.properties.get(self.USER_DATA):
-            params['userdata'] = b64encode(self.properties.get(self.USER_DATA))
+        # names are resolved from the cached catalog
+        params['zoneid'] = catalog.resolve(
+            cs, 'zone', self.properties.get(self.ZONE_ID))
+        params['serviceofferingid'] = catalog.resolve(
+            cs, 'serviceoffering', self.properties.get(
+                self.SERVICE_OFFERING_ID))
+        params['templateid'] = catalog.resolve(
+            cs, 'template', self.properties.get(self.TEMPLATE_ID),
+            zoneid=params['zoneid'])
         if self.properties.get(self.KEY_PAIR):
             params['keypair'] = self.properties.get(self.KEY_PAIR)
+        if self.properties.get(self.NETWORK_IDS):
+            params['networkids'] = self.properties.get(self.NETWORK_IDS)
+        return params
+
+    def _deploy_params(self):
+        params = self._pool_params()
+
+        if self.properties.get(self.USER_DATA):
+            # registered once and passed by id where CloudStack supports it
+            params.update(userdata.params(
+                self._get_cloudstack(method='post'),
+                self.properties.get(self.USER_DATA)))
         if self.properties.get(self.SECURITY_GROUP_IDS):
             params['securitygroupids'] = self.properties.get(
                 self.SECURITY_GROUP_IDS)
-        if self.properties.get(self.NETWORK_IDS):
-            params['networkids'] = self.properties.get(self.NETWORK_IDS)
         if self.properties.get(self.NAME):
             params['name'] = self.properties.get(self.NAME)
         if self.properties.get(self.IPADDRESS):
             params['ipaddress'] = self.properties.get(self.IPADDRESS)
 
-        vm = cs.deployVirtualMachine(**params)
+        return params
+
+    def _deploy_vm(self, cs, params):
+        try:
+            return cs.deployVirtualMachine(**params)
+        except CloudStackException as e:
+            if 'userdataid' not in params or not retry.not_found(e):
+                raise e
+            # the registered user data was collected meanwhile
+            userdata.forget(cs, params.pop('userdataid'))
+            params.update(userdata.params(
+                cs, self.properties.get(self.USER_DATA)))
+            return cs.deployVirtualMachine(**params)
+
+    def _warm_pool_size(self):
+        if self.properties.get(self.IPADDRESS):
+            # a pool VM has its addresses already
+            return 0
+        return self.properties.get(self.WARM_POOL) or 0
+
+    def _claim(self, cs, params):
+        """Start a VM of the warm pool, return its id or None."""
+        pool = warmpool.get_pool()
+        sig = warmpool.signature(params)
+        try:
+            while True:
+                try:
+                    vm_id = pool.claim(cs, sig)
+                    if vm_id is None:
+                        return None
+                    # the VM is ours from now on, also if it fails
+                    self.resource_id_set(vm_id)
+                    cs.updateVirtualMachine(
+                        id=vm_id,
+                        displayname=params.get('name') or vm_id,
+                        **dict((key, params[key]) for key in
+                               ('name', 'userdata', 'userdataid',
+                                'securitygroupids')
+                               if key in params))
+                    break
+                except CloudStackException as e:
+                    if not retry.not_found(e):
+                        raise e
+                    # expunged meanwhile, try the next one
+                    self.resource_id_set(None)
+        finally:
+            pool.refill(cs, sig, self._warm_pool_size(), params)
+
+        res = cs.startVirtualMachine(id=vm_id)
+        jobs.start(self, cs, 'create_jobid', res)
+        return vm_id
+
+    @trace.traced('create')
+    def handle_create(self):
+        capacity.preflight(self)
+        # use post to be able to inject up to 64k user data
+        cs = self._get_cloudstack(method='post')
+
+        params = self._deploy_params()
+        if self._warm_pool_size():
+            vm_id = self._claim(cs, params)
+            if vm_id is not None:
+                return vm_id
+
+        vm = self._deploy_vm(cs, params)
 
         self.resource_id_set(vm['id'])
+        jobs.start(self, cs, 'create_jobid', vm)
         return vm['id']
 
+    @scheduler.scheduled('create')
     def check_create_complete(self, _compute_id):
-        cs = self._get_cloudstack()
+        # the deploy job finishes once the VM is running
+        vm = jobs.poll(self, self._get_cloudstack(), 'create_jobid')
+        if vm is None:
+            return False
+        cache.get_cache().put('virtualmachine', self.resource_id,
+                              vm.get('virtualmachine'))
+        return True
 
-        vm = cs.listVirtualMachines(id=self.resource_id)
-        if vm:
-            if vm['virtualmachine'][0]['state'].lower() == 'running':
-                return True
+    @trace.traced('update')
+    def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
+        self._invalidate()
+        if not prop_diff or self.resource_id is None:
+            return
 
-        return False
+        vm = self._show_resource()
+        stopped = vm is not None and vm['state'].lower() == 'stopped'
+        live_steps = []
+        stopped_steps = []
+
+        if self.SERVICE_OFFERING_ID in prop_diff:
+            offering = catalog.resolve(
+                self._get_cloudstack(), 'serviceoffering',
+                prop_diff[self.SERVICE_OFFERING_ID])
+            if stopped:
+                stopped_steps.append(('changeServiceForVirtualMachine',
+                                      {'serviceofferingid': offering}))
+            else:
+                # falls back to stop / change / start if the VM cannot be
+                # scaled while running
+                live_steps.append(('scaleVirtualMachine',
+                                   {'serviceofferingid': offering}))
 
-    def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
-        # TODO
-        pass
+        params = {}
+        if self.NAME in prop_diff:
+            params['displayname'] = prop_diff[self.NAME]
+        if self.USER_DATA in prop_diff:
+            if prop_diff[self.USER_DATA]:
+                params.update(userdata.params(
+                    self._get_cloudstack(method='post'),
+                    prop_diff[self.USER_DATA]))
+            else:
+                params['userdata'] = ''
+        if params:
+            live_steps.append(('updateVirtualMachine', params))
+
+        if self.NETWORK_IDS in prop_diff:
+            old = self.properties.get(self.NETWORK_IDS) or []
+            new = prop_diff[self.NETWORK_IDS] or []
+            for networkid in new:
+                if networkid not in old:
+                    live_steps.append(('addNicToVirtualMachine',
+                                       {'networkid': networkid}))
+            for networkid in old:
+                if networkid not in new:
+                    live_steps.append(('removeNicFromVirtualMachine',
+                                       {'networkid': networkid}))
+
+        if self.SECURITY_GROUP_IDS in prop_diff:
+            stopped_steps.append(('updateVirtualMachine', {
+                'securitygroupids': prop_diff[self.SECURITY_GROUP_IDS] or []}))
+
+        if stopped_steps and not stopped:
+            stopped_steps = ([('stopVirtualMachine', {})] + stopped_steps +
+                             [('startVirtualMachine', {})])
+        self._set_update_steps(live_steps + stopped_steps)
+
+    def _set_update_steps(self, steps):
+        if steps:
+            self.data_set('update_steps', json.dumps(steps))
+        else:
+            self.data_delete('update_steps')
+
+    def _run_update_step(self, cs, command, params):
+        params = dict(params)
+        if command == 'removeNicFromVirtualMachine':
+            vm = self._get_cloudstack().listVirtualMachines(
+                id=self.resource_id)['virtualmachine'][0]
+            networkid = params.pop('networkid')
+            nics = [nic for nic in vm.get('nic', [])
+                    if nic['networkid'] == networkid]
+            if not nics:
+                return
+            params['nicid'] = nics[0]['id']
+        if command in ('addNicToVirtualMachine',
+                       'removeNicFromVirtualMachine'):
+            params['virtualmachineid'] = self.resource_id
+        else:
+            params['id'] = self.resource_id
+        self.data_set('update_step', json.dumps((command, params)))
+        res = getattr(cs, command)(**params)
+        jobs.start(self, cs, 'update_jobid', res)
+
+    @staticmethod
+    def _scale_offline(steps, params):
+        # the VM cannot be scaled while running
+        change = ('changeServiceForVirtualMachine',
+                  {'serviceofferingid': params['serviceofferingid']})
+        commands = [step[0] for step in steps]
+        if 'stopVirtualMachine' in commands:
+            steps.insert(commands.index('stopVirtualMachine') + 1, change)
+        else:
+            steps += [('stopVirtualMachine', {}), change,
+                      ('startVirtualMachine', {})]
+        return steps
+
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        # use post to be able to send up to 64k user data
+        cs = self._get_cloudstack(method='post')
+        steps = json.loads(self.data().get('update_steps', '[]'))
+        try:
+            if jobs.poll(self, cs, 'update_jobid') is None:
+                return False
+        except jobs.AsyncJobFailed as e:
+            command, params = json.loads(self.data()['update_step'])
+            if command != 'scaleVirtualMachine':
+                raise e
+            self.data_delete('update_jobid')
+            steps = self._scale_offline(steps, params)
+
+        if not steps:
+            self._invalidate()
+            return True
+        command, params = steps.pop(0)
+        self._set_update_steps(steps)
+        try:
+            self._run_update_step(cs, command, params)
+        except CloudStackException as e:
+            if command != 'scaleVirtualMachine':
+                raise e
+            self._set_update_steps(self._scale_offline(steps, params))
+        return False
 
-    def check_update_complete(self):
-        # TODO
-        pass
+    def _destroy(self, cs, expunge=True):
+        res = cs.destroyVirtualMachine(id=self.resource_id, expunge=expunge)
+        self.data_set('expunge', str(expunge))
+        jobs.start(self, cs, 'delete_jobid', res)
 
-    def handle_delete(self, expunge=True):
+    def _recycle(self, cs):
+        """Stop the VM to return it to the warm pool, if there is room."""
+        size = self._warm_pool_size()
+        if not CONF.cloudstack.warm_pool_recycle or not size:
+            return False
+        vm = self._show_resource()
+        if vm is None or vm['state'].lower() not in ('running', 'stopped'):
+            return False
+        sig = warmpool.signature(self._pool_params())
+        if not warmpool.get_pool().give_back(cs, sig, self.resource_id,
+                                             size):
+            return False
+        self.data_set('recycle', sig)
+        if vm['state'].lower() == 'running':
+            res = cs.stopVirtualMachine(id=self.resource_id)
+            jobs.start(self, cs, 'delete_jobid', res)
+        return True
+
+    @trace.traced('delete')
+    def handle_delete(self):
         cs = self._get_cloudstack()
 
         if self.resource_id is None:
             return
+        self._invalidate()
+        if self._recycle(cs):
+            return
         try:
-            res = cs.destroyVirtualMachine(id=self.resource_id,
-                                           expunge=expunge)
-            jobid = res['jobid']
-            res = cs.queryAsyncJobResult(jobid=jobid)
-            if int(res['jobresultcode']) == 530:
-                # try to delete with expunge = False
-                self.handle_delete(expunge=False)
+            self._destroy(cs)
         except CloudStackException as e:
+            if retry.not_found(e):
+                # Resource cannot be found
+                return
             raise e
 
+    @scheduler.scheduled('delete')
     def check_delete_complete(self, _compute_id):
+        if self.resource_id is None:
+            return True
+
         cs = self._get_cloudstack()
-        vm = None
+        sig = self.data().get('recycle')
+        if sig is not None:
+            return self._check_recycle(cs, sig)
         try:
-            vm = cs.listVirtualMachines(id=self.resource_id)
-        except CloudStackException as e:
-            if e.args[2]['errorcode'] == 431:
-                # Resource cannot be found
-                # One thing less...
-                return True
+            if jobs.poll(self, cs, 'delete_jobid') is None:
+                return False
+        except jobs.AsyncJobFailed as e:
+            if retry.classify(e) in (retry.SERVER_ERROR, retry.CONCURRENT) \
+                    and self.data().get('expunge') != 'False':
+                # try to delete with expunge = False,
+                # the VM gets expunged by CloudStack later on
+                self._destroy(cs, expunge=False)
+                return False
             raise e
-        if vm:
+
+        # make sure the VM is gone or at least on its way to be expunged
+        vm = poller.get_poller().state(self._get_cloudstack(method='post'),
+                                       self.resource_id)
+        if vm is poller.PENDING:
             return False
-        else:
-            return True
+        if vm and vm['state'].lower() not in ('destroyed', 'expunging'):
+            return False
+
+        self._forget_vm()
+        # drop registered user data no VM refers to anymore, the VM is gone
+        # whether that works or not
+        try:
+            userdata.collect(self._get_cloudstack())
+        except (CloudStackException, requests.RequestException) as e:
+            LOG.warning('Collecting unused user data failed: %s', e)
+        return True
+
+    def _check_recycle(self, cs, sig):
+        pool = warmpool.get_pool()
+        try:
+            if jobs.poll(self, cs, 'delete_jobid') is None:
+                return False
+        except jobs.AsyncJobFailed:
+            # cannot be stopped, destroy it instead
+            pool.discard(cs, sig, self.resource_id)
+            self.data_delete('recycle')
+            self._destroy(cs)
+            return False
+        pool.ready(cs, sig, self.resource_id)
+        self.data_delete('recycle')
+        self._forget_vm()
+        return True
 
+    @trace.traced('suspend')
     def handle_suspend(self):
         cs = self._get_cloudstack()
 
         if self.resource_id is None:
             return
 
+        self._invalidate()
         cs.stopVirtualMachine(id=self.resource_id)
 
+    @scheduler.scheduled('suspend')
     def check_suspend_complete(self, _compute_id):
-        cs = self._get_cloudstack()
-
-        vm = cs.listVirtualMachines(id=self.resource_id)
-        if vm:
-            if vm['virtualmachine'][0]['state'].lower() == 'stopped':
-                return True
+        vm = self._poll_vm()
+        if vm and vm['state'].lower() == 'stopped':
+            self._forget_vm()
+            cache.get_cache().put('virtualmachine', self.resource_id, vm)
+            return True
 
         return False
 
+    @trace.traced('resume')
     def handle_resume(self):
         cs = self._get_cloudstack()
 
         if self.resource_id is None:
             return
 
+        self._invalidate()
         cs.startVirtualMachine(id=self.resource_id)
 
+    @scheduler.scheduled('resume')
     def check_resume_complete(self, _compute_id):
-        cs = self._get_cloudstack()
-
-        vm = cs.listVirtualMachines(id=self.resource_id)
-        if vm:
-            if vm['virtualmachine'][0]['state'].lower() == 'running':
-                return True
+        vm = self._poll_vm()
+        if vm and vm['state'].lower() == 'running':
+            self._forget_vm()
+            cache.get_cache().put('virtualmachine', self.resource_id, vm)
+            return True
 
         return False
 
     def _resolve_attribute(self, name):
-        cs = self._get_cloudstack()
-
-        vm = cs.listVirtualMachines(id=self.resource_id)
+        vm = self._show_resource()
         if vm:
             if name == 'network_ip':
-                return vm['virtualmachine'][0]['nic'][0]['ipaddress']
-            if name == 'id':
-                return vm['virtualmachine'][0]['id']
-            return getattr(vm, name)
+                return vm['nic'][0]['ipaddress']
+            if name == 'network_ips':
+                return [nic.get('ipaddress') for nic in vm.get('nic', [])]
+            if name == 'show':
+                return vm
+            return vm.get(name)
 
     attributes_schema = {
         'id': _('id'),
-        'network_ip': _('network_ip')
+        'network_ip': _('IP address of the first NIC'),
+        'network_ips': _('IP addresses of all NICs'),
+        'state': _('state'),
+        'show': _('All attributes of the virtual machine')
     }
 
 
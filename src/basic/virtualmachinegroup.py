@@ -0,0 +1,280 @@
+import json
+
+from cs import CloudStackException
+
+from heat.engine import constraints
+from heat.engine import properties
+from heat.engine import resource
+from gettext import gettext as _
+
+from ..common import cache
+from ..common import capacity
+from ..common import jobs
+from ..common import pool
+from ..common import retry
+from ..common import scheduler
+from ..common import trace
+from ..common.config import CONF
+from .virtualmachine import CloudstackVirtualMachine
+
+__author__ = 'cima'
+
+# members are neither pinned to an address nor taken from a warm pool
+EXCLUDED_PROPERTIES = (CloudstackVirtualMachine.IPADDRESS,
+                       CloudstackVirtualMachine.WARM_POOL)
+
+
+class CloudstackVirtualMachineGroup(CloudstackVirtualMachine):
+    """Fleet of identical VMs kept in one CloudStack instance group."""
+
+    COUNT = 'count'
+
+    PROPERTIES = tuple(
+        key for key in CloudstackVirtualMachine.PROPERTIES
+        if key not in EXCLUDED_PROPERTIES) + (COUNT,)
+
+    properties_schema = dict(
+        (key, schema) for key, schema in
+        CloudstackVirtualMachine.properties_schema.items()
+        if key not in EXCLUDED_PROPERTIES)
+    properties_schema[COUNT] = properties.Schema(
+        data_type=properties.Schema.INTEGER,
+        description=_('Number of virtual machines'),
+        required=True,
+        update_allowed=True,
+        constraints=[constraints.Range(min=0)]
+    )
+
+    def _group_name(self):
+        return self.properties.get(self.NAME) or \
+            self.physical_resource_name()
+
+    def _members(self):
+        return json.loads(self.data().get('members', '[]'))
+
+    def _set_members(self, members):
+        self.data_set('members', json.dumps(members))
+
+    def _deploy(self, count):
+        # use post to be able to inject up to 64k user data
+        cs = self._get_cloudstack(method='post')
+        members = self._members()
+        params = self._deploy_params()
+        params['group'] = self._group_name()
+        name = self.properties.get(self.NAME)
+
+        def deploy(index):
+            member_params = dict(params)
+            if name:
+                member_params['name'] = '%s-%d' % (name, index)
+            try:
+                return self._deploy_vm(cs, member_params)
+            except CloudStackException as e:
+                return e
+
+        first = len(members)
+        responses = pool.map(deploy, range(first, first + count),
+                             size=CONF.cloudstack.vm_group_workers)
+        # keep track of the members deployed before raising any failure
+        deployed = [res for res in responses
+                    if not isinstance(res, Exception)]
+        self._set_members(members + [vm['id'] for vm in deployed])
+        jobs.start_many(self, cs, 'create_jobids', deployed)
+        for res in responses:
+            if isinstance(res, Exception):
+                raise res
+
+    def _destroy_members(self, members):
+        cs = self._get_cloudstack()
+
+        def destroy(vm_id):
+            try:
+                return cs.destroyVirtualMachine(id=vm_id, expunge=True)
+            except CloudStackException as e:
+                if retry.not_found(e):
+                    # Resource cannot be found
+                    return None
+                raise e
+
+        responses = pool.map(destroy, members,
+                             size=CONF.cloudstack.vm_group_workers)
+        jobs.start_many(self, cs, 'delete_jobids', responses)
+
+    def _destroy_unexpunged(self, cs, failed):
+        """Destroy the members whose destroy job failed without expunge.
+
+        Like a single VM the members get expunged by CloudStack later on,
+        a member failing again fails the delete.
+        """
+        unexpunged = set(json.loads(self.data().get('unexpunged', '[]')))
+        members = []
+        for e in failed:
+            vm_id = (e.args[1] or {}).get('jobinstanceid')
+            if vm_id is None or vm_id in unexpunged or retry.classify(e) \
+                    not in (retry.SERVER_ERROR, retry.CONCURRENT):
+                raise e
+            members.append(vm_id)
+        self.data_set('unexpunged', json.dumps(sorted(unexpunged |
+                                                      set(members))))
+
+        def destroy(vm_id):
+            try:
+                return cs.destroyVirtualMachine(id=vm_id, expunge=False)
+            except CloudStackException as e:
+                if retry.not_found(e):
+                    return None
+                raise e
+
+        pending = self.data().get('delete_jobids')
+        responses = pool.map(destroy, members,
+                             size=CONF.cloudstack.vm_group_workers)
+        jobids = jobs.start_many(self, cs, 'delete_jobids', responses)
+        if pending:
+            # start_many replaces the jobs of other members still running
+            self.data_set('delete_jobids', ','.join([pending] + jobids))
+
+    def _list_members(self):
+        cs = self._get_cloudstack()
+        members = []
+        page = 1
+        while True:
+            res = cs.listVirtualMachines(groupid=self.resource_id,
+                                         page=page, pagesize=500)
+            vms = res.get('virtualmachine', []) if res else []
+            members.extend(vms)
+            if len(vms) < 500:
+                return members
+            page += 1
+
+    def _show_resource(self):
+        return cache.get_cache().fetch('instancegroup', self.resource_id,
+                                       self._list_members)
+
+    def _invalidate(self):
+        cache.get_cache().invalidate('instancegroup', self.resource_id)
+
+    @trace.traced('create')
+    def handle_create(self):
+        capacity.preflight(self)
+        cs = self._get_cloudstack()
+
+        group = cs.createInstanceGroup(name=self._group_name())
+        self.resource_id_set(group['instancegroup']['id'])
+
+        self._deploy(self.properties.get(self.COUNT))
+        return self.resource_id
+
+    @scheduler.scheduled('create')
+    def check_create_complete(self, _compute_id):
+        # one batched job query for all members
+        return jobs.poll_many(self, self._get_cloudstack(), 'create_jobids')
+
+    @trace.traced('update')
+    def handle_update(self, json_snippet=None, tmpl_diff=None, prop_diff=None):
+        self._invalidate()
+        if not prop_diff:
+            return
+        if set(prop_diff) - set([self.COUNT]):
+            # members are only added or removed, never changed
+            raise resource.UpdateReplace(self.name)
+
+        members = self._members()
+        count = prop_diff[self.COUNT]
+        if count > len(members):
+            capacity.preflight_scale(self, count - len(members))
+            self._deploy(count - len(members))
+        elif count < len(members):
+            self._set_members(members[:count])
+            self._destroy_members(members[count:])
+
+    @scheduler.scheduled('update')
+    def check_update_complete(self, _cookie=None):
+        cs = self._get_cloudstack()
+        return (jobs.poll_many(self, cs, 'create_jobids') and
+                jobs.poll_many(self, cs, 'delete_jobids'))
+
+    @trace.traced('delete')
+    def handle_delete(self):
+        if self.resource_id is None:
+            return
+        self._invalidate()
+        self._destroy_members(self._members())
+        self._set_members([])
+
+    @scheduler.scheduled('delete')
+    def check_delete_complete(self, _compute_id):
+        if self.resource_id is None:
+            return True
+
+        cs = self._get_cloudstack()
+        failed = []
+        done = jobs.poll_many(self, cs, 'delete_jobids', failed=failed)
+        if failed:
+            self._destroy_unexpunged(cs, failed)
+            return False
+        if not done:
+            return False
+        for vm in self._list_members():
+            if vm['state'].lower() not in ('destroyed', 'expunging'):
+                return False
+        try:
+            cs.deleteInstanceGroup(id=self.resource_id)
+        except CloudStackException as e:
+            if not retry.not_found(e):
+                raise e
+        return True
+
+    def _control_members(self, command):
+        cs = self._get_cloudstack()
+        self._invalidate()
+        responses = pool.map(lambda vm_id: getattr(cs, command)(id=vm_id),
+                             self._members(),
+                             size=CONF.cloudstack.vm_group_workers)
+        jobs.start_many(self, cs, 'control_jobids', responses)
+
+    @trace.traced('suspend')
+    def handle_suspend(self):
+        if self.resource_id is None:
+            return
+        self._control_members('stopVirtualMachine')
+
+    @scheduler.scheduled('suspend')
+    def check_suspend_complete(self, _compute_id):
+        return jobs.poll_many(self, self._get_cloudstack(), 'control_jobids')
+
+    @trace.traced('resume')
+    def handle_resume(self):
+        if self.resource_id is None:
+            return
+        self._control_members('startVirtualMachine')
+
+    @scheduler.scheduled('resume')
+    def check_resume_complete(self, _compute_id):
+        return jobs.poll_many(self, self._get_cloudstack(), 'control_jobids')
+
+    def _resolve_attribute(self, name):
+        vms = self._show_resource()
+        if vms is None:
+            return None
+        if name == 'ids':
+            return [vm['id'] for vm in vms]
+        if name == 'network_ips':
+            return [vm['nic'][0]['ipaddress'] for vm in vms if vm.get('nic')]
+        if name == 'show':
+            return vms
+        if name == 'id':
+            return self.resource_id
+
+    attributes_schema = {
+        'id': _('id of the instance group'),
+        'ids': _('ids of the member virtual machines'),
+        'network_ips': _('IP addresses of the first NIC of every member'),
+        'show': _('All attributes of the member virtual machines')
+    }
+
+
+def resource_mapping():
+    mappings = {}
+    mappings['Cloudstack::Compute::VirtualMachineGroup'] = \
+        CloudstackVirtualMachineGroup
+    return mappings
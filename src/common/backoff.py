@@ -0,0 +1,8 @@
+import random
+
+__author__ = 'cima'
+
+
+def delay(attempt, base=2, cap=60):
+    """Exponential backoff with full jitter for the given attempt (1..n)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
@@ -0,0 +1,74 @@
+import threading
+import time
+
+from .config import CONF
+
+__author__ = 'cima'
+
+
+class RecordCache(object):
+    """TTL cache of CloudStack records keyed by record kind and id.
+
+    The kind is the key CloudStack uses for the record in list responses,
+    e.g. 'virtualmachine' or 'publicipaddress'.
+    """
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind, record_id):
+        with self._lock:
+            entry = self._records.get((kind, record_id))
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, kind, record_id, record):
+        if record_id is None or not record:
+            return
+        now = time.time()
+        with self._lock:
+            if len(self._records) >= self.max_size:
+                self._expire(now)
+            self._records[(kind, record_id)] = (now + self.ttl, record)
+
+    def invalidate(self, kind, record_id):
+        with self._lock:
+            self._records.pop((kind, record_id), None)
+
+    def fetch(self, kind, record_id, loader):
+        """Return the cached record or load, cache and return it."""
+        if record_id is None:
+            return None
+        record = self.get(kind, record_id)
+        if record is None:
+            record = loader()
+            self.put(kind, record_id, record)
+        return record
+
+    def _expire(self, now):
+        for key, entry in list(self._records.items()):
+            if entry[0] <= now:
+                del self._records[key]
+        if len(self._records) >= self.max_size:
+            self._records.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = RecordCache(ttl=CONF.cloudstack.record_cache_ttl)
+    return _cache
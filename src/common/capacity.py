@@ -0,0 +1,310 @@
+import logging
+import threading
+import time
+
+import requests
+from cs import CloudStackException
+
+from . import catalog
+from . import client
+from . import ippool
+from . import retry
+from . import warmpool
+from .config import CONF
+
+__author__ = 'cima'
+
+LOG = logging.getLogger(__name__)
+
+VM = 'Cloudstack::Compute::VirtualMachine'
+VM_GROUP = 'Cloudstack::Compute::VirtualMachineGroup'
+ADDRESS = 'Cloudstack::Network::Address'
+NETWORK = 'Cloudstack::Network::Network'
+VPC = 'Cloudstack::Network::VPC'
+
+# listResourceLimits resource types and the listAccounts usage fields
+LIMITS = (('0', 'vms', 'vmtotal'),
+          ('1', 'ips', 'iptotal'),
+          ('6', 'networks', 'networktotal'),
+          ('7', 'vpcs', 'vpctotal'),
+          ('8', 'cpu', 'cputotal'),
+          ('9', 'memory', 'memorytotal'))
+
+# listCapacity types of zone wide capacity
+CAPACITIES = (('0', 'memory'), ('1', 'cpu_mhz'))
+
+UNITS = {'vms': 'VMs', 'ips': 'public IPs', 'networks': 'networks',
+         'vpcs': 'VPCs', 'cpu': 'cores', 'memory': 'MB', 'cpu_mhz': 'MHz'}
+
+# raised for accounts which may not list the capacity of their zones
+FORBIDDEN_ERRORS = (401, 432)
+
+
+class CapacityShortfall(Exception):
+    pass
+
+
+class _Demand(object):
+    """Resources a stack asks for from one account."""
+
+    def __init__(self, cs):
+        self.cs = cs
+        self.totals = dict((name, 0) for _type, name, _field in LIMITS)
+        self.zones = {}
+        self.pooled = {}
+
+    def add(self, name, amount):
+        self.totals[name] += amount
+
+    def add_vms(self, count, zoneid, offering):
+        self.totals['vms'] += count
+        self.totals['cpu'] += count * int(offering.get('cpunumber') or 0)
+        self.totals['memory'] += count * int(offering.get('memory') or 0)
+        self.add_zone(count, zoneid, offering)
+
+    def add_zone(self, count, zoneid, offering):
+        cpu = int(offering.get('cpunumber') or 0)
+        zone = self.zones.setdefault(zoneid, {'memory': 0, 'cpu_mhz': 0})
+        zone['memory'] += count * int(offering.get('memory') or 0)
+        zone['cpu_mhz'] += count * cpu * int(offering.get('cpuspeed') or 0)
+
+    def add_pooled(self, pool, key, costs):
+        """Count a resource a pool may serve with the totals it adds."""
+        entry = self.pooled.setdefault((pool, key), [0, costs])
+        entry[0] += 1
+
+    def settle(self):
+        """Add the pooled resources the pools cannot serve.
+
+        Ready pool resources already count in the usage of the account.
+        """
+        for (pool, key), (count, costs) in self.pooled.items():
+            misses = max(0, count - pool.available(self.cs, key))
+            for name, amount in costs.items():
+                self.totals[name] += misses * amount
+        self.pooled = {}
+
+
+def _get(res, name):
+    try:
+        return res.properties.get(name)
+    except Exception:
+        # left to Heat's own validation of the resource
+        return None
+
+
+def _client(res):
+    return client.get_client(endpoint=_get(res, 'api_endpoint'),
+                             key=_get(res, 'api_key'),
+                             secret=_get(res, 'api_secret'))
+
+
+def _offering(cs, res):
+    zoneid = catalog.resolve(cs, 'zone', _get(res, 'zone_id'))
+    offeringid = catalog.resolve(cs, 'serviceoffering',
+                                 _get(res, 'service_offering_id'))
+    offering = catalog.get_catalog(cs).get(
+        cs, 'serviceoffering', offeringid) or {}
+    return zoneid, offeringid, offering
+
+
+def _warm_pool(cs, res, zoneid, offeringid):
+    """Signature of the warm pool a VM is claimed from, else None."""
+    if res.type() != VM or not _get(res, 'warm_pool') or \
+            _get(res, 'ipaddress'):
+        return None
+    network_ids = _get(res, 'network_ids') or []
+    if None in network_ids:
+        # networks of the stack are new, no pool VM is attached to them
+        return None
+    return warmpool.signature({
+        'zoneid': zoneid, 'serviceofferingid': offeringid,
+        'templateid': catalog.resolve(cs, 'template', _get(res, 'template_id'),
+                                      zoneid=zoneid),
+        'networkids': network_ids or None,
+        'keypair': _get(res, 'key_pair') or None})
+
+
+def demand(stack):
+    """Add up what the resources of the stack still to create ask for.
+
+    Returns a _Demand per endpoint and API key.  VPCs take a source NAT
+    address besides counting as a VPC.  VMs and addresses served by a
+    pool only count as far as the pool runs short, pool VMs still take
+    their zone capacity once started.
+    """
+    demands = {}
+    for res in stack.resources.values():
+        if res.resource_id is not None or res.type() not in (
+                VM, VM_GROUP, ADDRESS, NETWORK, VPC):
+            continue
+        cs = _client(res)
+        account = demands.get((cs.endpoint, cs.key))
+        if account is None:
+            account = demands[(cs.endpoint, cs.key)] = _Demand(cs)
+        if res.type() in (VM, VM_GROUP):
+            zoneid, offeringid, offering = _offering(cs, res)
+            sig = _warm_pool(cs, res, zoneid, offeringid)
+            if sig is not None:
+                account.add_pooled(warmpool.get_pool(), sig, {
+                    'vms': 1,
+                    'cpu': int(offering.get('cpunumber') or 0),
+                    'memory': int(offering.get('memory') or 0)})
+                account.add_zone(1, zoneid, offering)
+                continue
+            count = _get(res, 'count') if res.type() == VM_GROUP else 1
+            account.add_vms(count or 0, zoneid, offering)
+        elif res.type() == ADDRESS:
+            vpcid = _get(res, 'vpc_id')
+            if _get(res, 'pooled') and vpcid is not None:
+                account.add_pooled(ippool.get_pool(), vpcid, {'ips': 1})
+            else:
+                account.add('ips', 1)
+        elif res.type() == NETWORK:
+            account.add('networks', 1)
+        else:
+            account.add('vpcs', 1)
+            account.add('ips', 1)
+    for account in demands.values():
+        account.settle()
+    return demands
+
+
+def _available(limit, used):
+    if limit is None or int(limit) < 0:
+        return None
+    return int(limit) - int(used)
+
+
+def shortfalls(account):
+    """Compare the demand of an account to its limits and zone capacity.
+
+    Limits take one listResourceLimits and one listAccounts query, zone
+    capacity one listCapacity query.
+    """
+    cs = account.cs
+    found = []
+    limits = cs.listResourceLimits().get('resourcelimit', [])
+    if limits:
+        records = cs.listAccounts(name=limits[0].get('account'),
+                                  domainid=limits[0].get('domainid'))
+        usage = (records.get('account') or [{}])[0]
+        by_type = dict((str(limit.get('resourcetype')), limit.get('max'))
+                       for limit in limits)
+        for resource_type, name, field in LIMITS:
+            requested = account.totals[name]
+            available = _available(by_type.get(resource_type),
+                                   usage.get(field) or 0)
+            if requested and available is not None and \
+                    requested > available:
+                found.append('%s: %d %s requested, %d available of the '
+                             'account limit of %s' % (
+                                 name, requested, UNITS[name],
+                                 max(available, 0),
+                                 by_type[resource_type]))
+
+    if not account.zones:
+        return found
+    try:
+        capacities = cs.listCapacity().get('capacity', [])
+    except CloudStackException as e:
+        if retry.error_code(e) not in FORBIDDEN_ERRORS:
+            raise e
+        return found
+    by_zone = dict(((c.get('zoneid'), str(c.get('type'))), c)
+                   for c in capacities)
+    for zoneid, requested in sorted(account.zones.items()):
+        for capacity_type, name in CAPACITIES:
+            capacity = by_zone.get((zoneid, capacity_type))
+            if capacity is None:
+                continue
+            total = int(capacity.get('capacitytotal') or 0)
+            used = int(capacity.get('capacityused') or 0)
+            amount = requested[name]
+            if name == 'memory':
+                # capacity is counted in bytes
+                total //= 1024 * 1024
+                used //= 1024 * 1024
+            if amount > total - used:
+                found.append('%s of zone %s: %d %s requested, %d free of '
+                             '%d' % (name, capacity.get('zonename', zoneid),
+                                     amount, UNITS[name],
+                                     max(total - used, 0), total))
+    return found
+
+
+class _Check(object):
+    def __init__(self):
+        self.checked_at = time.time()
+        self.done = False
+        self.shortfalls = []
+        self.lock = threading.Lock()
+
+
+_checks = {}
+_checks_lock = threading.Lock()
+
+
+def _check(stack):
+    key = (stack.id, stack.action, getattr(stack, 'current_traversal', None))
+    with _checks_lock:
+        now = time.time()
+        for stale in [k for k, check in _checks.items()
+                      if now - check.checked_at > 3600]:
+            del _checks[stale]
+        check = _checks.get(key)
+        if check is None:
+            check = _checks[key] = _Check()
+        return check
+
+
+def preflight(res):
+    """Fail if the stack of the resource asks for more than available.
+
+    The check runs once per stack operation, the first resource created
+    pays for every other one.  Raises CapacityShortfall with one line per
+    exceeded limit or zone capacity.
+    """
+    if not CONF.cloudstack.preflight_capacity:
+        return
+    check = _check(res.stack)
+    with check.lock:
+        if not check.done:
+            try:
+                check.shortfalls = [line for account in
+                                    demand(res.stack).values()
+                                    for line in shortfalls(account)]
+            except (CloudStackException, requests.RequestException,
+                    catalog.CatalogLookupError) as e:
+                # the check is advisory, CloudStack has the last word, also
+                # on timeouts or when no management server answers
+                LOG.warning('Capacity pre-flight check of stack %s failed: '
+                            '%s', res.stack.name, e)
+            check.done = True
+    if check.shortfalls:
+        raise CapacityShortfall('Stack %s asks for more than available: %s'
+                                % (res.stack.name,
+                                   '; '.join(check.shortfalls)))
+
+
+def preflight_scale(res, count):
+    """Fail if count more members of a VM group ask for more than available.
+
+    Unlike the check of a stack this one runs on every scale up.
+    """
+    if not CONF.cloudstack.preflight_capacity or count <= 0:
+        return
+    try:
+        cs = _client(res)
+        account = _Demand(cs)
+        zoneid, _offeringid, offering = _offering(cs, res)
+        account.add_vms(count, zoneid, offering)
+        found = shortfalls(account)
+    except (CloudStackException, requests.RequestException,
+            catalog.CatalogLookupError) as e:
+        LOG.warning('Capacity pre-flight check of %s failed: %s', res.name, e)
+        return
+    if found:
+        raise CapacityShortfall('Adding %d VMs to %s asks for more than '
+                                'available: %s' % (count, res.name,
+                                                   '; '.join(found)))
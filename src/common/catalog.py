@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from . import state
+from .config import CONF
+
+__author__ = 'cima'
+
+# kind: (list API, response key, extra list parameters)
+KINDS = {
+    'zone': ('listZones', 'zone', {}),
+    'serviceoffering': ('listServiceOfferings', 'serviceoffering', {}),
+    'template': ('listTemplates', 'template',
+                 {'templatefilter': 'executable'}),
+    'networkoffering': ('listNetworkOfferings', 'networkoffering', {}),
+    'vpcoffering': ('listVPCOfferings', 'vpcoffering', {})
+}
+
+
+UUID_RE = re.compile('^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                     '[0-9a-f]{12}$', re.IGNORECASE)
+
+
+class CatalogLookupError(ValueError):
+    pass
+
+
+def iter_records(cs, api, key, page_size=500, **params):
+    """Stream the records of a list API page by page."""
+    page = 1
+    while True:
+        res = getattr(cs, api)(page=page, pagesize=page_size, **params)
+        records = res.get(key, []) if res else []
+        for record in records:
+            yield record
+        if len(records) < page_size:
+            return
+        page += 1
+
+
+class _Index(object):
+    def __init__(self, records, fetched_at):
+        self.records = records
+        self.fetched_at = fetched_at
+        self.by_id = {}
+        self.by_name = {}
+        for record in records:
+            self.by_id[record['id']] = record
+            self.by_name.setdefault(record.get('name'), []).append(record)
+
+
+class Catalog(object):
+    """Indexes of offerings, templates and zones of one account.
+
+    Each kind is listed once per TTL and indexed by id and name, so
+    resolving a name is a dictionary lookup.  Indexes are snapshotted to
+    snapshot_file so a restarted engine starts warm.
+    """
+
+    def __init__(self, ttl=600, page_size=500, snapshot_file=None):
+        self.ttl = ttl
+        self.page_size = page_size
+        self.snapshot_file = snapshot_file
+        self.refreshes = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _index(self, cs, kind, refresh=False):
+        with self._lock:
+            index = self._indexes.get(kind)
+            if refresh or index is None or \
+                    time.time() - index.fetched_at >= self.ttl:
+                api, key, params = KINDS[kind]
+                self.refreshes += 1
+                index = _Index(list(iter_records(cs, api, key,
+                                                 page_size=self.page_size,
+                                                 **params)),
+                               time.time())
+                self._indexes[kind] = index
+                self._save()
+            return index
+
+    def get(self, cs, kind, record_id):
+        return self._index(cs, kind).by_id.get(record_id)
+
+    def resolve(self, cs, kind, value, zoneid=None):
+        """Return the id of the record with the given id or name.
+
+        Ids are returned as they are, without listing the catalog; ids
+        which are not visible to the account are left to CloudStack.
+        """
+        if value is None or UUID_RE.match(value):
+            return value
+        index = self._index(cs, kind)
+        if value in index.by_id:
+            return value
+        if value not in index.by_name:
+            # may have been added since the last refresh
+            index = self._index(cs, kind, refresh=True)
+            if value in index.by_id:
+                return value
+
+        records = index.by_name.get(value, [])
+        if zoneid is not None and len(records) > 1:
+            records = [r for r in records
+                       if r.get('zoneid') in (None, zoneid)]
+        ids = set(r['id'] for r in records)
+        if not ids:
+            raise CatalogLookupError('No %s named %s' % (kind, value))
+        if len(ids) > 1:
+            raise CatalogLookupError('%d %ss are named %s, use the id' %
+                                     (len(ids), kind, value))
+        return ids.pop()
+
+    def _load(self):
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            return
+        for kind, entry in snapshot.items():
+            if kind in KINDS:
+                self._indexes[kind] = _Index(entry['records'],
+                                             entry['fetched_at'])
+
+    def _save(self):
+        if not self.snapshot_file:
+            return
+        snapshot = dict((kind, {'records': index.records,
+                                'fetched_at': index.fetched_at})
+                        for kind, index in self._indexes.items())
+        # every engine worker writes its own file and renames it in place
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(self.snapshot_file) or '.',
+                prefix=os.path.basename(self.snapshot_file) + '.',
+                suffix='.tmp')
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(tmp, self.snapshot_file)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(cs):
+    key = (cs.endpoint, cs.key)
+    with _catalogs_lock:
+        catalog = _catalogs.get(key)
+        if catalog is None:
+            snapshot_file = None
+            if CONF.cloudstack.catalog_snapshot_dir:
+                snapshot_file = state.path(
+                    CONF.cloudstack.catalog_snapshot_dir, *key)
+            catalog = _catalogs[key] = Catalog(
+                ttl=CONF.cloudstack.catalog_ttl,
+                snapshot_file=snapshot_file)
+        return catalog
+
+
+def resolve(cs, kind, value, zoneid=None):
+    return get_catalog(cs).resolve(cs, kind, value, zoneid=zoneid)
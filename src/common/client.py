@@ -0,0 +1,200 @@
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cs import CloudStack
+from cs import CloudStackException
+from cs import transform
+
+from . import endpoints
+from . import metrics
+from . import ratelimit
+from . import retry
+from . import trace
+from .config import CONF
+
+__author__ = 'cima'
+
+
+class PooledCloudStack(CloudStack):
+    """CloudStack client issuing requests over a persistent HTTP session."""
+
+    def __init__(self, endpoint, key, secret, timeout=10, method='get',
+                 pool_maxsize=10, limiter=None, recorder=None,
+                 retrier=None, balancer=None):
+        super(PooledCloudStack, self).__init__(endpoint=endpoint,
+                                               key=key,
+                                               secret=secret,
+                                               timeout=timeout,
+                                               method=method)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.limiter = limiter
+        self.recorder = recorder
+        self.retrier = retrier
+        # several management servers of one cluster, the endpoint
+        # attribute keeps identifying the account
+        self.urls = endpoints.split(endpoint)
+        self.balancer = balancer if len(self.urls) > 1 else None
+
+    def _request(self, command, json=True, opcode_name='command', **kwargs):
+        if self.retrier is None:
+            return self._send(command, json, opcode_name, **kwargs)
+        return self.retrier.call(command, self._send, command, json,
+                                 opcode_name, **kwargs)
+
+    def _send(self, command, json, opcode_name, **kwargs):
+        kwargs.update({
+            'apiKey': self.key,
+            opcode_name: command,
+        })
+        if json:
+            kwargs['response'] = 'json'
+        if 'page' in kwargs:
+            kwargs.setdefault('pagesize', 500)
+
+        kwargs = transform(kwargs)
+        kwargs['signature'] = self._sign(kwargs)
+
+        kw = {'timeout': self.timeout}
+        if self.method == 'get':
+            kw['params'] = kwargs
+        else:
+            kw['data'] = kwargs
+        if self.balancer is None:
+            return self._attempt(self.urls[0], command, kw)
+        # the signature does not cover the URL, any endpoint accepts it
+        return self.balancer.call(
+            self.urls, command, lambda url: self._attempt(url, command, kw))
+
+    def _attempt(self, url, command, kw):
+        if self.limiter is not None:
+            wait = self.limiter.acquire(self.endpoint, self.key, command)
+            if self.recorder is not None:
+                self.recorder.waited(self.endpoint,
+                                     ratelimit.priority(command), wait)
+
+        started = time.time()
+        response = self.session.request(self.method, url, **kw)
+
+        try:
+            data = response.json()
+        except ValueError as e:
+            self._record(command, started, response, response.status_code)
+            msg = "Make sure endpoint URL '%s' is correct." % url
+            raise CloudStackException(
+                "HTTP {0} response from CloudStack".format(
+                    response.status_code), response, "%s. " % str(e) + msg
+                )
+
+        [key] = data.keys()
+        data = data[key]
+        if response.status_code != 200:
+            self._record(command, started, response,
+                         data.get('errorcode', response.status_code))
+            raise CloudStackException(
+                "HTTP {0} response from CloudStack".format(
+                    response.status_code), response, data)
+        self._record(command, started, response)
+        return data
+
+    def _record(self, command, started, response, error=None):
+        ended = time.time()
+        error = error and str(error)
+        if self.recorder is not None:
+            self.recorder.record(command, ended - started,
+                                 len(response.content), error=error)
+        trace.api_call(command, started, ended, error=error)
+
+    def close(self):
+        self.session.close()
+
+
+class ClientRegistry(object):
+    """Bounded LRU registry of API clients keyed by endpoint, key and method.
+
+    Clients are shared by all resources of the engine process so that their
+    keep-alive connections are reused between handle and check calls.
+    """
+
+    def __init__(self, max_size=32, pool_maxsize=10, timeout=10):
+        self.max_size = max_size
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, key, secret, method='get'):
+        endpoint = ','.join(endpoints.split(endpoint))
+        registry_key = (endpoint, key, method.lower())
+        with self._lock:
+            client = self._clients.pop(registry_key, None)
+            if client is not None and client.secret == secret:
+                self.hits += 1
+                self._clients[registry_key] = client
+                return client
+            if client is not None:
+                # secret was rotated, drop the stale client
+                client.close()
+            self.misses += 1
+            client = PooledCloudStack(endpoint=endpoint,
+                                      key=key,
+                                      secret=secret,
+                                      timeout=self.timeout,
+                                      method=method,
+                                      pool_maxsize=self.pool_maxsize,
+                                      limiter=ratelimit.get_limiter(),
+                                      recorder=metrics.get_metrics(),
+                                      retrier=retry.get_policy(),
+                                      balancer=endpoints.get_balancer())
+            self._clients[registry_key] = client
+            while len(self._clients) > self.max_size:
+                _key, evicted = self._clients.popitem(last=False)
+                evicted.close()
+                self.evictions += 1
+            return client
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._clients),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def clear(self):
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ClientRegistry(
+                    max_size=CONF.cloudstack.client_pool_size,
+                    pool_maxsize=CONF.cloudstack.http_pool_maxsize,
+                    timeout=CONF.cloudstack.http_timeout)
+    return _registry
+
+
+def get_client(endpoint, key, secret, method='get'):
+    return get_registry().get(endpoint, key, secret, method=method)
+
+
+def stats():
+    return get_registry().stats()
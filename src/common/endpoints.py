@@ -0,0 +1,238 @@
+import threading
+import time
+
+import eventlet
+from eventlet import queue
+import requests
+import urllib3
+from cs import CloudStackException
+
+from . import retry
+from .config import CONF
+
+__author__ = 'cima'
+
+# a hedged call waits for this many typical latencies of its first endpoint
+HEDGE_FACTOR = 3
+
+# status codes of load balancers in front of an unavailable server
+UNAVAILABLE = (502, 503, 504)
+
+
+def split(endpoint):
+    """Return the URLs of a comma separated api_endpoint."""
+    return [url.strip() for url in endpoint.split(',') if url.strip()]
+
+
+def down(e):
+    """Return True if the error tells the endpoint is unavailable."""
+    if isinstance(e, requests.RequestException):
+        return True
+    if isinstance(e, CloudStackException):
+        # CloudStack itself always answers with a JSON error document
+        data = e.args[2] if len(e.args) > 2 else None
+        return not isinstance(data, dict) and \
+            retry.error_code(e) in UNAVAILABLE
+    return False
+
+
+def not_sent(e):
+    """Return True if the request never reached the endpoint."""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0] if e.args else None, 'reason', None)
+    return isinstance(e, requests.ConnectionError) and \
+        isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+class _Endpoint(object):
+    def __init__(self):
+        self.latency = None
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.calls = 0
+        self.errors = 0
+
+
+class Balancer(object):
+    """Health and latency of the management servers of a cluster.
+
+    Calls go to the closed endpoint with the fewest recent failures and
+    the lowest moving average latency.  A failed endpoint is probed by a
+    green thread every probe_interval until it answers again, and after
+    failure_threshold failures in a row it is ejected: its circuit opens
+    until a probe succeeds.  Ejected endpoints are only used once every
+    endpoint is ejected.  Read only list calls are hedged: if the first
+    endpoint has not answered after hedge_delay, or a few times its
+    typical latency if that is longer, the call is sent to the second
+    endpoint as well and the first answer wins.
+    """
+
+    def __init__(self, failure_threshold=3, probe_interval=10, decay=0.2,
+                 hedge=True, hedge_delay=0.5, timeout=10):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.decay = decay
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.timeout = timeout
+        self.failovers = 0
+        self.hedges = 0
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, url):
+        endpoint = self._endpoints.get(url)
+        if endpoint is None:
+            endpoint = self._endpoints[url] = _Endpoint()
+        return endpoint
+
+    def rank(self, urls):
+        """Order the endpoints by health, then latency."""
+        with self._lock:
+            endpoints = [(url, self._endpoint(url)) for url in urls]
+            closed = sorted(((e.failures, e.latency or 0), i, url)
+                            for i, (url, e) in enumerate(endpoints)
+                            if e.opened_at is None)
+            opened = sorted((e.opened_at, i, url) for i, (url, e) in
+                            enumerate(endpoints) if e.opened_at is not None)
+        return [url for _key, _i, url in closed + opened]
+
+    def report(self, url, latency, failed=False):
+        probe = False
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint.calls += 1
+            if failed:
+                endpoint.errors += 1
+                endpoint.failures += 1
+                if endpoint.failures >= self.failure_threshold and \
+                        endpoint.opened_at is None:
+                    endpoint.opened_at = time.time()
+                probe = not endpoint.probing
+                endpoint.probing = True
+            else:
+                endpoint.failures = 0
+                endpoint.opened_at = None
+                if endpoint.latency is None:
+                    endpoint.latency = latency
+                else:
+                    endpoint.latency += self.decay * (
+                        latency - endpoint.latency)
+        if probe:
+            eventlet.spawn_n(self._probe, url)
+
+    def _probe(self, url):
+        session = requests.Session()
+        try:
+            while True:
+                time.sleep(self.probe_interval)
+                with self._lock:
+                    if self._endpoint(url).failures == 0:
+                        # recovered on a call meanwhile
+                        return
+                started = time.time()
+                try:
+                    # unsigned, any JSON answer proves the server is up
+                    session.get(url, params={'command': 'listCapabilities',
+                                             'response': 'json'},
+                                timeout=self.timeout).json()
+                except (requests.RequestException, ValueError):
+                    continue
+                with self._lock:
+                    endpoint = self._endpoint(url)
+                    endpoint.failures = 0
+                    endpoint.opened_at = None
+                    endpoint.latency = time.time() - started
+                return
+        finally:
+            with self._lock:
+                self._endpoint(url).probing = False
+            session.close()
+
+    def _timed(self, url, attempt):
+        started = time.time()
+        try:
+            result = attempt(url)
+        except (CloudStackException, requests.RequestException) as e:
+            self.report(url, time.time() - started, failed=down(e))
+            raise
+        self.report(url, time.time() - started)
+        return result
+
+    def call(self, urls, command, attempt):
+        """Issue a request with attempt(url) on the best endpoints."""
+        ranked = self.rank(urls)
+        if self.hedge and len(ranked) > 1 and command.startswith('list'):
+            return self._hedged(ranked[0], ranked[1], attempt)
+        for i, url in enumerate(ranked):
+            try:
+                return self._timed(url, attempt)
+            except requests.RequestException as e:
+                # a request which may have been executed is left to the
+                # retry policy, which knows whether it is idempotent
+                if i == len(ranked) - 1 or not (
+                        not_sent(e) or retry.idempotent(command)):
+                    raise
+                with self._lock:
+                    self.failovers += 1
+
+    def _hedged(self, primary, secondary, attempt):
+        results = queue.LightQueue()
+
+        def run(url):
+            try:
+                results.put((True, self._timed(url, attempt)))
+            except Exception as e:
+                results.put((False, e))
+
+        with self._lock:
+            latency = self._endpoint(primary).latency or 0
+        eventlet.spawn_n(run, primary)
+        try:
+            ok, value = results.get(
+                timeout=max(self.hedge_delay, HEDGE_FACTOR * latency))
+        except queue.Empty:
+            ok, value = False, None
+        if not ok and (value is None or down(value)):
+            with self._lock:
+                self.hedges += 1
+            eventlet.spawn_n(run, secondary)
+            pending = 2 if value is None else 1
+            while pending:
+                ok, value = results.get()
+                pending -= 1
+                if ok or not down(value):
+                    break
+        if ok:
+            return value
+        raise value
+
+    def stats(self):
+        with self._lock:
+            return dict((url, {'latency': endpoint.latency,
+                               'failures': endpoint.failures,
+                               'open': endpoint.opened_at is not None,
+                               'calls': endpoint.calls,
+                               'errors': endpoint.errors})
+                        for url, endpoint in self._endpoints.items())
+
+
+_balancer = None
+_balancer_lock = threading.Lock()
+
+
+def get_balancer():
+    global _balancer
+    if _balancer is None:
+        with _balancer_lock:
+            if _balancer is None:
+                _balancer = Balancer(
+                    failure_threshold=(
+                        CONF.cloudstack.endpoint_failure_threshold),
+                    probe_interval=CONF.cloudstack.endpoint_probe_interval,
+                    hedge=CONF.cloudstack.endpoint_hedge,
+                    hedge_delay=CONF.cloudstack.endpoint_hedge_delay,
+                    timeout=CONF.cloudstack.http_timeout)
+    return _balancer
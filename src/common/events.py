@@ -0,0 +1,231 @@
+import datetime
+import json
+import logging
+import threading
+import time
+
+import eventlet
+
+from . import backoff
+from .catalog import iter_records
+from .config import CONF
+
+try:
+    import kombu
+except ImportError:
+    kombu = None
+
+__author__ = 'cima'
+
+LOG = logging.getLogger(__name__)
+
+# marks every watched job of an account, for events without a resource id
+ANY = '*'
+
+FINISHED = ('completed', 'succeeded', 'failed')
+
+
+class EventStream(object):
+    """Table of the CloudStack events seen for watched async jobs.
+
+    A job is due for a direct query once an event arrived for the job or
+    the resource it works on since it was last queried, or once no event
+    arrived for overdue seconds.  Subclasses feed the table.
+    """
+
+    def __init__(self, overdue=60, max_entries=10000):
+        self.overdue = overdue
+        self.max_entries = max_entries
+        self.skipped = 0
+        self._arrived = {}
+        self._watched = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _account(cs):
+        return (cs.endpoint, cs.key)
+
+    def refresh(self, cs):
+        """Read new events of the account, if the stream is polled."""
+        pass
+
+    def watch(self, cs, jobid, resource_id=None):
+        with self._lock:
+            self._watched[jobid] = (self._account(cs), resource_id,
+                                    time.time())
+
+    def forget(self, jobid):
+        with self._lock:
+            self._watched.pop(jobid, None)
+
+    def arrive(self, object_id, account=None):
+        """Record an event of a job, a resource or, with ANY, an account."""
+        now = time.time()
+        with self._lock:
+            self._arrived[(account, object_id)] = now
+            if len(self._arrived) > self.max_entries:
+                for key, arrived in list(self._arrived.items()):
+                    if now - arrived >= self.overdue:
+                        del self._arrived[key]
+
+    def due(self, cs, jobid):
+        """Return True if the job should be queried now."""
+        now = time.time()
+        account = self._account(cs)
+        with self._lock:
+            watched = self._watched.get(jobid)
+            if watched is None:
+                # not started by this engine, e.g. before a restart
+                self._watched[jobid] = (account, None, now)
+                return True
+            _account, resource_id, since = watched
+            arrived = max(self._arrived.get(key, 0) for key in (
+                (None, jobid), (None, resource_id), (account, ANY)))
+            if arrived < since and now - since < self.overdue:
+                self.skipped += 1
+                return False
+            self._watched[jobid] = (account, resource_id, now)
+            return True
+
+
+class _Tail(object):
+    def __init__(self):
+        self.created = None
+        self.seen = set()
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+
+class ListEventsStream(EventStream):
+    """Tails listEvents of every account from a high-water mark.
+
+    At most once per interval the events created since the newest event
+    seen so far are listed.  Finished events are matched by their resource
+    id; events without one make every job of the account due.
+    """
+
+    def __init__(self, interval=5, overdue=60):
+        super(ListEventsStream, self).__init__(overdue=overdue)
+        self.interval = interval
+        self.queries = 0
+        self._tails = {}
+        self._tails_lock = threading.Lock()
+
+    def _tail(self, account):
+        with self._tails_lock:
+            tail = self._tails.get(account)
+            if tail is None:
+                tail = self._tails[account] = _Tail()
+            return tail
+
+    def refresh(self, cs):
+        account = self._account(cs)
+        tail = self._tail(account)
+        with tail.lock:
+            now = time.time()
+            if now - tail.fetched_at < self.interval:
+                return
+            tail.fetched_at = now
+            if tail.created is None:
+                # the server's time zone is unknown, start a day early
+                startdate = (datetime.datetime.utcnow() -
+                             datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+            else:
+                startdate = tail.created[:19].replace('T', ' ')
+            self.queries += 1
+            for event in iter_records(cs, 'listEvents', 'event',
+                                      startdate=startdate):
+                if event['id'] in tail.seen:
+                    continue
+                created = event.get('created', '')
+                if tail.created is None or created > tail.created:
+                    tail.created = created
+                    tail.seen = set()
+                if created == tail.created:
+                    tail.seen.add(event['id'])
+                if event.get('state', '').lower() not in FINISHED:
+                    continue
+                if event.get('resourceid'):
+                    self.arrive(event['resourceid'])
+                else:
+                    self.arrive(ANY, account=account)
+
+
+class AmqpEventStream(EventStream):
+    """Consumes the CloudStack event bus in a green thread.
+
+    Async job and action events are matched by job id and entity id.  Any
+    transport kombu supports works, memory:// stands in for a broker.
+    """
+
+    def __init__(self, url, exchange='cloudstack-events', overdue=60):
+        super(AmqpEventStream, self).__init__(overdue=overdue)
+        if kombu is None:
+            raise RuntimeError('kombu is required for the amqp event source')
+        self.url = url
+        self.exchange = exchange
+        self.received = 0
+        self._started = False
+
+    def watch(self, cs, jobid, resource_id=None):
+        if not self._started:
+            self._started = True
+            eventlet.spawn_n(self._consume)
+        super(AmqpEventStream, self).watch(cs, jobid, resource_id)
+
+    def _consume(self):
+        exchange = kombu.Exchange(self.exchange, type='topic', durable=True)
+        queue = kombu.Queue(exchange=exchange, routing_key='#',
+                            exclusive=True, auto_delete=True)
+        attempt = 0
+        while True:
+            try:
+                with kombu.Connection(self.url) as connection:
+                    with connection.Consumer(
+                            queue, callbacks=[self.on_message],
+                            accept=['json', 'text/plain']):
+                        attempt = 0
+                        while True:
+                            connection.drain_events()
+            except Exception as e:
+                # jobs are queried once they are overdue meanwhile
+                LOG.warning('Event bus connection failed: %s', e)
+                attempt += 1
+                time.sleep(backoff.delay(attempt))
+
+    def on_message(self, body, message):
+        self.received += 1
+        if not isinstance(body, dict):
+            try:
+                body = json.loads(body)
+            except ValueError:
+                body = {}
+        status = str(body.get('status', '')).lower()
+        if status in FINISHED:
+            for key in ('jobId', 'entityuuid', 'instanceUuid'):
+                if body.get(key):
+                    self.arrive(body[key])
+        message.ack()
+
+
+_stream = None
+_stream_lock = threading.Lock()
+
+
+def get_stream():
+    """Return the process wide event stream, None if events are off."""
+    global _stream
+    source = CONF.cloudstack.event_source
+    if _stream is None and source:
+        with _stream_lock:
+            if _stream is None:
+                if source == 'amqp':
+                    _stream = AmqpEventStream(
+                        CONF.cloudstack.event_amqp_url,
+                        exchange=CONF.cloudstack.event_amqp_exchange,
+                        overdue=CONF.cloudstack.event_overdue)
+                else:
+                    _stream = ListEventsStream(
+                        interval=CONF.cloudstack.event_poll_interval,
+                        overdue=CONF.cloudstack.event_overdue)
+    return _stream
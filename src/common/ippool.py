@@ -0,0 +1,63 @@
+import threading
+
+from . import standby
+from .config import CONF
+
+__author__ = 'cima'
+
+TAG = 'heat-ip-pool'
+
+
+class AddressPool(standby.StandbyPool):
+    """Public IP addresses kept associated per VPC for reuse.
+
+    Released addresses are kept up to high_watermark free addresses per
+    VPC instead of being disassociated, and claims refill the pool in the
+    background up to low_watermark.  Free addresses are tagged with their
+    VPC.
+    """
+
+    STATE_NAME = 'heat-cloudstack-ippool'
+    TAG = TAG
+    RESOURCE_TYPE = 'PublicIpAddress'
+    KIND = 'pooled address'
+
+    def __init__(self, state_dir=None, low_watermark=0, high_watermark=5,
+                 pending_timeout=600, poll_interval=5):
+        super(AddressPool, self).__init__(state_dir=state_dir,
+                                          pending_timeout=pending_timeout,
+                                          poll_interval=poll_interval)
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+
+    def _create(self, cs, vpcid, _params):
+        return cs.associateIpAddress(vpcid=vpcid)
+
+    def _delete(self, cs, address_id):
+        cs.disassociateIpAddress(id=address_id)
+
+    def release(self, cs, vpcid, address_id):
+        """Keep a released address, False if the pool is full."""
+        return self.keep(cs, vpcid, address_id, self.high_watermark)
+
+    def refill(self, cs, vpcid, size=None, params=None):
+        """Associate addresses in the background up to low_watermark."""
+        return super(AddressPool, self).refill(
+            cs, vpcid, self.low_watermark if size is None else size, params)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = AddressPool(
+                    state_dir=CONF.cloudstack.ip_pool_state_dir,
+                    low_watermark=CONF.cloudstack.ip_pool_low_watermark,
+                    high_watermark=CONF.cloudstack.ip_pool_high_watermark,
+                    poll_interval=CONF.cloudstack.job_poll_interval)
+    return _pool
@@ -0,0 +1,226 @@
+import threading
+import time
+
+from cs import CloudStackException
+
+from . import events
+from . import trace
+from .config import CONF
+
+__author__ = 'cima'
+
+JOB_PENDING = 0
+JOB_SUCCEEDED = 1
+JOB_FAILED = 2
+
+# seconds a listing starts before the oldest job, for the clock of the
+# management server running behind the engine
+CLOCK_SKEW = 300
+
+
+class AsyncJobFailed(CloudStackException):
+    """Raised with the same arguments as CloudStackException.
+
+    The third argument is the job result, so e.args[2]['errorcode'] holds
+    the CloudStack error code just like for synchronous calls.
+    """
+    pass
+
+
+class _Bucket(object):
+    def __init__(self):
+        self.pending = set()
+        # when the jobs were tracked by this process
+        self.started = {}
+        self.results = {}
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+
+class JobTracker(object):
+    """Tracks CloudStack async jobs of all resources of an engine process.
+
+    Jobs sharing an endpoint and API key are refreshed together at most
+    once per interval: a single outstanding job is looked up with
+    queryAsyncJobResult, several with one paginated listAsyncJobs call
+    starting at the oldest of them, as CloudStack lists the jobs of the
+    account oldest first.  Jobs the process did not start, e.g. before an
+    engine restart, are looked up one by one.  With an event stream only
+    jobs it reports as due are looked up.
+    """
+
+    def __init__(self, interval=2, page_size=500, max_pages=4, stream=None):
+        self.interval = interval
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.stream = stream
+        self.queries = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, cs):
+        key = (cs.endpoint, cs.key)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket()
+            return bucket
+
+    def track(self, cs, jobid, resource_id=None):
+        bucket = self._bucket(cs)
+        with bucket.lock:
+            bucket.pending.add(jobid)
+            bucket.started.setdefault(jobid, time.time())
+        if self.stream is not None:
+            self.stream.watch(cs, jobid, resource_id)
+
+    def result(self, cs, jobid):
+        """Return the job result, or None while the job is still running.
+
+        Raises AsyncJobFailed if the job failed.
+        """
+        bucket = self._bucket(cs)
+        with bucket.lock:
+            if jobid not in bucket.results:
+                bucket.pending.add(jobid)
+                now = time.time()
+                if now - bucket.fetched_at >= self.interval:
+                    self._fetch(cs, bucket)
+                    bucket.fetched_at = now
+            job = bucket.results.get(jobid)
+            if job is None:
+                return None
+            # finished jobs are handed out once
+            del bucket.results[jobid]
+        trace.job_finished(jobid, job.get('cmd'))
+
+        if int(job['jobstatus']) == JOB_FAILED:
+            raise AsyncJobFailed(
+                "Async job %s failed" % jobid, job, job.get('jobresult', {}))
+        return job.get('jobresult', {})
+
+    def _fetch(self, cs, bucket):
+        due = set(bucket.pending)
+        if self.stream is not None:
+            self.stream.refresh(cs)
+            due = set(jobid for jobid in due
+                      if self.stream.due(cs, jobid))
+        listed = set(jobid for jobid in due if jobid in bucket.started)
+        seen = set()
+        if len(listed) > 1:
+            seen = self._list(cs, bucket, listed)
+        # jobs missing from the listing are looked up one by one
+        for jobid in due - seen:
+            self.queries += 1
+            job = cs.queryAsyncJobResult(jobid=jobid)
+            job.setdefault('jobid', jobid)
+            self._collect(bucket, job)
+
+    def _list(self, cs, bucket, wanted):
+        oldest = min(bucket.started[jobid] for jobid in wanted)
+        startdate = time.strftime('%Y-%m-%dT%H:%M:%S+0000',
+                                  time.gmtime(oldest - CLOCK_SKEW))
+        seen = set()
+        for page in range(1, self.max_pages + 1):
+            self.queries += 1
+            res = cs.listAsyncJobs(startdate=startdate, page=page,
+                                   pagesize=self.page_size)
+            jobs = res.get('asyncjobs', []) if res else []
+            for job in jobs:
+                if job['jobid'] in wanted:
+                    seen.add(job['jobid'])
+                    self._collect(bucket, job)
+            if seen == wanted or len(jobs) < self.page_size:
+                break
+        return seen
+
+    def _collect(self, bucket, job):
+        if int(job.get('jobstatus', JOB_PENDING)) == JOB_PENDING:
+            return
+        bucket.pending.discard(job['jobid'])
+        bucket.started.pop(job['jobid'], None)
+        bucket.results[job['jobid']] = job
+        if self.stream is not None:
+            self.stream.forget(job['jobid'])
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = JobTracker(
+                    interval=CONF.cloudstack.job_poll_interval,
+                    page_size=CONF.cloudstack.job_poll_page_size,
+                    max_pages=CONF.cloudstack.job_poll_max_pages,
+                    stream=events.get_stream())
+    return _tracker
+
+
+def start(resource, cs, key, response):
+    """Remember the async job of an API response in the resource data."""
+    jobid = response.get('jobid') if response else None
+    if jobid:
+        resource.data_set(key, jobid)
+        get_tracker().track(cs, jobid,
+                            resource.resource_id or response.get('id'))
+        trace.job_started(jobid)
+    return jobid
+
+
+def poll(resource, cs, key):
+    """Return the result of the job stored under key, None while it runs.
+
+    Resources without a stored job are considered complete.
+    """
+    jobid = resource.data().get(key)
+    if jobid is None:
+        return {}
+    result = get_tracker().result(cs, jobid)
+    if result is not None:
+        resource.data_delete(key)
+    return result
+
+
+def start_many(resource, cs, key, responses):
+    """Remember the async jobs of several API responses under one key."""
+    started = [res for res in responses if res and res.get('jobid')]
+    jobids = [res['jobid'] for res in started]
+    if jobids:
+        resource.data_set(key, ','.join(jobids))
+        tracker = get_tracker()
+        for res in started:
+            tracker.track(cs, res['jobid'], res.get('id'))
+            trace.job_started(res['jobid'])
+    return jobids
+
+
+def poll_many(resource, cs, key, failed=None):
+    """Return True once all jobs stored under key are done.
+
+    Finished jobs are dropped from the resource data as they complete.
+    Raises AsyncJobFailed as soon as one of the jobs failed, unless a list
+    is given the failures are collected in instead.
+    """
+    jobids = resource.data().get(key)
+    if not jobids:
+        return True
+    tracker = get_tracker()
+    pending = []
+    for jobid in jobids.split(','):
+        try:
+            if tracker.result(cs, jobid) is None:
+                pending.append(jobid)
+        except AsyncJobFailed as e:
+            if failed is None:
+                raise e
+            failed.append(e)
+    if pending:
+        resource.data_set(key, ','.join(pending))
+        return False
+    resource.data_delete(key)
+    return True
@@ -0,0 +1,298 @@
+import atexit
+import importlib
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import CONF
+
+__author__ = 'cima'
+
+CALLS = 'cloudstack_api_calls_total'
+LATENCY = 'cloudstack_api_latency_seconds'
+SIZE = 'cloudstack_api_response_bytes'
+RETRIES = 'cloudstack_api_retries_total'
+EXHAUSTED = 'cloudstack_api_retries_exhausted_total'
+WASTED = 'cloudstack_api_retry_wasted_seconds'
+RATELIMIT_WAIT = 'cloudstack_ratelimit_wait_seconds'
+
+BUCKETS = {
+    LATENCY: (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    SIZE: (256, 1024, 4096, 16384, 65536, 262144, 1048576),
+    WASTED: (0.1, 0.5, 1, 2.5, 5, 10, 30, 60),
+    RATELIMIT_WAIT: (0, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+}
+
+HELP = {
+    CALLS: 'CloudStack API calls',
+    LATENCY: 'Latency of CloudStack API calls',
+    SIZE: 'Size of CloudStack API responses',
+    RETRIES: 'Retried CloudStack API calls',
+    EXHAUSTED: 'CloudStack API calls failed after retrying',
+    WASTED: 'Seconds lost to failed attempts of retried API calls',
+    RATELIMIT_WAIT: 'Seconds API calls were queued by the rate limiter'
+}
+
+_context = threading.local()
+
+
+@contextmanager
+def operation(name):
+    """Attribute the API calls of the block to the given Heat operation."""
+    previous = getattr(_context, 'operation', None)
+    _context.operation = name
+    try:
+        yield
+    finally:
+        _context.operation = previous
+
+
+def current():
+    """Return the (resource type, operation) the running call belongs to."""
+    return (getattr(_context, 'resource_type', None) or '',
+            getattr(_context, 'resource_operation', None) or '')
+
+
+def _resource_operation(resource):
+    override = getattr(_context, 'operation', None)
+    if override:
+        return override
+    if resource.status == resource.IN_PROGRESS:
+        return resource.action.lower()
+    return 'resolve'
+
+
+class InstrumentedClient(object):
+    """Client proxy attributing its API calls to a resource."""
+
+    def __init__(self, client, resource):
+        self._client = client
+        self._resource = resource
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            previous = current()
+            _context.resource_type = self._resource.type()
+            _context.resource_operation = _resource_operation(self._resource)
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                (_context.resource_type,
+                 _context.resource_operation) = previous
+        return call
+
+
+class Sink(object):
+    """Receives the counters and histogram samples of API calls."""
+
+    def increment(self, name, labels, value=1):
+        raise NotImplementedError()
+
+    def observe(self, name, value, labels):
+        raise NotImplementedError()
+
+
+class PrometheusFileSink(Sink):
+    """Aggregates in memory and rewrites a text exposition file.
+
+    Meant for the node_exporter textfile collector.  The file is named
+    after the process id, so engine workers do not overwrite each other,
+    and is rewritten at most once per flush_interval.
+    """
+
+    def __init__(self, directory, flush_interval=15):
+        self.path = os.path.join(directory,
+                                 'heat-cloudstack-%d.prom' % os.getpid())
+        self.flush_interval = flush_interval
+        self._counters = {}
+        self._histograms = {}
+        self._flushed_at = 0
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def increment(self, name, labels, value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        buckets = BUCKETS[name]
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(buckets), 0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        now = time.time()
+        if now - self._flushed_at >= self.flush_interval:
+            self._flushed_at = now
+            self.flush()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = labels + tuple(extra)
+        return '{%s}' % ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in pairs)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, self._labels(labels), value))
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            for bound, bucket_count in zip(BUCKETS[name], counts):
+                lines.append('%s_bucket%s %d' % (
+                    name, self._labels(labels, [('le', bound)]),
+                    bucket_count))
+            lines.append('%s_bucket%s %d' % (
+                name, self._labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (name, self._labels(labels), total))
+            lines.append('%s_count%s %d' % (name, self._labels(labels),
+                                            count))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+
+class StatsdSink(Sink):
+    """Sends every sample as a fire and forget statsd UDP datagram."""
+
+    NAME_RE = re.compile('[^A-Za-z0-9_]+')
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='heat.cloudstack'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name.replace('cloudstack_api_', 'api.')]
+        parts.extend(self.NAME_RE.sub('_', str(v)) or 'none'
+                     for _k, v in labels)
+        return '.'.join(parts)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except (IOError, OSError):
+            pass
+
+    def increment(self, name, labels, value=1):
+        self._send('%s:%d|c' % (self._name(name, labels), value))
+
+    def observe(self, name, value, labels):
+        if name in (LATENCY, WASTED, RATELIMIT_WAIT):
+            self._send('%s:%.3f|ms' % (self._name(name, labels),
+                                       value * 1000))
+        else:
+            self._send('%s:%d|h' % (self._name(name, labels), value))
+
+
+class Metrics(object):
+    """Records every API call to the configured sinks."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def record(self, command, latency, size, error=None):
+        resource_type, resource_operation = current()
+        labels = (('resource_type', resource_type),
+                  ('operation', resource_operation),
+                  ('command', command))
+        for sink in self.sinks:
+            sink.increment(CALLS, labels + (('error', error or ''),))
+            sink.observe(LATENCY, latency, labels)
+            sink.observe(SIZE, size, labels)
+
+    def _retry_labels(self, command, error_class):
+        resource_type, resource_operation = current()
+        return (('resource_type', resource_type),
+                ('operation', resource_operation),
+                ('command', command),
+                ('error_class', error_class))
+
+    def retried(self, command, error_class, wasted):
+        labels = self._retry_labels(command, error_class)
+        for sink in self.sinks:
+            sink.increment(RETRIES, labels)
+            sink.observe(WASTED, wasted, labels)
+
+    def exhausted(self, command, error_class):
+        labels = self._retry_labels(command, error_class)
+        for sink in self.sinks:
+            sink.increment(EXHAUSTED, labels)
+
+    def waited(self, endpoint, priority, wait):
+        labels = (('endpoint', endpoint), ('priority', priority))
+        for sink in self.sinks:
+            sink.observe(RATELIMIT_WAIT, wait, labels)
+
+
+def load_sink(name):
+    if name == 'prometheus':
+        return PrometheusFileSink(
+            CONF.cloudstack.metrics_prometheus_dir,
+            flush_interval=CONF.cloudstack.metrics_flush_interval)
+    if name == 'statsd':
+        return StatsdSink(host=CONF.cloudstack.metrics_statsd_host,
+                          port=CONF.cloudstack.metrics_statsd_port,
+                          prefix=CONF.cloudstack.metrics_statsd_prefix)
+    # custom sink given as package.module:Class
+    module, _sep, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)()
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return the process wide recorder, None if no sink is configured."""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics([load_sink(name) for name in
+                                    CONF.cloudstack.metrics_sinks])
+    return _metrics if _metrics.sinks else None
+
+
+def instrument(client, resource):
+    """Wrap the client of a resource, a no-op while metrics are off."""
+    if get_metrics() is None:
+        return client
+    return InstrumentedClient(client, resource)
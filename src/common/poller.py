@@ -0,0 +1,102 @@
+import threading
+import time
+
+from .config import CONF
+
+__author__ = 'cima'
+
+# Returned for VMs that were registered after the latest batched query
+PENDING = object()
+
+
+class _Bucket(object):
+    def __init__(self):
+        self.ids = set()
+        self.queried = set()
+        self.records = {}
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+
+class VirtualMachinePoller(object):
+    """Coalesces VM status queries of all resources of an engine process.
+
+    Every resource waiting for a VM registers its id.  At most once per
+    interval a single paginated listVirtualMachines call is issued for all
+    registered ids sharing an endpoint and API key, and each resource reads
+    its own record from the result.
+    """
+
+    def __init__(self, interval=5, page_size=500):
+        self.interval = interval
+        self.page_size = page_size
+        self.queries = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, cs):
+        key = (cs.endpoint, cs.key)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = _Bucket()
+            return bucket
+
+    def watch(self, cs, vm_id):
+        bucket = self._bucket(cs)
+        with bucket.lock:
+            bucket.ids.add(vm_id)
+
+    def forget(self, cs, vm_id):
+        bucket = self._bucket(cs)
+        with bucket.lock:
+            bucket.ids.discard(vm_id)
+            bucket.queried.discard(vm_id)
+            bucket.records.pop(vm_id, None)
+
+    def state(self, cs, vm_id):
+        """Return the VM record, None if it does not exist or PENDING."""
+        bucket = self._bucket(cs)
+        with bucket.lock:
+            bucket.ids.add(vm_id)
+            now = time.time()
+            if now - bucket.fetched_at >= self.interval:
+                self._fetch(cs, bucket)
+                bucket.fetched_at = now
+            if vm_id not in bucket.queried:
+                return PENDING
+            return bucket.records.get(vm_id)
+
+    def _fetch(self, cs, bucket):
+        ids = list(bucket.ids)
+        records = {}
+        page = 1
+        while ids:
+            self.queries += 1
+            res = cs.listVirtualMachines(ids=ids,
+                                         page=page,
+                                         pagesize=self.page_size)
+            vms = res.get('virtualmachine', []) if res else []
+            for vm in vms:
+                records[vm['id']] = vm
+            if len(vms) < self.page_size or \
+                    len(records) >= res.get('count', 0):
+                break
+            page += 1
+        bucket.queried = set(ids)
+        bucket.records = records
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    global _poller
+    if _poller is None:
+        with _poller_lock:
+            if _poller is None:
+                _poller = VirtualMachinePoller(
+                    interval=CONF.cloudstack.vm_poll_interval,
+                    page_size=CONF.cloudstack.vm_poll_page_size)
+    return _poller
@@ -0,0 +1,13 @@
+from eventlet import greenpool
+
+__author__ = 'cima'
+
+
+def map(func, items, size=8):
+    """Call func on every item with at most size concurrent calls.
+
+    Results are returned in the order of items. The first exception raised
+    by a call is re-raised once the calls before it have finished.
+    """
+    pool = greenpool.GreenPool(size)
+    return list(pool.imap(func, items))
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from . import state
+from .config import CONF
+
+__author__ = 'cima'
+
+HIGH = 'high'
+LOW = 'low'
+
+
+def priority(command):
+    """Status queries yield to calls which change something."""
+    if command.startswith(('list', 'query', 'get')):
+        return LOW
+    return HIGH
+
+
+class RateLimiter(object):
+    """Token bucket per API endpoint and key, shared by engine processes.
+
+    The bucket state lives in a small file per (endpoint, key) which is
+    updated under an exclusive flock, so every heat-engine worker on the
+    host draws from the same budget.  Low priority calls may not use the
+    last reserve tokens of the bucket, which are kept for high priority
+    calls.
+    """
+
+    def __init__(self, rate=20, burst=25, reserve=0.2, state_dir=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.reserve = self.burst * reserve
+        self.state_dir = state.directory(state_dir,
+                                         'heat-cloudstack-ratelimit')
+        self.waits = {HIGH: 0, LOW: 0}
+        self.wait_time = {HIGH: 0.0, LOW: 0.0}
+        self._lock = threading.Lock()
+
+    def _take(self, path, floor):
+        """Take a token, return 0 or the seconds to wait for one."""
+        with state.locked(path) as doc:
+            now = time.time()
+            tokens = min(self.burst, doc.get('tokens', self.burst) +
+                         (now - doc.get('updated', now)) * self.rate)
+            wait = 0
+            if tokens - 1 >= floor:
+                tokens -= 1
+            else:
+                wait = (floor + 1 - tokens) / self.rate
+            doc['tokens'] = tokens
+            doc['updated'] = now
+        return wait
+
+    def acquire(self, endpoint, key, command):
+        """Block until the call may be sent, return the queueing delay."""
+        prio = priority(command)
+        floor = self.reserve if prio == LOW else 0
+        path = state.path(self.state_dir, endpoint, key)
+        wait = self._take(path, floor)
+        if not wait:
+            return 0
+        started = time.time()
+        while wait:
+            time.sleep(wait)
+            wait = self._take(path, floor)
+        delay = time.time() - started
+        with self._lock:
+            self.waits[prio] += 1
+            self.wait_time[prio] += delay
+        return delay
+
+    def stats(self):
+        with self._lock:
+            return {'waits': dict(self.waits),
+                    'wait_time': dict(self.wait_time)}
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """Return the process-wide limiter, None if rate limiting is off."""
+    global _limiter
+    if _limiter is None and CONF.cloudstack.rate_limit > 0:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = RateLimiter(
+                    rate=CONF.cloudstack.rate_limit,
+                    burst=CONF.cloudstack.rate_limit_burst,
+                    reserve=CONF.cloudstack.rate_limit_reserve,
+                    state_dir=CONF.cloudstack.rate_limit_state_dir)
+    return _limiter
@@ -0,0 +1,201 @@
+import re
+import threading
+import time
+
+import requests
+from cs import CloudStackException
+
+from . import backoff
+from . import metrics
+from .config import CONF
+
+__author__ = 'cima'
+
+NOT_FOUND = 'not_found'
+IN_USE = 'in_use'
+THROTTLED = 'throttled'
+CONCURRENT = 'concurrent'
+SERVER_ERROR = 'server_error'
+
+CLASSES = (NOT_FOUND, IN_USE, THROTTLED, CONCURRENT, SERVER_ERROR)
+
+# requests CloudStack turned down before acting on them, which are safe to
+# retry whatever the command
+REJECTED = (THROTTLED, CONCURRENT)
+
+# commands which do no harm when CloudStack executes them twice
+IDEMPOTENT = ('list', 'query', 'get', 'update', 'delete', 'destroy',
+              'disassociate', 'revoke', 'remove', 'start', 'stop', 'reboot',
+              'enable', 'disable')
+
+SERVER_ERRORS = (502, 503, 504, 530, 534)
+
+CONCURRENT_RE = re.compile(r'concurrent|in progress|acquire (the )?lock|'
+                           r'being (created|modified|updated|deleted)',
+                           re.IGNORECASE)
+
+
+def error_code(e):
+    """Return the CloudStack error code of an API error, else None."""
+    data = e.args[2] if len(e.args) > 2 else None
+    if isinstance(data, dict) and data.get('errorcode') is not None:
+        code = data['errorcode']
+    else:
+        # responses which are no JSON, e.g. of a proxy in front of CloudStack
+        code = getattr(e.args[1] if len(e.args) > 1 else None,
+                       'status_code', None)
+    try:
+        return int(code)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(e):
+    """Return the class of a CloudStack or transport error, else None."""
+    if isinstance(e, requests.RequestException):
+        return SERVER_ERROR
+    if not isinstance(e, CloudStackException):
+        return None
+    code = error_code(e)
+    if code == 431:
+        return NOT_FOUND
+    if code == 536:
+        return IN_USE
+    if code == 429:
+        return THROTTLED
+    if code in SERVER_ERRORS:
+        data = e.args[2] if len(e.args) > 2 else None
+        text = data.get('errortext', '') if isinstance(data, dict) else ''
+        if CONCURRENT_RE.search(text or ''):
+            return CONCURRENT
+        return SERVER_ERROR
+    return None
+
+
+def not_found(e):
+    return classify(e) == NOT_FOUND
+
+
+def in_use(e):
+    return classify(e) == IN_USE
+
+
+def idempotent(command):
+    return command.startswith(IDEMPOTENT)
+
+
+class Policy(object):
+    """Attempts and exponential backoff of one error class."""
+
+    def __init__(self, attempts=3, base=1, cap=30):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return backoff.delay(attempt, base=self.base, cap=self.cap)
+
+
+class RetryPolicy(object):
+    """Retries API calls which failed for a transient reason.
+
+    Errors are classified, and each class has its own number of attempts
+    and backoff.  Throttled calls and calls turned down for a concurrent
+    operation are retried whatever the command, server errors only for
+    idempotent commands as CloudStack may have acted on the first request.
+    Retries of a call stop at its deadline.  Missing resources and
+    resources in use are left to the caller.
+    """
+
+    def __init__(self, policies, deadline=60):
+        self.policies = policies
+        self.deadline = deadline
+        self._stats = dict((error_class, {'retries': 0, 'wasted': 0.0,
+                                          'exhausted': 0})
+                           for error_class in CLASSES)
+        self._lock = threading.Lock()
+
+    def retryable(self, error_class, command):
+        if error_class in REJECTED:
+            return True
+        return error_class == SERVER_ERROR and idempotent(command)
+
+    def delay(self, error_class, attempt):
+        """Backoff before the given attempt (1..n) of the error class."""
+        return self.policies[error_class].delay(attempt)
+
+    def call(self, command, func, *args, **kwargs):
+        deadline = time.time() + self.deadline
+        attempt = 1
+        while True:
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            except (CloudStackException, requests.RequestException) as e:
+                error_class = classify(e)
+                policy = self.policies.get(error_class)
+                if policy is None or \
+                        not self.retryable(error_class, command):
+                    raise
+                wait = policy.delay(attempt)
+                if attempt >= policy.attempts or \
+                        time.time() + wait >= deadline:
+                    self.exhausted(error_class, command)
+                    raise
+                time.sleep(wait)
+                self.retried(error_class, command, time.time() - started)
+                attempt += 1
+
+    def retried(self, error_class, command, wasted):
+        """Account for a failed attempt which is retried."""
+        with self._lock:
+            self._stats[error_class]['retries'] += 1
+            self._stats[error_class]['wasted'] += wasted
+        recorder = metrics.get_metrics()
+        if recorder is not None:
+            recorder.retried(command, error_class, wasted)
+
+    def exhausted(self, error_class, command):
+        """Account for a call which failed after giving up on retries."""
+        with self._lock:
+            self._stats[error_class]['exhausted'] += 1
+        recorder = metrics.get_metrics()
+        if recorder is not None:
+            recorder.exhausted(command, error_class)
+
+    def stats(self):
+        with self._lock:
+            return dict((error_class, dict(counts))
+                        for error_class, counts in self._stats.items())
+
+
+def _policy(error_class):
+    opts = CONF.cloudstack
+    return Policy(attempts=int(opts.retry_attempts.get(error_class, 1)),
+                  base=float(opts.retry_backoff_base.get(error_class, 1)),
+                  cap=float(opts.retry_backoff_max.get(error_class, 30)))
+
+
+_policy_engine = None
+_policy_lock = threading.Lock()
+
+
+def get_policy():
+    global _policy_engine
+    if _policy_engine is None:
+        with _policy_lock:
+            if _policy_engine is None:
+                policies = dict((error_class, _policy(error_class))
+                                for error_class in REJECTED +
+                                (SERVER_ERROR,))
+                # in use resources are retried by their resources later on
+                policies[IN_USE] = Policy(
+                    base=CONF.cloudstack.sg_delete_backoff_base,
+                    cap=CONF.cloudstack.sg_delete_backoff_max)
+                _policy_engine = RetryPolicy(
+                    policies, deadline=CONF.cloudstack.retry_deadline)
+    return _policy_engine
+
+
+def stats():
+    return get_policy().stats()
@@ -0,0 +1,158 @@
+import functools
+import json
+import os
+import threading
+import time
+
+from . import metrics
+from . import trace
+from .config import CONF
+
+__author__ = 'cima'
+
+
+class _Operation(object):
+    def __init__(self, started, first_poll, interval):
+        self.started = started
+        self.next_poll = first_poll
+        self.interval = interval
+
+
+class PollScheduler(object):
+    """Decides when a check_*_complete call should really hit the API.
+
+    The first poll of an operation is delayed to a fraction of the typical
+    duration learned for its (resource type, operation, zone) profile,
+    later polls back off geometrically up to max_interval.  Durations are
+    kept as an exponentially weighted moving average and optionally
+    persisted to history_file.
+    """
+
+    def __init__(self, min_interval=1, max_interval=30, factor=1.5,
+                 first_fraction=0.8, history_file=None, weight=0.3,
+                 save_interval=60):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.first_fraction = first_fraction
+        self.history_file = history_file
+        self.weight = weight
+        self.save_interval = save_interval
+        self.skipped = 0
+        self._operations = {}
+        self._history = self._load()
+        self._saved_at = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(resource, operation):
+        return (resource.stack.id, resource.name, operation)
+
+    @staticmethod
+    def _profile(resource, operation):
+        zone = None
+        if hasattr(resource, 'ZONE_ID'):
+            zone = resource.properties.get(resource.ZONE_ID)
+        return '|'.join((resource.type(), operation, zone or ''))
+
+    def expected(self, profile):
+        return self._history.get(profile, 0)
+
+    def due(self, resource, operation):
+        key = self._key(resource, operation)
+        now = time.time()
+        with self._lock:
+            op = self._operations.get(key)
+            if op is None:
+                expected = self.expected(self._profile(resource, operation))
+                op = _Operation(now, now + expected * self.first_fraction,
+                                self.min_interval)
+                self._operations[key] = op
+            if now < op.next_poll:
+                self.skipped += 1
+                return False
+            op.next_poll = now + op.interval
+            op.interval = min(op.interval * self.factor, self.max_interval)
+            return True
+
+    def done(self, resource, operation):
+        now = time.time()
+        with self._lock:
+            op = self._operations.pop(self._key(resource, operation), None)
+            if op is None:
+                return
+            profile = self._profile(resource, operation)
+            duration = now - op.started
+            if profile in self._history:
+                duration = (self.weight * duration +
+                            (1 - self.weight) * self._history[profile])
+            self._history[profile] = duration
+            if now - self._saved_at >= self.save_interval:
+                self._save()
+                self._saved_at = now
+
+    def abandon(self, resource, operation):
+        """Forget a failed operation without learning from its duration."""
+        with self._lock:
+            self._operations.pop(self._key(resource, operation), None)
+
+    def _load(self):
+        if not self.history_file or not os.path.exists(self.history_file):
+            return {}
+        try:
+            with open(self.history_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        if not self.history_file:
+            return
+        tmp = self.history_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self._history, f)
+            os.rename(tmp, self.history_file)
+        except (IOError, OSError):
+            pass
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = PollScheduler(
+                    min_interval=CONF.cloudstack.poll_min_interval,
+                    max_interval=CONF.cloudstack.poll_max_interval,
+                    factor=CONF.cloudstack.poll_backoff_factor,
+                    first_fraction=CONF.cloudstack.poll_first_fraction,
+                    history_file=CONF.cloudstack.poll_history_file)
+    return _scheduler
+
+
+def scheduled(operation):
+    """Decorate a check_*_complete method to be polled adaptively."""
+    def decorator(check):
+        @functools.wraps(check)
+        def wrapper(self, *args, **kwargs):
+            sched = get_scheduler()
+            if not sched.due(self, operation):
+                return False
+            try:
+                with metrics.operation('check'), \
+                        trace.span(self, check.__name__, operation):
+                    complete = check(self, *args, **kwargs)
+            except Exception:
+                sched.abandon(self, operation)
+                raise
+            if complete:
+                sched.done(self, operation)
+                trace.finish(self, operation)
+            return complete
+        return wrapper
+    return decorator
@@ -0,0 +1,81 @@
+__author__ = 'cima'
+
+
+def group_rules(rules):
+    """Merge rules which only differ in their CIDR into one API call.
+
+    Returns a list of (direction, params) tuples, params being the
+    arguments of authorizeSecurityGroupIngress / Egress.
+    """
+    groups = {}
+    order = []
+    for rule in rules:
+        direction = rule.get('direction', 'ingress')
+        key = (direction,
+               rule.get('protocol', 'tcp'),
+               rule.get('startport', None),
+               rule.get('endport', None))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        cidr = rule.get('cidr', '0.0.0.0/0')
+        if cidr not in groups[key]:
+            groups[key].append(cidr)
+
+    return [(key[0], {'protocol': key[1],
+                      'startport': key[2],
+                      'endport': key[3],
+                      'cidrlist': ','.join(groups[key])})
+            for key in order]
+
+
+def _port(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def rule_keys(rules):
+    """Normalize rules to a set of (direction, protocol, ports, cidr)."""
+    keys = set()
+    for rule in rules:
+        for cidr in rule.get('cidr', '0.0.0.0/0').split(','):
+            keys.add((rule.get('direction', 'ingress'),
+                      rule.get('protocol', 'tcp').lower(),
+                      _port(rule.get('startport', None)),
+                      _port(rule.get('endport', None)),
+                      cidr.strip()))
+    return keys
+
+
+def existing_rules(sg):
+    """Map the normalized keys of the rules of a group to their ids."""
+    rules = {}
+    for direction in ('ingress', 'egress'):
+        for rule in sg.get('%srule' % direction, []):
+            key = (direction,
+                   rule.get('protocol', '').lower(),
+                   _port(rule.get('startport')),
+                   _port(rule.get('endport')),
+                   rule.get('cidr'))
+            rules[key] = rule['ruleid']
+    return rules
+
+
+def diff(sg, rules):
+    """Rules to authorize and to revoke to turn a group into the given rules.
+
+    Returns grouped (direction, params) rules to authorize and the
+    (direction, ruleid) rules to revoke.
+    """
+    existing = existing_rules(sg)
+    wanted = rule_keys(rules)
+    revoke = [(key[0], ruleid) for key, ruleid in existing.items()
+              if key not in wanted]
+    authorize = group_rules(
+        {'direction': key[0],
+         'protocol': key[1],
+         'startport': key[2],
+         'endport': key[3],
+         'cidr': key[4]} for key in sorted(wanted - set(existing), key=str))
+    return authorize, revoke
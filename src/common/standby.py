@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import eventlet
+import requests
+from cs import CloudStackException
+
+from . import jobs
+from . import retry
+from . import state
+
+__author__ = 'cima'
+
+LOG = logging.getLogger(__name__)
+
+
+class StandbyPool(object):
+    """CloudStack resources created ahead of time and kept for reuse.
+
+    The ready and pending resources of every pool live in a state file per
+    endpoint and API key which is only changed under an exclusive flock,
+    so every heat-engine worker of the host claims from and refills the
+    same pools.  Ready resources are tagged in CloudStack with their pool;
+    the tag is informational, the state file is authoritative.  A pending
+    entry is either a place reserved for a resource or a resource being
+    created, with its job.  Entries older than pending_timeout are given
+    up and their resources deleted, so none is ever forgotten.
+
+    Subclasses create and delete the resources of a pool.
+    """
+
+    # name of the default state directory below the system temp dir
+    STATE_NAME = None
+    # tag key and resource type of the tagged resources
+    TAG = None
+    RESOURCE_TYPE = None
+    # what a resource is called in log messages
+    KIND = None
+
+    def __init__(self, state_dir=None, pending_timeout=1800,
+                 poll_interval=5):
+        self.state_dir = state.directory(state_dir, self.STATE_NAME)
+        self.pending_timeout = pending_timeout
+        self.poll_interval = poll_interval
+        self.claims = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _create(self, cs, pool, params):
+        """Start creating a resource, return the API response."""
+        raise NotImplementedError()
+
+    def _delete(self, cs, resource_id):
+        raise NotImplementedError()
+
+    def _locked(self, cs):
+        return state.locked(state.path(self.state_dir, cs.endpoint, cs.key))
+
+    def _entry(self, doc, pool, expired):
+        entry = doc.setdefault(pool, {'size': 0, 'ready': [], 'pending': {}})
+        # pending resources with the job creating them, if any
+        resources = entry.setdefault('resources', {})
+        now = time.time()
+        for key, started in list(entry['pending'].items()):
+            if now - started >= self.pending_timeout:
+                del entry['pending'][key]
+                if key in resources:
+                    expired.append(key)
+                    del resources[key]
+        return entry
+
+    @contextmanager
+    def _locked_entry(self, cs, pool):
+        expired = []
+        with self._locked(cs) as doc:
+            yield self._entry(doc, pool, expired)
+        if expired:
+            eventlet.spawn_n(self._destroy, cs, expired)
+
+    def _destroy(self, cs, resource_ids):
+        for resource_id in resource_ids:
+            try:
+                self._delete(cs, resource_id)
+            except (CloudStackException, requests.RequestException) as e:
+                if not retry.not_found(e):
+                    LOG.warning('Deleting %s %s failed: %s', self.KIND,
+                                resource_id, e)
+
+    def _tag(self, cs, pool, resource_id):
+        try:
+            cs.createTags(resourceids=resource_id,
+                          resourcetype=self.RESOURCE_TYPE,
+                          tags=[{'key': self.TAG, 'value': pool}])
+        except (CloudStackException, requests.RequestException) as e:
+            LOG.warning('Tagging %s %s failed: %s', self.KIND, resource_id, e)
+
+    def available(self, cs, pool):
+        """Number of ready resources of the pool."""
+        with self._locked_entry(cs, pool) as entry:
+            return len(entry['ready'])
+
+    def claim(self, cs, pool):
+        """Take a ready resource out of the pool, None if it is empty."""
+        with self._locked_entry(cs, pool) as entry:
+            resource_id = entry['ready'].pop(0) if entry['ready'] else None
+        with self._lock:
+            if resource_id is None:
+                self.misses += 1
+            else:
+                self.claims += 1
+        if resource_id is None:
+            return None
+        # out of the state file the resource belongs to the caller, a
+        # stale tag must not leak it
+        try:
+            cs.deleteTags(resourceids=resource_id,
+                          resourcetype=self.RESOURCE_TYPE,
+                          tags=[{'key': self.TAG}])
+        except (CloudStackException, requests.RequestException) as e:
+            if retry.not_found(e):
+                # deleted meanwhile, nothing to hand over
+                raise
+            LOG.warning('Untagging %s %s failed: %s', self.KIND,
+                        resource_id, e)
+        return resource_id
+
+    def give_back(self, cs, pool, resource_id, size):
+        """Reserve a place for a resource made ready later on."""
+        with self._locked_entry(cs, pool) as entry:
+            entry['size'] = size
+            if len(entry['ready']) + len(entry['pending']) >= size:
+                return False
+            entry['pending'][resource_id] = time.time()
+            entry['resources'][resource_id] = None
+            return True
+
+    def keep(self, cs, pool, resource_id, size):
+        """Make a resource ready at once, False if the pool is full."""
+        with self._locked_entry(cs, pool) as entry:
+            if len(entry['ready']) >= size:
+                return False
+            entry['ready'].append(resource_id)
+        self._tag(cs, pool, resource_id)
+        return True
+
+    def ready(self, cs, pool, resource_id):
+        """Make the resource of a pending entry available for claims.
+
+        Returns False if the entry was given up meanwhile, its resource is
+        being deleted then.
+        """
+        with self._locked_entry(cs, pool) as entry:
+            pending = entry['pending'].pop(resource_id, None) is not None
+            entry['resources'].pop(resource_id, None)
+            if pending:
+                entry['ready'].append(resource_id)
+        if not pending:
+            return False
+        self._tag(cs, pool, resource_id)
+        return True
+
+    def discard(self, cs, pool, resource_id):
+        """Drop a pending entry, its resource is left to the caller."""
+        with self._locked_entry(cs, pool) as entry:
+            entry['pending'].pop(resource_id, None)
+            entry['resources'].pop(resource_id, None)
+
+    def _reserve(self, cs, pool, size):
+        with self._locked_entry(cs, pool) as entry:
+            entry['size'] = size
+            missing = size - len(entry['ready']) - len(entry['pending'])
+            tokens = [str(uuid.uuid4()) for _i in range(max(0, missing))]
+            for token in tokens:
+                entry['pending'][token] = time.time()
+        return tokens
+
+    def _replace(self, cs, pool, token, resource_id=None, jobid=None):
+        with self._locked_entry(cs, pool) as entry:
+            started = entry['pending'].pop(token, time.time())
+            if resource_id is not None:
+                entry['pending'][resource_id] = started
+                entry['resources'][resource_id] = jobid
+
+    def refill(self, cs, pool, size, params=None):
+        """Create the missing resources of the pool in the background."""
+        tokens = self._reserve(cs, pool, size)
+        if tokens:
+            eventlet.spawn_n(self._fill, cs, pool, tokens, params)
+        return len(tokens)
+
+    def _fill(self, cs, pool, tokens, params):
+        tracker = jobs.get_tracker()
+        creating = {}
+        for token in tokens:
+            try:
+                res = self._create(cs, pool, params)
+            except (CloudStackException, requests.RequestException) as e:
+                LOG.warning('Creating a %s failed: %s', self.KIND, e)
+                self._replace(cs, pool, token)
+                continue
+            self._replace(cs, pool, token, res['id'], res['jobid'])
+            tracker.track(cs, res['jobid'], res['id'])
+            creating[res['jobid']] = res['id']
+
+        deadline = time.time() + self.pending_timeout
+        while creating:
+            time.sleep(self.poll_interval)
+            for jobid, resource_id in list(creating.items()):
+                try:
+                    result = tracker.result(cs, jobid)
+                except jobs.AsyncJobFailed as e:
+                    LOG.warning('Creating %s %s failed: %s', self.KIND,
+                                resource_id, e)
+                    self._drop(cs, pool, resource_id)
+                    del creating[jobid]
+                    continue
+                except (CloudStackException, requests.RequestException) as e:
+                    # the job is kept, its resource is adopted by a later
+                    # round
+                    LOG.warning('Creating %s %s unknown: %s', self.KIND,
+                                resource_id, e)
+                    result = None
+                if result is not None:
+                    self.ready(cs, pool, resource_id)
+                elif time.time() >= deadline:
+                    LOG.warning('Creating %s %s timed out', self.KIND,
+                                resource_id)
+                    self._drop(cs, pool, resource_id)
+                else:
+                    continue
+                del creating[jobid]
+
+    def _drop(self, cs, pool, resource_id):
+        self.discard(cs, pool, resource_id)
+        self._destroy(cs, [resource_id])
@@ -0,0 +1,49 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+__author__ = 'cima'
+
+
+def directory(configured, name):
+    """Return the state directory, creating it if needed."""
+    path = configured or os.path.join(tempfile.gettempdir(), name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+    return path
+
+
+def path(state_dir, endpoint, key):
+    """File of the state of one endpoint and API key."""
+    name = hashlib.sha1(
+        ('%s|%s' % (endpoint, key)).encode('utf-8')).hexdigest()
+    return os.path.join(state_dir, name + '.json')
+
+
+@contextmanager
+def locked(state_file):
+    """Read, modify and write back a JSON document under an exclusive flock.
+
+    The lock is shared by every engine worker of the host.  The block must
+    not issue API calls or otherwise yield to other green threads.
+    """
+    with open(state_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                doc = json.loads(f.read() or '{}')
+            except ValueError:
+                doc = {}
+            yield doc
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(doc))
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,279 @@
+import bisect
+import threading
+import weakref
+
+__author__ = 'cima'
+
+VPC = 'Cloudstack::Network::VPC'
+NETWORK = 'Cloudstack::Network::Network'
+VM = 'Cloudstack::Compute::VirtualMachine'
+
+
+def parse_address(text):
+    """Return a dotted quad IPv4 address as an integer."""
+    parts = text.strip().split('.')
+    if len(parts) != 4 or not all(part.isdigit() and int(part) < 256
+                                  for part in parts):
+        raise ValueError('%s is no IPv4 address' % text)
+    value = 0
+    for part in parts:
+        value = value << 8 | int(part)
+    return value
+
+
+def format_address(value):
+    return '.'.join(str(value >> shift & 255) for shift in (24, 16, 8, 0))
+
+
+def parse_netmask(text):
+    """Return the prefix length of a dotted quad netmask."""
+    mask = parse_address(text)
+    prefix = bin(mask).count('1')
+    if mask != (0xffffffff << (32 - prefix)) & 0xffffffff:
+        raise ValueError('%s is no contiguous netmask' % text)
+    return prefix
+
+
+def span(address, prefix):
+    """Return the first and last address of the subnet of an address."""
+    size = 1 << (32 - prefix)
+    first = address & ~(size - 1) & 0xffffffff
+    return first, first + size - 1
+
+
+def parse_cidr(text):
+    """Return the first and last address of a CIDR block.
+
+    Host bits are masked, 10.0.1.5/24 is the block 10.0.1.0/24.
+    """
+    address, sep, prefix = text.strip().partition('/')
+    if not sep or not prefix.isdigit() or int(prefix) > 32:
+        raise ValueError('%s is no IPv4 CIDR' % text)
+    return span(parse_address(address), int(prefix))
+
+
+def format_span(first, last):
+    prefix = 32 - (last - first + 1).bit_length() + 1
+    return '%s/%d' % (format_address(first), prefix)
+
+
+class IntervalIndex(object):
+    """Non-overlapping address ranges sorted by their first address.
+
+    Adding and looking up a range takes a binary search, so checking the
+    tiers of a VPC stays fast for hundreds of tiers.
+    """
+
+    def __init__(self):
+        self._firsts = []
+        self._ranges = []
+
+    def overlapping(self, first, last):
+        """Return the label of a range overlapping the given one, or None."""
+        i = bisect.bisect_right(self._firsts, first)
+        if i > 0 and self._ranges[i - 1][1] >= first:
+            return self._ranges[i - 1][2]
+        if i < len(self._ranges) and self._ranges[i][0] <= last:
+            return self._ranges[i][2]
+        return None
+
+    def add(self, first, last, label):
+        """Add a range, return the label of an overlapping one instead."""
+        other = self.overlapping(first, last)
+        if other is not None:
+            return other
+        i = bisect.bisect_right(self._firsts, first)
+        self._firsts.insert(i, first)
+        self._ranges.insert(i, (first, last, label))
+        return None
+
+    def find(self, address):
+        """Return the label of the range containing the address, or None."""
+        return self.overlapping(address, address)
+
+
+def _get(res, name):
+    try:
+        value = res.properties.get(name)
+    except Exception:
+        # left to Heat's own validation of the resource
+        return None
+    return value if isinstance(value, (str, type(u''), list)) else None
+
+
+def _refs(res):
+    """Names other resources may refer to the resource by."""
+    refs = [res.name]
+    if res.resource_id is not None:
+        refs.append(res.resource_id)
+    return refs
+
+
+def _target(snippet):
+    """Name of the resource a get_resource or get_attr function refers to."""
+    fn_name = getattr(snippet, 'fn_name', None)
+    args = getattr(snippet, 'args', None)
+    if fn_name in ('get_attr', 'Fn::GetAtt') and isinstance(args, list) \
+            and args:
+        args = args[0]
+    elif fn_name not in ('get_resource', 'Ref'):
+        return None
+    return args if isinstance(args, (str, type(u''))) else None
+
+
+def _requires(res):
+    try:
+        return list(res.stack.dependencies[res].requires())
+    except Exception:
+        # e.g. a dependency loop, left to Heat's own validation
+        return []
+
+
+def _link(res, name, kind, index=None):
+    """Return what a reference property of the resource points to.
+
+    get_attr references of resources not created yet resolve to None, so
+    references are taken from the template instead: the function of the
+    property, else the only resource of the given type the resource
+    depends on.  Resources of the stack are referred to by name, literal
+    ids are returned as they are.
+    """
+    value = _get(res, name)
+    try:
+        snippet = res.properties.data.get(name)
+    except Exception:
+        snippet = None
+    if index is not None:
+        value = value[index] if value and len(value) > index else None
+        snippet = snippet[index] if isinstance(snippet, list) and \
+            len(snippet) > index else None
+    target = _target(snippet)
+    if target is not None and target in res.stack.resources:
+        return target
+    if value is None and snippet is not None:
+        found = [dep.name for dep in _requires(res) if dep.type() == kind]
+        if len(found) == 1:
+            return found[0]
+    return value if isinstance(value, (str, type(u''))) else None
+
+
+def _host(address, first, last):
+    """Return why the address cannot be a host of the subnet, or None."""
+    if not first <= address <= last:
+        return 'is outside %s' % format_span(first, last)
+    if last - first > 1 and address in (first, last):
+        return 'is the network or broadcast address of %s' % format_span(
+            first, last)
+    return None
+
+
+def check(stack):
+    """Return the topology problems of the stack by resource name.
+
+    Every VPC CIDR, tier gateway and netmask and VM ipaddress is parsed,
+    tiers must lie inside the CIDR of their VPC if it is part of the stack
+    and must not overlap other tiers of the same VPC, and VM addresses must
+    be host addresses of the tier of their default network.
+    """
+    problems = {}
+    resources = sorted(stack.resources.values(), key=lambda res: res.name)
+
+    def problem(res, message):
+        problems.setdefault(res.name, []).append(message)
+
+    vpcs = {}
+    for res in resources:
+        if res.type() != VPC or _get(res, 'cidr') is None:
+            continue
+        try:
+            cidr = parse_cidr(_get(res, 'cidr'))
+        except ValueError as e:
+            problem(res, str(e))
+            continue
+        for ref in _refs(res):
+            vpcs[ref] = cidr
+
+    indexes = {}
+    tiers = {}
+    for res in resources:
+        if res.type() != NETWORK:
+            continue
+        gateway = _get(res, 'gateway')
+        netmask = _get(res, 'netmask')
+        vpc_id = _link(res, 'vpc_id', VPC)
+        if gateway is None or netmask is None:
+            continue
+        try:
+            address = parse_address(gateway)
+            first, last = span(address, parse_netmask(netmask))
+        except ValueError as e:
+            problem(res, str(e))
+            continue
+        reason = _host(address, first, last)
+        if reason:
+            problem(res, 'gateway %s %s' % (gateway, reason))
+        if vpc_id in vpcs:
+            vpc_first, vpc_last = vpcs[vpc_id]
+            if first < vpc_first or last > vpc_last:
+                problem(res, '%s is outside the VPC CIDR %s' % (
+                    format_span(first, last),
+                    format_span(vpc_first, vpc_last)))
+        if vpc_id is not None:
+            index = indexes.setdefault(vpc_id, IntervalIndex())
+            other = index.add(first, last, res.name)
+            if other is not None:
+                problem(res, '%s overlaps tier %s' % (
+                    format_span(first, last), other))
+        for ref in _refs(res):
+            tiers[ref] = (first, last, vpc_id, res.name)
+
+    addresses = {}
+    for res in resources:
+        if res.type() != VM:
+            continue
+        ipaddress = _get(res, 'ipaddress')
+        network_id = _link(res, 'network_ids', NETWORK, index=0)
+        if ipaddress is None or network_id not in tiers:
+            continue
+        try:
+            address = parse_address(ipaddress)
+        except ValueError as e:
+            problem(res, str(e))
+            continue
+        first, last, vpc_id, tier = tiers[network_id]
+        reason = _host(address, first, last)
+        if reason:
+            other = vpc_id is not None and indexes[vpc_id].find(address)
+            if other and other != tier:
+                reason += ', it belongs to tier %s' % other
+            problem(res, 'ipaddress %s %s' % (ipaddress, reason))
+            continue
+        key = (vpc_id or network_id, address)
+        if key in addresses:
+            problem(res, 'ipaddress %s is taken by %s' % (ipaddress,
+                                                          addresses[key]))
+        addresses.setdefault(key, res.name)
+    return problems
+
+
+_checked = {}
+_checked_lock = threading.Lock()
+
+
+def problems(res):
+    """Return the topology problems of a resource of a stack.
+
+    The stack is checked once per stack and template, the first resource
+    validated pays for every other one.
+    """
+    stack = res.stack
+    key = (id(stack), id(stack.t))
+    with _checked_lock:
+        ref, found = _checked.get(key, (None, None))
+        if ref is None or ref() is not stack:
+            found = check(stack)
+            for dead in [k for k, (r, _f) in _checked.items()
+                         if r() is None]:
+                del _checked[dead]
+            _checked[key] = (weakref.ref(stack), found)
+    return found.get(res.name, [])
@@ -0,0 +1,268 @@
+import atexit
+import functools
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .config import CONF
+
+__author__ = 'cima'
+
+_context = threading.local()
+
+
+def _now():
+    return int(time.time() * 1000000)
+
+
+def _id(text):
+    # stable across engine workers so their traces can be merged
+    return zlib.crc32(text.encode('utf-8')) & 0x7fffffff
+
+
+class _Trace(object):
+    def __init__(self, stack_name, stack_id, action):
+        self.stack_name = stack_name
+        self.stack_id = stack_id
+        self.action = action
+        self.pid = _id(stack_id)
+        self.events = [{'ph': 'M', 'name': 'process_name', 'pid': self.pid,
+                        'args': {'name': '%s %s' % (stack_name, action)}}]
+        self.threads = set()
+        self.operations = {}
+        self.written_at = 0
+
+    def thread(self, name):
+        tid = _id(name)
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append({'ph': 'M', 'name': 'thread_name',
+                                'pid': self.pid, 'tid': tid,
+                                'args': {'name': name}})
+        return tid
+
+
+class Tracer(object):
+    """Records spans of resource operations as Chrome trace events.
+
+    Every handle and check call, every API request made beneath it and
+    every async job is recorded on the track of its resource.  Events are
+    kept per stack operation and written to directory as a Chrome trace /
+    Perfetto JSON file whenever the last running resource operation of the
+    stack completed, or at most once per flush_interval in between.  Each
+    engine worker writes its own file.
+    """
+
+    def __init__(self, directory, flush_interval=30, max_traces=32,
+                 max_jobs=10000):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_traces = max_traces
+        self.max_jobs = max_jobs
+        self._traces = OrderedDict()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def _trace(self, resource):
+        stack = resource.stack
+        key = (stack.id, stack.action)
+        trace = self._traces.pop(key, None)
+        if trace is None:
+            trace = _Trace(stack.name, stack.id, stack.action)
+        self._traces[key] = trace
+        while len(self._traces) > self.max_traces:
+            self._write(self._traces.popitem(last=False)[1])
+        return trace
+
+    @staticmethod
+    def _dependencies(resource):
+        deps = resource.stack.dependencies
+        try:
+            if resource.stack.action == resource.stack.DELETE:
+                # dependents are deleted first
+                return [r.name for r in deps.required_by(resource)]
+            return [r.name for r in deps.requires(resource)]
+        except KeyError:
+            return []
+
+    @contextmanager
+    def span(self, resource, name, operation):
+        """Record a handle or check call of a resource operation."""
+        with self._lock:
+            trace = self._trace(resource)
+            tid = trace.thread(resource.name)
+            if operation not in trace.operations.setdefault(
+                    resource.name, {}):
+                trace.operations[resource.name][operation] = _now()
+        previous = getattr(_context, 'span', None)
+        _context.span = (trace, tid)
+        started = _now()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            _context.span = previous
+            with self._lock:
+                trace.events.append({'ph': 'X', 'cat': 'call', 'name': name,
+                                     'pid': trace.pid, 'tid': tid,
+                                     'ts': started, 'dur': _now() - started})
+            if error is not None:
+                # a failed call ends the operation
+                self.finish(resource, operation, error=error)
+
+    def finish(self, resource, operation, error=None):
+        """Record the end of a resource operation."""
+        with self._lock:
+            trace = self._trace(resource)
+            started = trace.operations.get(resource.name, {}).pop(
+                operation, None)
+            if started is None:
+                return
+            if not trace.operations[resource.name]:
+                del trace.operations[resource.name]
+            trace.events.append({
+                'ph': 'X', 'cat': 'operation', 'name': operation,
+                'pid': trace.pid, 'tid': trace.thread(resource.name),
+                'ts': started, 'dur': _now() - started,
+                'args': {'resource': resource.name,
+                         'type': resource.type(),
+                         'requires': self._dependencies(resource),
+                         'error': error and str(error)}})
+            if not trace.operations or \
+                    time.time() - trace.written_at >= self.flush_interval:
+                self._write(trace)
+
+    def api_call(self, command, started, ended, error=None):
+        span = getattr(_context, 'span', None)
+        if span is None:
+            return
+        trace, tid = span
+        event = {'ph': 'X', 'cat': 'api', 'name': command, 'pid': trace.pid,
+                 'tid': tid, 'ts': int(started * 1000000),
+                 'dur': int((ended - started) * 1000000)}
+        if error:
+            event['args'] = {'error': error}
+        with self._lock:
+            trace.events.append(event)
+
+    def job_started(self, jobid):
+        span = getattr(_context, 'span', None)
+        if span is None:
+            return
+        with self._lock:
+            self._jobs[jobid] = (span, _now())
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+    def job_finished(self, jobid, command=None):
+        with self._lock:
+            started = self._jobs.pop(jobid, None)
+            if started is None:
+                return
+            (trace, tid), ts = started
+            name = (command or 'job').split('.')[-1]
+            # jobs overlap the calls of their resource, so they are async
+            # events on a track of their own
+            for ph, when in (('b', ts), ('e', _now())):
+                trace.events.append({'ph': ph, 'cat': 'job', 'name': name,
+                                     'id': jobid, 'pid': trace.pid,
+                                     'tid': tid, 'ts': when})
+
+    def path(self, trace):
+        name = re.sub('[^A-Za-z0-9_.-]+', '_', trace.stack_name)
+        return os.path.join(self.directory, '%s-%s-%s-%d.json' % (
+            name, trace.stack_id[:8], trace.action.lower(), os.getpid()))
+
+    def _write(self, trace):
+        trace.written_at = time.time()
+        path = self.path(trace)
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'traceEvents': trace.events,
+                           'displayTimeUnit': 'ms',
+                           'metadata': {'stack_id': trace.stack_id,
+                                        'stack_name': trace.stack_name,
+                                        'action': trace.action}}, f)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def flush(self):
+        with self._lock:
+            for trace in self._traces.values():
+                self._write(trace)
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """Return the process wide tracer, None if tracing is off."""
+    global _tracer
+    if not CONF.cloudstack.trace_dir:
+        return None
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                if not os.path.isdir(CONF.cloudstack.trace_dir):
+                    try:
+                        os.makedirs(CONF.cloudstack.trace_dir)
+                    except OSError:
+                        pass
+                _tracer = Tracer(
+                    CONF.cloudstack.trace_dir,
+                    flush_interval=CONF.cloudstack.trace_flush_interval)
+    return _tracer
+
+
+@contextmanager
+def span(resource, name, operation):
+    tracer = get_tracer()
+    if tracer is None:
+        yield
+        return
+    with tracer.span(resource, name, operation):
+        yield
+
+
+def finish(resource, operation):
+    tracer = get_tracer()
+    if tracer is not None:
+        tracer.finish(resource, operation)
+
+
+def api_call(command, started, ended, error=None):
+    if _tracer is not None:
+        _tracer.api_call(command, started, ended, error=error)
+
+
+def job_started(jobid):
+    if _tracer is not None:
+        _tracer.job_started(jobid)
+
+
+def job_finished(jobid, command=None):
+    if _tracer is not None:
+        _tracer.job_finished(jobid, command=command)
+
+
+def traced(operation):
+    """Decorate a handle_* method to be recorded as a span."""
+    def decorator(handle):
+        @functools.wraps(handle)
+        def wrapper(self, *args, **kwargs):
+            with span(self, handle.__name__, operation):
+                return handle(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,208 @@
+import gzip
+import hashlib
+import io
+import threading
+import time
+from base64 import b64encode
+
+from cs import CloudStackException
+
+from . import retry
+from .catalog import iter_records
+from .config import CONF
+
+__author__ = 'cima'
+
+PREFIX = 'heat-'
+
+# formats cloud-init recognizes after transparently gunzipping user data
+CLOUD_INIT_MARKERS = (b'#cloud-config', b'#!', b'#include', b'#upstart-job',
+                      b'#cloud-boothook', b'#part-handler', b'## template:',
+                      b'Content-Type: multipart/')
+
+# raised by CloudStack releases without registered user data (< 4.18)
+UNSUPPORTED_ERRORS = (401, 432)
+
+
+def _bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+def compressible(data):
+    return data.lstrip().startswith(CLOUD_INIT_MARKERS)
+
+
+def encode(data, compress=False):
+    """Base64 encode user data, gzipped if asked to.
+
+    The gzip header carries no timestamp, so equal payloads encode equally
+    and dedupe by content hash.
+    """
+    data = _bytes(data)
+    if compress:
+        buf = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buf,
+                           mtime=0) as f:
+            f.write(data)
+        data = buf.getvalue()
+    return b64encode(data).decode('ascii')
+
+
+class _Account(object):
+    def __init__(self):
+        self.ids = {}
+        self.used = {}
+        self.supported = True
+        self.candidates = set()
+        self.collected_at = time.time()
+        self.lock = threading.Lock()
+
+
+class UserDataRegistry(object):
+    """Registers every distinct user data payload once per account.
+
+    Payloads are registered with registerUserData under a name derived from
+    their SHA-256, so every engine worker and every later deploy finds the
+    same blob and passes its userdataid instead of the payload.  Blobs no
+    VM refers to on two consecutive collections, gc_interval apart, are
+    deleted.
+    """
+
+    def __init__(self, register=True, min_size=1024, compress=True,
+                 compress_min_size=1024, gc_interval=3600):
+        self.register = register
+        self.min_size = min_size
+        self.compress = compress
+        self.compress_min_size = compress_min_size
+        self.gc_interval = gc_interval
+        self.registrations = 0
+        self.collected = 0
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def _account(self, cs):
+        key = (cs.endpoint, cs.key)
+        with self._lock:
+            account = self._accounts.get(key)
+            if account is None:
+                account = self._accounts[key] = _Account()
+            return account
+
+    def params(self, cs, data):
+        """Return the deploy parameters passing the given user data."""
+        data = _bytes(data)
+        compress = (self.compress and len(data) >= self.compress_min_size and
+                    compressible(data))
+        encoded = encode(data, compress=compress)
+        account = self._account(cs)
+        if not self.register or len(data) < self.min_size or \
+                not account.supported:
+            return {'userdata': encoded}
+
+        name = PREFIX + hashlib.sha256(encoded.encode('ascii')).hexdigest()
+        with account.lock:
+            userdata_id = account.ids.get(name)
+            if userdata_id is None:
+                try:
+                    userdata_id = self._register(cs, name, encoded)
+                except CloudStackException as e:
+                    if retry.error_code(e) not in UNSUPPORTED_ERRORS:
+                        raise e
+                    account.supported = False
+                    return {'userdata': encoded}
+                account.ids[name] = userdata_id
+            account.used[userdata_id] = time.time()
+        return {'userdataid': userdata_id}
+
+    def forget(self, cs, userdata_id):
+        """Drop a blob which turned out to be deleted."""
+        account = self._account(cs)
+        with account.lock:
+            for name, known_id in list(account.ids.items()):
+                if known_id == userdata_id:
+                    del account.ids[name]
+            account.used.pop(userdata_id, None)
+
+    def _register(self, cs, name, encoded):
+        res = cs.listUserData(name=name)
+        if res and res.get('userdata'):
+            return res['userdata'][0]['id']
+        self.registrations += 1
+        try:
+            res = cs.registerUserData(name=name, userdata=encoded)
+        except CloudStackException as e:
+            # another engine worker may have registered it meanwhile
+            res = cs.listUserData(name=name)
+            if res and res.get('userdata'):
+                return res['userdata'][0]['id']
+            raise e
+        return res.get('userdata', res)['id']
+
+    def collect(self, cs, force=False):
+        """Delete blobs no VM refers to, at most once per gc_interval."""
+        account = self._account(cs)
+        now = time.time()
+        with account.lock:
+            if not self.register or not account.supported or (
+                    not force and now - account.collected_at <
+                    self.gc_interval):
+                return []
+            account.collected_at = now
+
+        blobs = set(record['id'] for record in
+                    iter_records(cs, 'listUserData', 'userdata')
+                    if record.get('name', '').startswith(PREFIX))
+        referenced = set(vm.get('userdataid') for vm in
+                         iter_records(cs, 'listVirtualMachines',
+                                      'virtualmachine'))
+        with account.lock:
+            recent = set(userdata_id for userdata_id, used in
+                         account.used.items()
+                         if now - used < self.gc_interval)
+            unreferenced = blobs - referenced - recent
+            # only blobs unreferenced on the previous collection as well,
+            # deploys in flight may not show up in the listing yet
+            garbage = unreferenced & account.candidates
+            account.candidates = unreferenced - garbage
+        for userdata_id in garbage:
+            try:
+                cs.deleteUserData(id=userdata_id)
+            except CloudStackException as e:
+                if not retry.not_found(e):
+                    raise e
+            self.forget(cs, userdata_id)
+            self.collected += 1
+        return list(garbage)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = UserDataRegistry(
+                    register=CONF.cloudstack.userdata_register,
+                    min_size=CONF.cloudstack.userdata_register_min_size,
+                    compress=CONF.cloudstack.userdata_compress,
+                    compress_min_size=(
+                        CONF.cloudstack.userdata_compress_min_size),
+                    gc_interval=CONF.cloudstack.userdata_gc_interval)
+    return _registry
+
+
+def params(cs, data):
+    return get_registry().params(cs, data)
+
+
+def forget(cs, userdata_id):
+    get_registry().forget(cs, userdata_id)
+
+
+def collect(cs):
+    return get_registry().collect(cs)
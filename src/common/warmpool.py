@@ -0,0 +1,60 @@
+import hashlib
+import json
+import threading
+
+from . import standby
+from .config import CONF
+
+__author__ = 'cima'
+
+TAG = 'heat-warm-pool'
+
+# deploy parameters which cannot be changed once a VM exists
+SIGNATURE_PARAMS = ('zoneid', 'templateid', 'serviceofferingid', 'networkids',
+                    'keypair')
+
+
+def signature(params):
+    """Identify the pool of VMs interchangeable for the deploy params."""
+    key = dict((name, params.get(name)) for name in SIGNATURE_PARAMS)
+    if key['networkids']:
+        key['networkids'] = sorted(key['networkids'])
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode(
+        'utf-8')).hexdigest()
+
+
+class WarmPool(standby.StandbyPool):
+    """Stopped VMs deployed ahead of time, per deploy signature.
+
+    Pool VMs are tagged with their signature.  Besides refills, VMs of
+    deleted resources are given back to the pool once stopped.
+    """
+
+    STATE_NAME = 'heat-cloudstack-warmpool'
+    TAG = TAG
+    RESOURCE_TYPE = 'UserVm'
+    KIND = 'warm pool VM'
+
+    def _create(self, cs, sig, params):
+        params = dict((name, params[name]) for name in SIGNATURE_PARAMS
+                      if params.get(name))
+        return cs.deployVirtualMachine(startvm=False, **params)
+
+    def _delete(self, cs, vm_id):
+        cs.destroyVirtualMachine(id=vm_id, expunge=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WarmPool(
+                    state_dir=CONF.cloudstack.warm_pool_state_dir,
+                    pending_timeout=CONF.cloudstack.warm_pool_pending_timeout,
+                    poll_interval=CONF.cloudstack.job_poll_interval)
+    return _pool
@@ -0,0 +1,87 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    from heat.common import template_format
+    from heat.engine import resource
+    from heat.engine import scheduler
+    from heat.tests import common
+    from heat.tests import utils
+except ImportError:  # the plugin tests run inside a Heat tree
+    common = None
+
+from src.common.config import CONF
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tools'))
+import simulator  # noqa
+
+__author__ = 'cima'
+
+TestCase = common.HeatTestCase if common is not None else unittest.TestCase
+
+
+def serve(test, **kwargs):
+    """Run a simulator for the test, return it with a client for it."""
+    from src.common import client
+    sim = simulator.Simulator(**dict(dict(job_latency=0, job_jitter=0),
+                                     **kwargs))
+    server = simulator.make_server(sim, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test.addCleanup(server.shutdown)
+    test.addCleanup(server.server_close)
+    cs = client.PooledCloudStack(
+        endpoint='http://127.0.0.1:%d/client/api' % server.server_address[1],
+        key=sim.key, secret=sim.secret)
+    test.addCleanup(cs.close)
+    return sim, cs
+
+
+def override(test, **values):
+    """Override options of the cloudstack group for the test."""
+    for name, value in values.items():
+        CONF.set_override(name, value, group='cloudstack')
+        test.addCleanup(CONF.clear_override, name, group='cloudstack')
+
+
+@unittest.skipIf(common is None, 'Heat is not installed')
+class SimulatorTestCase(TestCase):
+    """Runs the resources of a template against the CloudStack simulator.
+
+    The template is filled in with %(endpoint)s, %(key)s and %(secret)s of
+    the simulator and the ids of its catalog, e.g. %(zone_id)s.
+    """
+
+    failures = {}
+
+    def setUp(self):
+        super(SimulatorTestCase, self).setUp()
+        from src.advanced import network
+        from src.advanced import vpc
+        from src.basic import virtualmachine
+        for module in (network, vpc, virtualmachine):
+            for name, cls in module.resource_mapping().items():
+                resource._register_class(name, cls)
+
+        self.simulator, cs = serve(self, failures=dict(self.failures))
+        self.endpoint = cs.endpoint
+
+        state_dir = tempfile.mkdtemp()
+        override(self, poll_min_interval=0, rate_limit=0,
+                 rate_limit_state_dir=state_dir,
+                 warm_pool_state_dir=state_dir,
+                 ip_pool_state_dir=state_dir)
+
+    def parse_stack(self, template, **values):
+        values.update(self.simulator.defaults())
+        values.update(endpoint=self.endpoint, key=self.simulator.key,
+                      secret=self.simulator.secret)
+        return utils.parse_stack(template_format.parse(template % values))
+
+    def run_task(self, task, *args):
+        scheduler.TaskRunner(task, *args)(wait_time=0)
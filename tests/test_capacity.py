@@ -0,0 +1,86 @@
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from src.common import capacity
+from src.common import ippool
+from src.common import warmpool
+
+from .base import serve
+
+__author__ = 'cima'
+
+
+class _Resource(object):
+
+    def __init__(self, type_name, **properties):
+        self.type_name = type_name
+        self.properties = properties
+        self.resource_id = None
+
+    def type(self):
+        return self.type_name
+
+
+class _Stack(object):
+
+    def __init__(self, *resources):
+        self.resources = dict(enumerate(resources))
+
+
+class DemandTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator, self.cs = serve(self)
+        self.defaults = self.simulator.defaults()
+        self.ippool = ippool.AddressPool(state_dir=tempfile.mkdtemp())
+        self.warmpool = warmpool.WarmPool(state_dir=tempfile.mkdtemp())
+        for patch in (mock.patch.object(ippool, 'get_pool',
+                                        lambda: self.ippool),
+                      mock.patch.object(warmpool, 'get_pool',
+                                        lambda: self.warmpool)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def resource(self, type_name, **properties):
+        properties.update(api_endpoint=self.cs.endpoint,
+                          api_key=self.cs.key, api_secret=self.cs.secret)
+        return _Resource(type_name, **properties)
+
+    def demand(self, *resources):
+        demands = capacity.demand(_Stack(*resources))
+        return demands[(self.cs.endpoint, self.cs.key)]
+
+    def vm(self, **properties):
+        return self.resource(
+            capacity.VM, zone_id=self.defaults['zone_id'],
+            service_offering_id=self.defaults['service_offering_id'],
+            template_id=self.defaults['template_id'], **properties)
+
+    def test_pooled_addresses_count_pool_misses(self):
+        self.ippool.keep(self.cs, self.defaults['vpc_id'], 'ip-1', 2)
+        address = self.resource(capacity.ADDRESS, pooled=True,
+                                vpc_id=self.defaults['vpc_id'])
+        self.assertEqual(0, self.demand(address).totals['ips'])
+        self.assertEqual(1, self.demand(address, address).totals['ips'])
+
+    def test_warm_pool_vms_count_pool_misses(self):
+        vm = self.vm(warm_pool=1, network_ids=['net-1'])
+        sig = capacity._warm_pool(
+            self.cs, vm, self.defaults['zone_id'],
+            self.defaults['service_offering_id'])
+        self.warmpool.keep(self.cs, sig, 'vm-1', 1)
+        demand = self.demand(vm)
+        self.assertEqual(0, demand.totals['vms'])
+        self.assertEqual(0, demand.totals['memory'])
+        # a started pool VM still takes capacity of its zone
+        self.assertTrue(demand.zones[self.defaults['zone_id']]['memory'])
+        self.assertEqual(1, self.demand(vm, vm).totals['vms'])
+
+    def test_vms_on_new_networks_count(self):
+        vm = self.vm(warm_pool=1, network_ids=[None])
+        self.assertEqual(1, self.demand(vm).totals['vms'])
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from src.common import catalog
+
+from .base import serve
+
+__author__ = 'cima'
+
+
+class CatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator, self.cs = serve(self)
+        self.snapshot_file = os.path.join(tempfile.mkdtemp(), 'catalog.json')
+        self.catalog = catalog.Catalog(snapshot_file=self.snapshot_file)
+
+    def calls(self, command):
+        with self.simulator.lock:
+            return self.simulator.calls.get(command, 0)
+
+    def offering(self, name):
+        return [offering['id'] for offering in
+                self.simulator.offerings.values()
+                if offering['name'] == name][0]
+
+    def test_names_are_resolved_from_one_listing(self):
+        self.assertEqual(self.offering('Small'), self.catalog.resolve(
+            self.cs, 'serviceoffering', 'Small'))
+        self.assertEqual(self.offering('Large'), self.catalog.resolve(
+            self.cs, 'serviceoffering', 'Large'))
+        self.assertEqual(1, self.calls('listServiceOfferings'))
+
+    def test_ids_are_returned_without_listing(self):
+        offeringid = self.offering('Small')
+        self.assertEqual(offeringid, self.catalog.resolve(
+            self.cs, 'serviceoffering', offeringid))
+        self.assertEqual(0, self.calls('listServiceOfferings'))
+
+    def test_unknown_names_refresh_once(self):
+        self.catalog.resolve(self.cs, 'serviceoffering', 'Small')
+        self.assertRaises(catalog.CatalogLookupError, self.catalog.resolve,
+                          self.cs, 'serviceoffering', 'Huge')
+        self.assertEqual(2, self.calls('listServiceOfferings'))
+
+    def test_ambiguous_names_are_rejected(self):
+        with self.simulator.lock:
+            for offering in self.simulator.offerings.values():
+                offering['name'] = 'Same'
+        self.assertRaises(catalog.CatalogLookupError, self.catalog.resolve,
+                          self.cs, 'serviceoffering', 'Same')
+
+    def test_templates_are_narrowed_to_the_zone(self):
+        zoneid = self.simulator.zone['id']
+        with self.simulator.lock:
+            first, second = sorted(self.simulator.templates.values(),
+                                   key=lambda t: t['id'])
+            second['name'] = first['name']
+            second['zoneid'] = 'other-zone'
+        self.assertEqual(first['id'], self.catalog.resolve(
+            self.cs, 'template', first['name'], zoneid=zoneid))
+
+    def test_snapshot_warms_a_new_catalog(self):
+        self.catalog.resolve(self.cs, 'serviceoffering', 'Small')
+        self.assertEqual([os.path.basename(self.snapshot_file)],
+                         os.listdir(os.path.dirname(self.snapshot_file)))
+        warm = catalog.Catalog(snapshot_file=self.snapshot_file)
+        self.assertEqual(self.offering('Small'), warm.resolve(
+            self.cs, 'serviceoffering', 'Small'))
+        self.assertEqual(1, self.calls('listServiceOfferings'))
@@ -0,0 +1,55 @@
+import tempfile
+import unittest
+
+import eventlet
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from src.common import ippool
+from src.common import jobs
+
+from .base import serve
+
+__author__ = 'cima'
+
+
+class AddressPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator, self.cs = serve(self)
+        self.vpcid = self.simulator.defaults()['vpc_id']
+        for patch in (mock.patch.object(eventlet, 'spawn_n',
+                                        lambda func, *args: func(*args)),
+                      mock.patch.object(jobs, '_tracker',
+                                        jobs.JobTracker(interval=0))):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.pool = ippool.AddressPool(state_dir=tempfile.mkdtemp(),
+                                       low_watermark=1, high_watermark=2,
+                                       poll_interval=0)
+
+    def addresses(self):
+        with self.simulator.lock:
+            self.simulator._complete_jobs()
+            return self.simulator.ips
+
+    def test_refill_up_to_low_watermark(self):
+        self.assertEqual(1, self.pool.refill(self.cs, self.vpcid))
+        self.assertEqual(0, self.pool.refill(self.cs, self.vpcid))
+        self.assertIn(self.pool.claim(self.cs, self.vpcid),
+                      self.addresses())
+        self.assertIsNone(self.pool.claim(self.cs, self.vpcid))
+
+    def test_release_up_to_high_watermark(self):
+        self.assertTrue(self.pool.release(self.cs, self.vpcid, 'a'))
+        self.assertTrue(self.pool.release(self.cs, self.vpcid, 'b'))
+        self.assertFalse(self.pool.release(self.cs, self.vpcid, 'c'))
+
+    def test_failed_association_is_disassociated(self):
+        self.simulator.failures['associateIpAddress'] = (1.0, 530)
+        before = set(self.addresses())
+        self.pool.refill(self.cs, self.vpcid)
+        self.assertEqual(before, set(self.addresses()))
+        self.assertIsNone(self.pool.claim(self.cs, self.vpcid))
@@ -0,0 +1,57 @@
+import unittest
+
+from src.common import jobs
+
+from .base import serve
+
+__author__ = 'cima'
+
+
+class JobTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator, self.cs = serve(self, job_latency=60)
+        self.tracker = jobs.JobTracker(interval=0)
+        defaults = self.simulator.defaults()
+        self.vms = [self.cs.deployVirtualMachine(
+            zoneid=defaults['zone_id'],
+            serviceofferingid=defaults['service_offering_id'],
+            templateid=defaults['template_id']) for _i in range(3)]
+        for vm in self.vms:
+            self.tracker.track(self.cs, vm['jobid'])
+        self.simulator.calls.clear()
+
+    def finish(self):
+        for job in self.simulator.jobs.values():
+            job['ready_at'] = 0
+
+    def test_pending_jobs_are_listed_once(self):
+        self.assertIsNone(self.tracker.result(self.cs, self.vms[0]['jobid']))
+        self.assertEqual({'listAsyncJobs': 1}, self.simulator.calls)
+
+    def test_older_jobs_are_not_paged_through(self):
+        with self.simulator.lock:
+            for _i in range(2500):
+                jobid = self.simulator._job('listZones', dict)
+                self.simulator.jobs[jobid]['created'] -= 3600
+        self.finish()
+        for vm in self.vms:
+            self.assertEqual(vm['id'], self.tracker.result(
+                self.cs, vm['jobid'])['virtualmachine']['id'])
+        self.assertEqual({'listAsyncJobs': 1}, self.simulator.calls)
+
+    def test_jobs_of_other_processes_are_queried(self):
+        tracker = jobs.JobTracker(interval=0)
+        self.finish()
+        for vm in self.vms:
+            self.assertIsNotNone(tracker.result(self.cs, vm['jobid']))
+        self.assertEqual({'queryAsyncJobResult': 3}, self.simulator.calls)
+
+    def test_failed_job_raises(self):
+        jobid = self.vms[0]['jobid']
+        self.simulator.jobs[jobid]['failure'] = (530, 'failed')
+        self.finish()
+        self.assertRaises(jobs.AsyncJobFailed, self.tracker.result,
+                          self.cs, jobid)
+        self.assertIsNotNone(self.tracker.result(self.cs,
+                                                 self.vms[1]['jobid']))
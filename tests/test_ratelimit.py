@@ -0,0 +1,62 @@
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from src.common import ratelimit
+
+__author__ = 'cima'
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.slept = []
+        for patch in (mock.patch.object(ratelimit.time, 'time',
+                                        lambda: self.now),
+                      mock.patch.object(ratelimit.time, 'sleep',
+                                        self.sleep)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.state_dir = tempfile.mkdtemp()
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def limiter(self, **kwargs):
+        return ratelimit.RateLimiter(state_dir=self.state_dir, **kwargs)
+
+    def test_priority(self):
+        self.assertEqual(ratelimit.LOW, ratelimit.priority('listZones'))
+        self.assertEqual(ratelimit.LOW,
+                         ratelimit.priority('queryAsyncJobResult'))
+        self.assertEqual(ratelimit.HIGH,
+                         ratelimit.priority('deployVirtualMachine'))
+
+    def test_burst_then_rate(self):
+        limiter = self.limiter(rate=10, burst=5, reserve=0)
+        for _i in range(5):
+            self.assertEqual(0, limiter.acquire('e', 'k', 'deploy'))
+        self.assertAlmostEqual(0.1, limiter.acquire('e', 'k', 'deploy'))
+        self.assertEqual(1, limiter.stats()['waits'][ratelimit.HIGH])
+
+    def test_reserve_is_kept_for_high_priority_calls(self):
+        limiter = self.limiter(rate=10, burst=5, reserve=0.4)
+        for _i in range(3):
+            self.assertEqual(0, limiter.acquire('e', 'k', 'listZones'))
+        self.assertTrue(limiter.acquire('e', 'k', 'listZones'))
+        self.assertEqual(0, limiter.acquire('e', 'k', 'deploy'))
+
+    def test_bucket_is_shared_through_the_state_dir(self):
+        first = self.limiter(rate=10, burst=2, reserve=0)
+        second = self.limiter(rate=10, burst=2, reserve=0)
+        first.acquire('e', 'k', 'deploy')
+        first.acquire('e', 'k', 'deploy')
+        self.assertTrue(second.acquire('e', 'k', 'deploy'))
+        # other keys have buckets of their own
+        self.assertEqual(0, second.acquire('e', 'other', 'deploy'))
@@ -0,0 +1,78 @@
+import unittest
+
+import requests
+from cs import CloudStackException
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from src.common import retry
+
+__author__ = 'cima'
+
+
+def api_error(code, text='', status_code=None):
+    response = mock.Mock(status_code=status_code or code)
+    return CloudStackException('HTTP %d response from CloudStack' % code,
+                               response,
+                               {'errorcode': code, 'errortext': text})
+
+
+class ClassifyTest(unittest.TestCase):
+
+    def test_error_codes(self):
+        self.assertEqual(retry.NOT_FOUND, retry.classify(api_error(431)))
+        self.assertEqual(retry.IN_USE, retry.classify(api_error(536)))
+        self.assertEqual(retry.THROTTLED, retry.classify(api_error(429)))
+        self.assertEqual(retry.SERVER_ERROR, retry.classify(api_error(530)))
+        self.assertIsNone(retry.classify(api_error(432)))
+
+    def test_concurrent_operations(self):
+        for text in ('Unable to acquire lock on VPC',
+                     'There is other active operation in progress',
+                     'The network is being updated'):
+            self.assertEqual(retry.CONCURRENT,
+                             retry.classify(api_error(530, text)))
+
+    def test_responses_without_json(self):
+        e = CloudStackException('HTTP 503 response from CloudStack',
+                                mock.Mock(status_code=503), None)
+        self.assertEqual(503, retry.error_code(e))
+        self.assertEqual(retry.SERVER_ERROR, retry.classify(e))
+
+    def test_transport_errors(self):
+        self.assertEqual(retry.SERVER_ERROR,
+                         retry.classify(requests.ConnectionError()))
+        self.assertIsNone(retry.classify(ValueError()))
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        patch = mock.patch.object(retry.time, 'sleep')
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.policy = retry.RetryPolicy(dict(
+            (error_class, retry.Policy(attempts=3, base=0, cap=0))
+            for error_class in retry.REJECTED + (retry.SERVER_ERROR,)))
+
+    def test_throttled_calls_are_retried(self):
+        func = mock.Mock(side_effect=[api_error(429), {'success': True}])
+        self.assertEqual({'success': True},
+                         self.policy.call('deployVirtualMachine', func))
+        self.assertEqual(1, self.policy.stats()[retry.THROTTLED]['retries'])
+
+    def test_server_errors_of_creates_are_not_retried(self):
+        func = mock.Mock(side_effect=api_error(530))
+        self.assertRaises(CloudStackException, self.policy.call,
+                          'deployVirtualMachine', func)
+        self.assertEqual(1, func.call_count)
+
+    def test_retries_are_exhausted(self):
+        func = mock.Mock(side_effect=api_error(530))
+        self.assertRaises(CloudStackException, self.policy.call,
+                          'listVirtualMachines', func)
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(1,
+                         self.policy.stats()[retry.SERVER_ERROR]['exhausted'])
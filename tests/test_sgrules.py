@@ -0,0 +1,72 @@
+import unittest
+
+from src.common import sgrules
+
+__author__ = 'cima'
+
+
+class GroupRulesTest(unittest.TestCase):
+
+    def test_rules_differing_in_cidr_are_merged(self):
+        rules = [{'protocol': 'tcp', 'startport': 22, 'endport': 22,
+                  'cidr': '10.0.0.0/8'},
+                 {'protocol': 'tcp', 'startport': 22, 'endport': 22,
+                  'cidr': '192.168.0.0/16'},
+                 {'direction': 'egress', 'protocol': 'udp',
+                  'startport': 53, 'endport': 53}]
+        self.assertEqual(
+            [('ingress', {'protocol': 'tcp', 'startport': 22, 'endport': 22,
+                          'cidrlist': '10.0.0.0/8,192.168.0.0/16'}),
+             ('egress', {'protocol': 'udp', 'startport': 53, 'endport': 53,
+                         'cidrlist': '0.0.0.0/0'})],
+            sgrules.group_rules(rules))
+
+    def test_duplicate_cidrs_are_sent_once(self):
+        rule = {'protocol': 'icmp', 'cidr': '10.0.0.0/8'}
+        self.assertEqual('10.0.0.0/8',
+                         sgrules.group_rules([rule, rule])[0][1]['cidrlist'])
+
+
+class DiffTest(unittest.TestCase):
+
+    SG = {'ingressrule': [{'ruleid': 'ssh', 'protocol': 'TCP',
+                           'startport': 22, 'endport': 22,
+                           'cidr': '0.0.0.0/0'},
+                          {'ruleid': 'web', 'protocol': 'tcp',
+                           'startport': 80, 'endport': 80,
+                           'cidr': '0.0.0.0/0'}],
+          'egressrule': [{'ruleid': 'all', 'protocol': 'all',
+                          'cidr': '0.0.0.0/0'}]}
+
+    def test_rule_keys_split_cidr_lists(self):
+        self.assertEqual(
+            set([('ingress', 'tcp', 22, 22, '10.0.0.0/8'),
+                 ('ingress', 'tcp', 22, 22, '192.168.0.0/16')]),
+            sgrules.rule_keys([{'protocol': 'TCP', 'startport': '22',
+                                'endport': 22,
+                                'cidr': '10.0.0.0/8, 192.168.0.0/16'}]))
+
+    def test_existing_rules_match_rule_keys(self):
+        existing = sgrules.existing_rules(self.SG)
+        self.assertEqual('ssh', existing[
+            ('ingress', 'tcp', 22, 22, '0.0.0.0/0')])
+        self.assertEqual('all', existing[
+            ('egress', 'all', None, None, '0.0.0.0/0')])
+
+    def test_unchanged_rules_are_kept(self):
+        rules = [{'protocol': 'tcp', 'startport': 22, 'endport': 22},
+                 {'protocol': 'tcp', 'startport': '80', 'endport': '80'},
+                 {'direction': 'egress', 'protocol': 'all'}]
+        self.assertEqual(([], []), sgrules.diff(self.SG, rules))
+
+    def test_changed_rules_are_revoked_and_authorized(self):
+        rules = [{'protocol': 'tcp', 'startport': 22, 'endport': 22},
+                 {'protocol': 'tcp', 'startport': 443, 'endport': 443,
+                  'cidr': '10.0.0.0/8'}]
+        authorize, revoke = sgrules.diff(self.SG, rules)
+        self.assertEqual(
+            [('ingress', {'protocol': 'tcp', 'startport': 443,
+                          'endport': 443, 'cidrlist': '10.0.0.0/8'})],
+            authorize)
+        self.assertEqual(set([('ingress', 'web'), ('egress', 'all')]),
+                         set(revoke))
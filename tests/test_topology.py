@@ -0,0 +1,148 @@
+import unittest
+
+from src.common import topology
+
+from .base import SimulatorTestCase
+
+try:
+    from heat.common import exception
+except ImportError:
+    exception = None
+
+__author__ = 'cima'
+
+TEMPLATE = '''
+heat_template_version: 2014-10-16
+resources:
+  vpc:
+    type: Cloudstack::Network::VPC
+    properties:
+      api_endpoint: %(endpoint)s
+      api_key: %(key)s
+      api_secret: %(secret)s
+      name: vpc
+      display_text: vpc
+      cidr: 10.0.0.0/16
+      vpc_offering_id: %(vpc_offering_id)s
+      zone_id: %(zone_id)s
+  tier:
+    type: Cloudstack::Network::Network
+    properties:
+      api_endpoint: %(endpoint)s
+      api_key: %(key)s
+      api_secret: %(secret)s
+      name: tier
+      display_text: tier
+      gateway: 10.0.1.1
+      netmask: 255.255.255.0
+      network_offering_id: %(network_offering_id)s
+      zone_id: %(zone_id)s
+      acl_id: %(acl_id)s
+      vpc_id: { get_attr: [ vpc, id ] }
+  other:
+    type: Cloudstack::Network::Network
+    properties:
+      api_endpoint: %(endpoint)s
+      api_key: %(key)s
+      api_secret: %(secret)s
+      name: other
+      display_text: other
+      gateway: %(other_gateway)s
+      netmask: 255.255.255.0
+      network_offering_id: %(network_offering_id)s
+      zone_id: %(zone_id)s
+      acl_id: %(acl_id)s
+      vpc_id: { get_attr: [ vpc, id ] }
+  vm:
+    type: Cloudstack::Compute::VirtualMachine
+    properties:
+      api_endpoint: %(endpoint)s
+      api_key: %(key)s
+      api_secret: %(secret)s
+      zone_id: %(zone_id)s
+      template_id: %(template_id)s
+      service_offering_id: %(service_offering_id)s
+      network_ids: [ { get_attr: [ tier, id ] } ]
+      ipaddress: %(ipaddress)s
+'''
+
+
+class TopologyTest(SimulatorTestCase):
+
+    def validate(self, other_gateway='10.0.2.1', ipaddress='10.0.1.10'):
+        stack = self.parse_stack(TEMPLATE, other_gateway=other_gateway,
+                                 ipaddress=ipaddress)
+        return stack.validate()
+
+    def assertProblem(self, message, **values):
+        error = self.assertRaises(exception.StackValidationFailed,
+                                  self.validate, **values)
+        self.assertIn(message, str(error))
+
+    def test_valid(self):
+        self.validate()
+
+    def test_tier_outside_vpc(self):
+        self.assertProblem('10.1.0.0/24 is outside the VPC CIDR 10.0.0.0/16',
+                           other_gateway='10.1.0.1')
+
+    def test_overlapping_tiers(self):
+        self.assertProblem('overlaps tier', other_gateway='10.0.1.129')
+
+    def test_vm_outside_tier(self):
+        self.assertProblem('ipaddress 10.0.2.10 is outside 10.0.1.0/24',
+                           ipaddress='10.0.2.10')
+
+
+class AddressTest(unittest.TestCase):
+
+    def test_parse_cidr(self):
+        self.assertEqual((topology.parse_address('10.0.1.0'),
+                          topology.parse_address('10.0.1.255')),
+                         topology.parse_cidr('10.0.1.0/24'))
+
+    def test_parse_cidr_masks_host_bits(self):
+        self.assertEqual(topology.parse_cidr('10.0.1.0/24'),
+                         topology.parse_cidr('10.0.1.5/24'))
+        self.assertEqual('10.0.1.0/24', topology.format_span(
+            *topology.parse_cidr('10.0.1.5/24')))
+
+    def test_invalid_cidrs(self):
+        for text in ('10.0.1.0', '10.0.1.0/33', '10.0.1/24', '10.0.1.0/x',
+                     '10.0.256.0/24'):
+            self.assertRaises(ValueError, topology.parse_cidr, text)
+
+    def test_parse_netmask(self):
+        self.assertEqual(24, topology.parse_netmask('255.255.255.0'))
+        self.assertRaises(ValueError, topology.parse_netmask, '255.0.255.0')
+
+
+class IntervalIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = topology.IntervalIndex()
+        for cidr in ('10.0.2.0/24', '10.0.0.0/24', '10.0.4.0/23'):
+            self.assertIsNone(self.index.add(*topology.parse_cidr(cidr),
+                                             label=cidr))
+
+    def test_find(self):
+        self.assertEqual('10.0.0.0/24', self.index.find(
+            topology.parse_address('10.0.0.7')))
+        self.assertEqual('10.0.4.0/23', self.index.find(
+            topology.parse_address('10.0.5.255')))
+        self.assertIsNone(self.index.find(
+            topology.parse_address('10.0.1.1')))
+
+    def test_overlapping_ranges_are_not_added(self):
+        self.assertEqual('10.0.2.0/24', self.index.add(
+            *topology.parse_cidr('10.0.2.128/25'), label='inner'))
+        self.assertEqual('10.0.0.0/24', self.index.add(
+            *topology.parse_cidr('10.0.0.0/16'), label='outer'))
+        self.assertEqual('10.0.2.0/24', self.index.find(
+            topology.parse_address('10.0.2.128')))
+
+    def test_adjacent_ranges_are_added(self):
+        self.assertIsNone(self.index.add(*topology.parse_cidr('10.0.1.0/24'),
+                                         label='10.0.1.0/24'))
+        self.assertEqual('10.0.1.0/24', self.index.find(
+            topology.parse_address('10.0.1.0')))
@@ -0,0 +1,55 @@
+from .base import SimulatorTestCase
+
+__author__ = 'cima'
+
+TEMPLATE = '''
+heat_template_version: 2014-10-16
+resources:
+  vm:
+    type: Cloudstack::Compute::VirtualMachine
+    properties:
+      api_endpoint: %(endpoint)s
+      api_key: %(key)s
+      api_secret: %(secret)s
+      zone_id: %(zone_id)s
+      template_id: %(template_id)s
+      service_offering_id: %(service_offering_id)s
+'''
+
+
+def update_offering(self):
+    stack = self.parse_stack(TEMPLATE)
+    vm = stack['vm']
+    self.run_task(vm.create)
+    medium = [offering['id'] for offering in
+              self.simulator.offerings.values()
+              if offering['name'] == 'Medium'][0]
+
+    props = dict(vm.properties)
+    props['service_offering_id'] = medium
+    self.run_task(vm.update, vm.t.freeze(properties=props))
+
+    self.assertEqual((vm.UPDATE, vm.COMPLETE), vm.state)
+    server = self.simulator.vms[vm.resource_id]
+    self.assertEqual(medium, server['serviceofferingid'])
+    self.assertEqual('Running', server['state'])
+    return dict(self.simulator.calls)
+
+
+class UpdateOfferingTest(SimulatorTestCase):
+
+    def test_scale_in_place(self):
+        calls = update_offering(self)
+        self.assertEqual(1, calls.get('scaleVirtualMachine'))
+        self.assertNotIn('changeServiceForVirtualMachine', calls)
+
+
+class UpdateOfferingFallbackTest(SimulatorTestCase):
+    # the VM cannot be scaled while running
+    failures = {'scaleVirtualMachine': (1.0, 431)}
+
+    def test_stop_change_start(self):
+        calls = update_offering(self)
+        self.assertEqual(1, calls.get('stopVirtualMachine'))
+        self.assertEqual(1, calls.get('changeServiceForVirtualMachine'))
+        self.assertEqual(1, calls.get('startVirtualMachine'))
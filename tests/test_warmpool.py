@@ -0,0 +1,80 @@
+import tempfile
+import unittest
+
+import eventlet
+try:
+    from unittest import mock
+except ImportError:  # python 2
+    import mock
+
+from src.common import jobs
+from src.common import standby
+from src.common import warmpool
+
+from .base import serve
+
+__author__ = 'cima'
+
+
+class WarmPoolRefillTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator, self.cs = serve(self)
+        defaults = self.simulator.defaults()
+        self.params = {'zoneid': defaults['zone_id'],
+                       'templateid': defaults['template_id'],
+                       'serviceofferingid': defaults['service_offering_id']}
+        self.sig = warmpool.signature(self.params)
+        # refills run to completion in the test
+        for patch in (mock.patch.object(eventlet, 'spawn_n',
+                                        lambda func, *args: func(*args)),
+                      mock.patch.object(jobs, '_tracker',
+                                        jobs.JobTracker(interval=0))):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def pool(self, pending_timeout=1800):
+        return warmpool.WarmPool(state_dir=tempfile.mkdtemp(),
+                                 pending_timeout=pending_timeout,
+                                 poll_interval=0)
+
+    def vms(self):
+        with self.simulator.lock:
+            self.simulator._complete_jobs()
+            return self.simulator.vms
+
+    def test_refill(self):
+        pool = self.pool()
+        self.assertEqual(2, pool.refill(self.cs, self.sig, 2, self.params))
+        vm_id = pool.claim(self.cs, self.sig)
+        self.assertIn(vm_id, self.simulator.vms)
+        self.assertIsNotNone(pool.claim(self.cs, self.sig))
+        self.assertIsNone(pool.claim(self.cs, self.sig))
+
+    def test_failed_deploy_is_destroyed(self):
+        self.simulator.failures['deployVirtualMachine'] = (1.0, 530)
+        pool = self.pool()
+        pool.refill(self.cs, self.sig, 1, self.params)
+        self.assertEqual({}, self.vms())
+        self.assertIsNone(pool.claim(self.cs, self.sig))
+
+    def test_unknown_deploy_is_adopted(self):
+        self.simulator.failures['queryAsyncJobResult'] = (1.0, 530)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 3:
+                self.simulator.failures.clear()
+        with mock.patch.object(standby.time, 'sleep', sleep):
+            pool = self.pool()
+            pool.refill(self.cs, self.sig, 1, self.params)
+        self.assertEqual(3, len(sleeps))
+        self.assertIn(pool.claim(self.cs, self.sig), self.vms())
+        self.assertEqual(1, len(self.vms()))
+
+    def test_expired_entry_is_destroyed(self):
+        pool = self.pool(pending_timeout=0)
+        pool.refill(self.cs, self.sig, 1, self.params)
+        self.assertEqual({}, self.vms())
+        self.assertIsNone(pool.claim(self.cs, self.sig))
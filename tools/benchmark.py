@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Benchmark the Heat plugin against the CloudStack simulator.
+
+Every template is scaled to the requested number of VMs, created and
+deleted through Heat, and the API calls seen by the simulator, the wall
+time of every stack operation and the p50 / p99 duration of every
+resource operation are reported.  The heat-engine under test has to load
+the plugin and reach the simulator at --endpoint; Keystone credentials are
+read from the usual OS_* environment variables.
+
+    python tools/simulator.py --port 8080 &
+    python tools/benchmark.py --scales 1,10,100 templates/*.yaml
+"""
+import argparse
+import copy
+import datetime
+import glob
+import json
+import math
+import os
+import time
+
+import requests
+import yaml
+
+from heatclient import client as heat_client
+from heatclient import exc as heat_exc
+from keystoneauth1 import loading
+from keystoneauth1 import session
+
+__author__ = 'cima'
+
+VM_TYPE = 'Cloudstack::Compute::VirtualMachine'
+VM_GROUP_TYPE = 'Cloudstack::Compute::VirtualMachineGroup'
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list of numbers."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, int(math.ceil(fraction * len(values))))
+    return values[rank - 1]
+
+
+def scale_template(template, count):
+    """Replicate the VMs of a template until it deploys count VMs."""
+    template = copy.deepcopy(template)
+    resources = template.get('resources', {})
+    for name, res in list(resources.items()):
+        if res.get('type') == VM_GROUP_TYPE:
+            res.setdefault('properties', {})['count'] = count
+        elif res.get('type') == VM_TYPE:
+            props = res.get('properties', {})
+            for index in range(1, count):
+                clone = copy.deepcopy(res)
+                # a fixed address fits one VM only
+                clone.get('properties', {}).pop('ipaddress', None)
+                if 'name' in props:
+                    clone['properties']['name'] = '%s-%d' % (props['name'],
+                                                             index)
+                resources['%s_%d' % (name, index)] = clone
+    return template
+
+
+def template_parameters(template, values):
+    """Values for every parameter the template declares."""
+    params = {}
+    for name, schema in template.get('parameters', {}).items():
+        if name in values:
+            params[name] = values[name]
+        elif 'default' not in (schema or {}):
+            params[name] = 'bench'
+    return params
+
+
+def heat_from_env():
+    loader = loading.get_plugin_loader('password')
+    auth = loader.load_from_options(
+        auth_url=os.environ['OS_AUTH_URL'],
+        username=os.environ['OS_USERNAME'],
+        password=os.environ['OS_PASSWORD'],
+        project_name=os.environ.get('OS_PROJECT_NAME',
+                                    os.environ.get('OS_TENANT_NAME')),
+        user_domain_id=os.environ.get('OS_USER_DOMAIN_ID', 'default'),
+        project_domain_id=os.environ.get('OS_PROJECT_DOMAIN_ID', 'default'))
+    return heat_client.Client('1', session=session.Session(auth=auth))
+
+
+class Benchmark(object):
+    def __init__(self, heat, simulator_url, endpoint, key, secret,
+                 poll_interval=2, timeout=3600):
+        self.heat = heat
+        self.simulator_url = simulator_url.rstrip('/')
+        self.endpoint = endpoint
+        self.key = key
+        self.secret = secret
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+    def _simulator(self, path, method='get'):
+        res = getattr(requests, method)(self.simulator_url + path)
+        res.raise_for_status()
+        return res.json()
+
+    def _wait(self, stack_id, action):
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            try:
+                stack = self.heat.stacks.get(stack_id)
+            except heat_exc.HTTPNotFound:
+                return 'DELETE_COMPLETE'
+            if stack.stack_status != '%s_IN_PROGRESS' % action:
+                return stack.stack_status
+            time.sleep(self.poll_interval)
+        return '%s_TIMEOUT' % action
+
+    def _resource_types(self, stack_id):
+        return dict((res.resource_name, res.resource_type)
+                    for res in self.heat.resources.list(stack_id))
+
+    def _resource_durations(self, stack, types, action):
+        # events are listed by stack name and id, which also finds deleted
+        # stacks
+        started = {}
+        durations = {}
+        events = sorted(self.heat.events.list(stack),
+                        key=lambda e: e.event_time)
+        for event in events:
+            if event.resource_name not in types:
+                continue
+            when = datetime.datetime.strptime(event.event_time[:19],
+                                              '%Y-%m-%dT%H:%M:%S')
+            if event.resource_status == '%s_IN_PROGRESS' % action:
+                started[event.resource_name] = when
+            elif event.resource_status == '%s_COMPLETE' % action and \
+                    event.resource_name in started:
+                delta = when - started.pop(event.resource_name)
+                durations.setdefault(types[event.resource_name], []).append(
+                    delta.total_seconds())
+        return durations
+
+    def _calls(self, before):
+        after = self._simulator('/_stats')['calls']
+        return dict((command, count - before.get(command, 0))
+                    for command, count in after.items()
+                    if count - before.get(command, 0))
+
+    def run(self, path, count):
+        with open(path) as f:
+            template = scale_template(yaml.safe_load(f), count)
+        values = self._simulator('/_reset', method='post')
+        values.update(api_endpoint=self.endpoint, api_key=self.key,
+                      api_secret=self.secret)
+        name = 'bench-%s-%d-%d' % (
+            os.path.splitext(os.path.basename(path))[0], count,
+            int(time.time()))
+        results = []
+
+        calls = self._simulator('/_stats')['calls']
+        started = time.time()
+        stack_id = self.heat.stacks.create(
+            stack_name=name, template=template,
+            parameters=template_parameters(template, values))['stack']['id']
+        status = self._wait(stack_id, 'CREATE')
+        stack = '%s/%s' % (name, stack_id)
+        types = self._resource_types(stack_id)
+        results.append(self._result(path, count, 'create', status,
+                                    time.time() - started,
+                                    self._calls(calls),
+                                    self._resource_durations(stack, types,
+                                                             'CREATE')))
+
+        calls = self._simulator('/_stats')['calls']
+        started = time.time()
+        self.heat.stacks.delete(stack_id)
+        status = self._wait(stack_id, 'DELETE')
+        results.append(self._result(path, count, 'delete', status,
+                                    time.time() - started,
+                                    self._calls(calls),
+                                    self._resource_durations(stack, types,
+                                                             'DELETE')))
+        return results
+
+    @staticmethod
+    def _result(path, count, operation, status, wall_time, calls,
+                durations):
+        return {'template': os.path.basename(path),
+                'vms': count,
+                'operation': operation,
+                'status': status,
+                'wall_time': round(wall_time, 2),
+                'api_calls': sum(calls.values()),
+                'calls': calls,
+                'resources': dict(
+                    (res_type, {'count': len(values),
+                                'p50': percentile(values, 0.5),
+                                'p99': percentile(values, 0.99)})
+                    for res_type, values in durations.items())}
+
+
+def report(results):
+    print('%-30s %6s %-7s %-16s %9s %9s' % ('template', 'vms', 'op',
+                                            'status', 'wall [s]', 'calls'))
+    for res in results:
+        print('%-30s %6d %-7s %-16s %9.1f %9d' % (
+            res['template'], res['vms'], res['operation'], res['status'],
+            res['wall_time'], res['api_calls']))
+        for res_type, stats in sorted(res['resources'].items()):
+            print('    %-40s n=%-5d p50=%-8s p99=%s' % (
+                res_type, stats['count'], stats['p50'], stats['p99']))
+
+
+def main():
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('templates', nargs='*',
+                        default=sorted(glob.glob(os.path.join(
+                            here, '..', 'templates', '*.yaml'))))
+    parser.add_argument('--scales', default='1,10,100,1000',
+                        help='comma separated numbers of VMs')
+    parser.add_argument('--simulator', default='http://127.0.0.1:8080',
+                        help='simulator URL as seen by the benchmark')
+    parser.add_argument('--endpoint',
+                        help='API endpoint as seen by the heat-engine, '
+                             'defaults to the simulator URL')
+    parser.add_argument('--key', default='simulator-key')
+    parser.add_argument('--secret', default='simulator-secret')
+    parser.add_argument('--timeout', type=int, default=3600)
+    parser.add_argument('--output', help='write the results as JSON')
+    args = parser.parse_args()
+
+    bench = Benchmark(heat_from_env(), args.simulator,
+                      args.endpoint or args.simulator + '/client/api',
+                      args.key, args.secret, timeout=args.timeout)
+    results = []
+    for count in [int(n) for n in args.scales.split(',')]:
+        for path in args.templates:
+            results.extend(bench.run(path, count))
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,913 @@
+#!/usr/bin/env python
+"""Local stand-in for a CloudStack management server.
+
+Speaks the signed CloudStack API as used by the cs client for the calls
+made by the Heat plugin, with configurable async job latency, API latency
+and failure injection.  Call counts are served as JSON on /_stats and
+reset with a POST to /_reset.
+
+    python tools/simulator.py --port 8080 --job-latency 5 \\
+        --fail deployVirtualMachine=0.05:530
+"""
+import argparse
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl
+    from urllib.parse import quote
+    from urllib.parse import urlparse
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import quote
+    from urlparse import parse_qsl
+    from urlparse import urlparse
+
+__author__ = 'cima'
+
+JOB_PENDING = 0
+JOB_SUCCEEDED = 1
+JOB_FAILED = 2
+
+# CloudStack error codes
+PARAM_ERROR = 431
+INTERNAL_ERROR = 530
+RESOURCE_IN_USE_ERROR = 536
+
+# listResourceLimits types and listAccounts field prefixes
+RESOURCE_TYPES = ((0, 'vms'), (1, 'ips'), (6, 'networks'), (7, 'vpcs'),
+                  (8, 'cpu'), (9, 'memory'))
+ACCOUNT_FIELDS = {'vms': 'vm', 'ips': 'ip', 'networks': 'network',
+                  'vpcs': 'vpc', 'cpu': 'cpu', 'memory': 'memory'}
+
+
+class ApiError(Exception):
+    def __init__(self, code, text):
+        super(ApiError, self).__init__(text)
+        self.code = code
+        self.text = text
+
+
+def _new_id():
+    return str(uuid.uuid4())
+
+
+def _ids(value):
+    return [v for v in (value or '').split(',') if v]
+
+
+class Simulator(object):
+    """In-memory CloudStack account with lazily completing async jobs."""
+
+    def __init__(self, key='simulator-key', secret='simulator-secret',
+                 job_latency=2.0, job_jitter=0.5, api_latency=0.0,
+                 failures=None, seed=None, limits=None):
+        self.key = key
+        self.secret = secret
+        self.job_latency = job_latency
+        self.job_jitter = job_jitter
+        self.api_latency = api_latency
+        self.failures = failures or {}
+        self.limits = limits or {}
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.vms = {}
+            self.groups = {}
+            self.sgs = {}
+            self.networks = {}
+            self.vpcs = {}
+            self.ips = {}
+            self.jobs = {}
+            self.userdata = {}
+            self.events = []
+            self._ip_counter = 0
+            self._seed_catalog()
+
+    def _seed_catalog(self):
+        self.zone = {'id': _new_id(), 'name': 'sim-zone',
+                     'networktype': 'Advanced'}
+        self.offerings = {}
+        for name, cpu, memory in (('Tiny', 1, 512), ('Small', 1, 1024),
+                                  ('Medium', 2, 2048), ('Large', 4, 8192)):
+            offering = {'id': _new_id(), 'name': name, 'cpunumber': cpu,
+                        'cpuspeed': 1000, 'memory': memory}
+            self.offerings[offering['id']] = offering
+        self.templates = {}
+        for name in ('Ubuntu 14.04', 'CentOS 7'):
+            template = {'id': _new_id(), 'name': name,
+                        'zoneid': self.zone['id'], 'isready': True}
+            self.templates[template['id']] = template
+        self.network_offering = {'id': _new_id(),
+                                 'name': 'DefaultIsolatedNetworkOfferingForVpc'
+                                         'Networks'}
+        self.vpc_offering = {'id': _new_id(), 'name': 'Default VPC offering'}
+        self.acl = {'id': _new_id(), 'name': 'default_allow'}
+        vpc = {'id': _new_id(), 'name': 'sim-vpc', 'displaytext': 'sim-vpc',
+               'cidr': '10.0.0.0/8', 'zoneid': self.zone['id'],
+               'vpcofferingid': self.vpc_offering['id'], 'state': 'Enabled'}
+        self.vpcs[vpc['id']] = vpc
+        self.default_vpc = vpc
+
+    def defaults(self):
+        """Ids of the seeded catalog, used to fill template parameters."""
+        smallest = min(self.offerings.values(), key=lambda o: o['memory'])
+        return {'zone_id': self.zone['id'],
+                'service_offering_id': smallest['id'],
+                'template_id': sorted(self.templates)[0],
+                'network_offering_id': self.network_offering['id'],
+                'vpc_offering_id': self.vpc_offering['id'],
+                'vpc_id': self.default_vpc['id'],
+                'acl_id': self.acl['id']}
+
+    # request handling
+
+    def verify(self, params):
+        signature = params.pop('signature', None)
+        if params.get('apiKey') != self.key or signature is None:
+            raise ApiError(401, 'unable to verify user credentials')
+        query = '&'.join(sorted(
+            '='.join((k, quote(v, safe='.-*_'))).lower()
+            for k, v in params.items()))
+        digest = hmac.new(self.secret.encode('utf-8'),
+                          msg=query.encode('utf-8'),
+                          digestmod=hashlib.sha1).digest()
+        expected = base64.b64encode(digest).decode('utf-8').strip()
+        if not hmac.compare_digest(expected, signature):
+            raise ApiError(401, 'unable to verify user credentials')
+
+    def call(self, params):
+        """Return (HTTP status, response body) for a signed request."""
+        command = params.get('command', '')
+        if self.api_latency:
+            time.sleep(self.api_latency)
+        try:
+            self.verify(dict(params))
+            handler = getattr(self, 'api_' + command, None)
+            if handler is None:
+                raise ApiError(PARAM_ERROR,
+                               'Unknown API command %s' % command)
+            with self.lock:
+                self.calls[command] = self.calls.get(command, 0) + 1
+                self._complete_jobs()
+                failure = self._injected_failure(command)
+                if failure and not getattr(handler, 'async_job', False):
+                    raise ApiError(*failure)
+                body = handler(params)
+                if failure:
+                    self.jobs[body['jobid']]['failure'] = failure
+            status = 200
+        except ApiError as e:
+            status = e.code
+            body = {'errorcode': e.code, 'errortext': e.text}
+        return status, {command.lower() + 'response': body}
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls),
+                    'total': sum(self.calls.values()),
+                    'vms': len(self.vms),
+                    'jobs': len(self.jobs)}
+
+    def _injected_failure(self, command):
+        rate, code = self.failures.get(command, (0, None))
+        if rate and self.random.random() < rate:
+            return code, 'Injected failure of %s' % command
+        return None
+
+    # async jobs
+
+    def _job(self, command, complete, instance=None, instanceid=None):
+        latency = self.job_latency * (
+            1 + self.random.uniform(-self.job_jitter, self.job_jitter))
+        job = {'jobid': _new_id(), 'cmd': command,
+               'created': time.time(), 'ready_at': time.time() + latency,
+               'jobstatus': JOB_PENDING, 'jobresultcode': 0,
+               'jobinstancetype': instance, 'jobinstanceid': instanceid,
+               'complete': complete, 'failure': None}
+        self.jobs[job['jobid']] = job
+        return job['jobid']
+
+    def _complete_jobs(self):
+        now = time.time()
+        for job in sorted(self.jobs.values(), key=lambda j: j['ready_at']):
+            if job['jobstatus'] != JOB_PENDING or job['ready_at'] > now:
+                continue
+            try:
+                if job['failure']:
+                    raise ApiError(*job['failure'])
+                job['jobresult'] = job['complete']()
+                job['jobstatus'] = JOB_SUCCEEDED
+            except ApiError as e:
+                job['jobstatus'] = JOB_FAILED
+                job['jobresultcode'] = e.code
+                job['jobresult'] = {'errorcode': e.code,
+                                    'errortext': e.text}
+            self._event(job)
+
+    def _event(self, job):
+        self.events.append({
+            'id': _new_id(),
+            'type': job['cmd'],
+            'level': 'INFO' if job['jobstatus'] == JOB_SUCCEEDED else 'ERROR',
+            'state': 'Completed',
+            'description': 'Completed %s' % job['cmd'],
+            'resourceid': job['jobinstanceid'],
+            'resourcetype': job['jobinstancetype'],
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S+0000',
+                                     time.gmtime(job['ready_at']))})
+
+    @staticmethod
+    def _job_record(job):
+        record = dict((k, v) for k, v in job.items()
+                      if k not in ('complete', 'failure', 'ready_at',
+                                   'created'))
+        record['jobprocstatus'] = 0
+        record['created'] = time.strftime('%Y-%m-%dT%H:%M:%S+0000',
+                                          time.gmtime(job['created']))
+        return record
+
+    def api_queryAsyncJobResult(self, params):
+        job = self.jobs.get(params.get('jobid'))
+        if job is None:
+            raise ApiError(PARAM_ERROR, 'Unable to find job')
+        return self._job_record(job)
+
+    def api_listEvents(self, params):
+        events = self.events
+        if params.get('startdate'):
+            start = params['startdate'].replace(' ', 'T')
+            events = [e for e in events if e['created'][:len(start)] >= start]
+        return self._list('event', events, params)
+
+    def api_listAsyncJobs(self, params):
+        # oldest first, like CloudStack
+        jobs = sorted(self.jobs.values(), key=lambda job: job['created'])
+        if params.get('startdate'):
+            start = calendar.timegm(time.strptime(
+                params['startdate'][:19], '%Y-%m-%dT%H:%M:%S'))
+            jobs = [job for job in jobs if job['created'] >= start]
+        return self._list('asyncjobs', [self._job_record(job)
+                                        for job in jobs], params)
+
+    # helpers
+
+    @staticmethod
+    def _list(key, records, params):
+        if params.get('id'):
+            records = [r for r in records if r.get('id') == params['id']]
+        if params.get('ids'):
+            wanted = set(_ids(params['ids']))
+            records = [r for r in records if r.get('id') in wanted]
+        count = len(records)
+        if params.get('page'):
+            size = int(params.get('pagesize', 500))
+            start = (int(params['page']) - 1) * size
+            records = records[start:start + size]
+        if not records:
+            return {}
+        return {'count': count, key: records}
+
+    @staticmethod
+    def _get(table, record_id, kind):
+        record = table.get(record_id)
+        if record is None:
+            raise ApiError(PARAM_ERROR,
+                           'Unable to find %s with id %s' % (kind, record_id))
+        return record
+
+    def _allocate_ip(self, network=None):
+        self._ip_counter += 1
+        if network is not None:
+            prefix = network['gateway'].rsplit('.', 1)[0]
+            return '%s.%d' % (prefix, self._ip_counter % 250 + 2)
+        return '10.1.%d.%d' % (self._ip_counter // 250,
+                               self._ip_counter % 250 + 2)
+
+    def _nic(self, networkid):
+        network = self.networks.get(networkid)
+        return {'id': _new_id(), 'networkid': networkid,
+                'ipaddress': self._allocate_ip(network)}
+
+    # virtual machines
+
+    def api_deployVirtualMachine(self, params):
+        offering = self._get(self.offerings, params.get('serviceofferingid'),
+                             'service offering')
+        self._get(self.templates, params.get('templateid'), 'template')
+        if params.get('zoneid') != self.zone['id']:
+            raise ApiError(PARAM_ERROR, 'Unable to find zone')
+        networkids = _ids(params.get('networkids'))
+        for networkid in networkids:
+            self._get(self.networks, networkid, 'network')
+        sgs = [self._get(self.sgs, sg_id, 'security group')
+               for sg_id in _ids(params.get('securitygroupids'))]
+        if params.get('userdataid'):
+            self._get(self.userdata, params['userdataid'], 'user data')
+        vm_id = _new_id()
+        group = None
+        if params.get('group'):
+            group = [g for g in self.groups.values()
+                     if g['name'] == params['group']]
+            group = group[0] if group else None
+        nics = [self._nic(networkid) for networkid in networkids] or \
+            [self._nic(None)]
+        if params.get('ipaddress'):
+            nics[0]['ipaddress'] = params['ipaddress']
+        vm = {'id': vm_id,
+              'name': params.get('name') or 'VM-' + vm_id,
+              'displayname': params.get('name') or 'VM-' + vm_id,
+              'state': 'Starting',
+              'zoneid': self.zone['id'],
+              'serviceofferingid': offering['id'],
+              'cpunumber': offering['cpunumber'],
+              'memory': offering['memory'],
+              'templateid': params.get('templateid'),
+              'userdata': params.get('userdata'),
+              'userdataid': params.get('userdataid'),
+              'nic': nics,
+              'securitygroup': [{'id': sg['id'], 'name': sg['name']}
+                                for sg in sgs]}
+        if group:
+            vm['group'] = group['name']
+            vm['groupid'] = group['id']
+        self.vms[vm_id] = vm
+
+        started = str(params.get('startvm', 'true')).lower() != 'false'
+
+        def complete():
+            vm['state'] = 'Running' if started else 'Stopped'
+            return {'virtualmachine': vm}
+        return {'id': vm_id, 'jobid': self._job(
+            'deployVirtualMachine', complete, 'VirtualMachine', vm_id)}
+    api_deployVirtualMachine.async_job = True
+
+    def api_listVirtualMachines(self, params):
+        vms = list(self.vms.values())
+        if params.get('groupid'):
+            vms = [vm for vm in vms if vm.get('groupid') == params['groupid']]
+        if params.get('id') and params['id'] not in self.vms:
+            raise ApiError(PARAM_ERROR, 'Unable to find virtual machine')
+        return self._list('virtualmachine', vms, params)
+
+    def _vm_job(self, command, params, change, key='id'):
+        vm = self._get(self.vms, params.get(key), 'virtual machine')
+
+        def complete():
+            change(vm)
+            return {'virtualmachine': vm}
+        return {'jobid': self._job(command, complete, 'VirtualMachine',
+                                   vm['id'])}
+
+    def api_destroyVirtualMachine(self, params):
+        expunge = params.get('expunge', 'false').lower() == 'true'
+
+        def change(vm):
+            if expunge:
+                self.vms.pop(vm['id'], None)
+            else:
+                vm['state'] = 'Destroyed'
+        return self._vm_job('destroyVirtualMachine', params, change)
+    api_destroyVirtualMachine.async_job = True
+
+    def api_stopVirtualMachine(self, params):
+        return self._vm_job('stopVirtualMachine', params,
+                            lambda vm: vm.update(state='Stopped'))
+    api_stopVirtualMachine.async_job = True
+
+    def api_startVirtualMachine(self, params):
+        return self._vm_job('startVirtualMachine', params,
+                            lambda vm: vm.update(state='Running'))
+    api_startVirtualMachine.async_job = True
+
+    def api_scaleVirtualMachine(self, params):
+        offering = self._get(self.offerings, params.get('serviceofferingid'),
+                             'service offering')
+
+        def change(vm):
+            vm.update(serviceofferingid=offering['id'],
+                      cpunumber=offering['cpunumber'],
+                      memory=offering['memory'])
+        return self._vm_job('scaleVirtualMachine', params, change)
+    api_scaleVirtualMachine.async_job = True
+
+    def api_changeServiceForVirtualMachine(self, params):
+        vm = self._get(self.vms, params.get('id'), 'virtual machine')
+        offering = self._get(self.offerings, params.get('serviceofferingid'),
+                             'service offering')
+        if vm['state'] != 'Stopped':
+            raise ApiError(PARAM_ERROR, 'Unable to upgrade a running VM')
+        vm.update(serviceofferingid=offering['id'],
+                  cpunumber=offering['cpunumber'],
+                  memory=offering['memory'])
+        return {'virtualmachine': vm}
+
+    def api_updateVirtualMachine(self, params):
+        vm = self._get(self.vms, params.get('id'), 'virtual machine')
+        if params.get('displayname'):
+            vm['displayname'] = params['displayname']
+        if 'userdata' in params:
+            vm['userdata'] = params['userdata']
+            vm['userdataid'] = None
+        if params.get('userdataid'):
+            self._get(self.userdata, params['userdataid'], 'user data')
+            vm['userdataid'] = params['userdataid']
+        if params.get('securitygroupids'):
+            if vm['state'] != 'Stopped':
+                raise ApiError(PARAM_ERROR, 'VM must be stopped')
+            vm['securitygroup'] = [
+                {'id': sg_id} for sg_id in _ids(params['securitygroupids'])]
+        return {'virtualmachine': vm}
+
+    def api_addNicToVirtualMachine(self, params):
+        self._get(self.networks, params.get('networkid'), 'network')
+        return self._vm_job(
+            'addNicToVirtualMachine', params,
+            lambda vm: vm['nic'].append(self._nic(params['networkid'])),
+            key='virtualmachineid')
+    api_addNicToVirtualMachine.async_job = True
+
+    def api_removeNicFromVirtualMachine(self, params):
+        def change(vm):
+            vm['nic'] = [nic for nic in vm['nic']
+                         if nic['id'] != params.get('nicid')]
+        return self._vm_job('removeNicFromVirtualMachine', params, change,
+                            key='virtualmachineid')
+    api_removeNicFromVirtualMachine.async_job = True
+
+    def api_createInstanceGroup(self, params):
+        group = {'id': _new_id(), 'name': params.get('name')}
+        self.groups[group['id']] = group
+        return {'instancegroup': group}
+
+    def api_deleteInstanceGroup(self, params):
+        self._get(self.groups, params.get('id'), 'instance group')
+        del self.groups[params['id']]
+        return {'success': True}
+
+    # security groups
+
+    def api_createSecurityGroup(self, params):
+        sg = {'id': _new_id(), 'name': params.get('name'),
+              'ingressrule': [], 'egressrule': []}
+        self.sgs[sg['id']] = sg
+        return {'securitygroup': sg}
+
+    def api_listSecurityGroups(self, params):
+        if params.get('id') and params['id'] not in self.sgs:
+            raise ApiError(PARAM_ERROR, 'Unable to find security group')
+        return self._list('securitygroup', list(self.sgs.values()), params)
+
+    def _authorize(self, direction, params):
+        sg = self._get(self.sgs, params.get('securitygroupid'),
+                       'security group')
+
+        def complete():
+            rules = []
+            for cidr in _ids(params.get('cidrlist')) or ['0.0.0.0/0']:
+                rule = {'ruleid': _new_id(), 'cidr': cidr,
+                        'protocol': params.get('protocol', 'tcp')}
+                for port in ('startport', 'endport'):
+                    if params.get(port):
+                        rule[port] = int(params[port])
+                rules.append(rule)
+            sg[direction + 'rule'].extend(rules)
+            return {'securitygroup': sg}
+        return {'jobid': self._job('authorizeSecurityGroup' +
+                                   direction.capitalize(), complete,
+                                   'SecurityGroup', sg['id'])}
+
+    def api_authorizeSecurityGroupIngress(self, params):
+        return self._authorize('ingress', params)
+    api_authorizeSecurityGroupIngress.async_job = True
+
+    def api_authorizeSecurityGroupEgress(self, params):
+        return self._authorize('egress', params)
+    api_authorizeSecurityGroupEgress.async_job = True
+
+    def _revoke(self, direction, params):
+        owner = [sg for sg in self.sgs.values()
+                 if any(rule['ruleid'] == params.get('id')
+                        for rule in sg[direction + 'rule'])]
+        if not owner:
+            raise ApiError(PARAM_ERROR, 'Unable to find rule')
+        sg = owner[0]
+
+        def complete():
+            sg[direction + 'rule'] = [rule for rule in sg[direction + 'rule']
+                                      if rule['ruleid'] != params['id']]
+            return {'success': True}
+        return {'jobid': self._job('revokeSecurityGroup' +
+                                   direction.capitalize(), complete,
+                                   'SecurityGroup', sg['id'])}
+
+    def api_revokeSecurityGroupIngress(self, params):
+        return self._revoke('ingress', params)
+    api_revokeSecurityGroupIngress.async_job = True
+
+    def api_revokeSecurityGroupEgress(self, params):
+        return self._revoke('egress', params)
+    api_revokeSecurityGroupEgress.async_job = True
+
+    def api_deleteSecurityGroup(self, params):
+        self._get(self.sgs, params.get('id'), 'security group')
+        for vm in self.vms.values():
+            in_use = any(sg['id'] == params['id']
+                         for sg in vm['securitygroup'])
+            if in_use and vm['state'] != 'Destroyed':
+                raise ApiError(RESOURCE_IN_USE_ERROR,
+                               'Cannot delete group when it is in use by '
+                               'virtual machines')
+        del self.sgs[params['id']]
+        return {'success': True}
+
+    # networks and VPCs
+
+    def api_createNetwork(self, params):
+        if params.get('vpcid'):
+            self._get(self.vpcs, params['vpcid'], 'VPC')
+        network = {'id': _new_id(), 'name': params.get('name'),
+                   'displaytext': params.get('displaytext'),
+                   'zoneid': params.get('zoneid'),
+                   'networkofferingid': params.get('networkofferingid'),
+                   'vpcid': params.get('vpcid'),
+                   'aclid': params.get('aclid'),
+                   'gateway': params.get('gateway', '10.1.1.1'),
+                   'netmask': params.get('netmask', '255.255.255.0'),
+                   'state': 'Allocated'}
+        self.networks[network['id']] = network
+        return {'network': network}
+
+    def api_listNetworks(self, params):
+        if params.get('id') and params['id'] not in self.networks:
+            raise ApiError(PARAM_ERROR, 'Unable to find network')
+        return self._list('network', list(self.networks.values()), params)
+
+    def api_updateNetwork(self, params):
+        network = self._get(self.networks, params.get('id'), 'network')
+
+        def complete():
+            for key in ('name', 'displaytext'):
+                if params.get(key):
+                    network[key] = params[key]
+            return {'network': network}
+        return {'jobid': self._job('updateNetwork', complete, 'Network',
+                                   network['id'])}
+    api_updateNetwork.async_job = True
+
+    def api_replaceNetworkACLList(self, params):
+        network = self._get(self.networks, params.get('networkid'), 'network')
+
+        def complete():
+            network['aclid'] = params.get('aclid')
+            return {'success': True}
+        return {'jobid': self._job('replaceNetworkACLList', complete,
+                                   'Network', network['id'])}
+    api_replaceNetworkACLList.async_job = True
+
+    def api_deleteNetwork(self, params):
+        network = self._get(self.networks, params.get('id'), 'network')
+        for vm in self.vms.values():
+            if any(nic['networkid'] == network['id'] for nic in vm['nic']):
+                raise ApiError(INTERNAL_ERROR,
+                               'Network has active virtual machines')
+
+        def complete():
+            self.networks.pop(network['id'], None)
+            return {'success': True}
+        return {'jobid': self._job('deleteNetwork', complete, 'Network',
+                                   network['id'])}
+    api_deleteNetwork.async_job = True
+
+    def api_createVPC(self, params):
+        vpc = {'id': _new_id(), 'name': params.get('name'),
+               'displaytext': params.get('displaytext'),
+               'cidr': params.get('cidr'), 'zoneid': params.get('zoneid'),
+               'vpcofferingid': params.get('vpcofferingid'),
+               'state': 'Enabled'}
+        self.vpcs[vpc['id']] = vpc
+        return {'id': vpc['id'], 'jobid': self._job(
+            'createVPC', lambda: {'vpc': vpc}, 'Vpc', vpc['id'])}
+    api_createVPC.async_job = True
+
+    def api_listVPCs(self, params):
+        if params.get('id') and params['id'] not in self.vpcs:
+            raise ApiError(PARAM_ERROR, 'Unable to find VPC')
+        return self._list('vpc', list(self.vpcs.values()), params)
+
+    def api_updateVPC(self, params):
+        vpc = self._get(self.vpcs, params.get('id'), 'VPC')
+
+        def complete():
+            for key in ('name', 'displaytext'):
+                if params.get(key):
+                    vpc[key] = params[key]
+            return {'vpc': vpc}
+        return {'jobid': self._job('updateVPC', complete, 'Vpc', vpc['id'])}
+    api_updateVPC.async_job = True
+
+    def api_deleteVPC(self, params):
+        vpc = self._get(self.vpcs, params.get('id'), 'VPC')
+        if any(n.get('vpcid') == vpc['id'] for n in self.networks.values()):
+            raise ApiError(INTERNAL_ERROR, 'VPC has tiers')
+
+        def complete():
+            self.vpcs.pop(vpc['id'], None)
+            return {'success': True}
+        return {'jobid': self._job('deleteVPC', complete, 'Vpc', vpc['id'])}
+    api_deleteVPC.async_job = True
+
+    # public IP addresses
+
+    def api_associateIpAddress(self, params):
+        if params.get('vpcid'):
+            self._get(self.vpcs, params['vpcid'], 'VPC')
+        self._ip_counter += 1
+        address = {'id': _new_id(),
+                   'ipaddress': '198.51.%d.%d' % (self._ip_counter // 250,
+                                                  self._ip_counter % 250 + 2),
+                   'vpcid': params.get('vpcid'), 'isstaticnat': False,
+                   'state': 'Allocating'}
+        self.ips[address['id']] = address
+
+        def complete():
+            address['state'] = 'Allocated'
+            return {'ipaddress': address}
+        return {'id': address['id'], 'jobid': self._job(
+            'associateIpAddress', complete, 'IpAddress', address['id'])}
+    api_associateIpAddress.async_job = True
+
+    def api_disassociateIpAddress(self, params):
+        address = self._get(self.ips, params.get('id'), 'IP address')
+
+        def complete():
+            self.ips.pop(address['id'], None)
+            return {'success': True}
+        return {'jobid': self._job('disassociateIpAddress', complete,
+                                   'IpAddress', address['id'])}
+    api_disassociateIpAddress.async_job = True
+
+    def api_listPublicIpAddresses(self, params):
+        if params.get('id') and params['id'] not in self.ips:
+            raise ApiError(PARAM_ERROR, 'Unable to find IP address')
+        return self._list('publicipaddress', list(self.ips.values()), params)
+
+    def api_enableStaticNat(self, params):
+        address = self._get(self.ips, params.get('ipaddressid'), 'IP address')
+        self._get(self.vms, params.get('virtualmachineid'), 'virtual machine')
+        address.update(isstaticnat=True,
+                       virtualmachineid=params['virtualmachineid'])
+        return {'success': True}
+
+    def api_disableStaticNat(self, params):
+        address = self._get(self.ips, params.get('ipaddressid'), 'IP address')
+
+        def complete():
+            address['isstaticnat'] = False
+            address.pop('virtualmachineid', None)
+            return {'success': True}
+        return {'jobid': self._job('disableStaticNat', complete, 'IpAddress',
+                                   address['id'])}
+    api_disableStaticNat.async_job = True
+
+    # tags
+
+    def _tags(self, params):
+        tags = []
+        index = 0
+        while 'tags[%d].key' % index in params:
+            tags.append((params['tags[%d].key' % index],
+                         params.get('tags[%d].value' % index)))
+            index += 1
+        return tags
+
+    def _tagged(self, params):
+        tables = {'UserVm': (self.vms, 'virtual machine'),
+                  'PublicIpAddress': (self.ips, 'IP address')}
+        if params.get('resourcetype') not in tables:
+            raise ApiError(PARAM_ERROR, 'Unsupported resource type %s' %
+                           params.get('resourcetype'))
+        table, kind = tables[params['resourcetype']]
+        return [self._get(table, record_id, kind)
+                for record_id in _ids(params.get('resourceids'))]
+
+    def api_createTags(self, params):
+        records = self._tagged(params)
+
+        def complete():
+            for record in records:
+                for key, value in self._tags(params):
+                    record.setdefault('tags', []).append({'key': key,
+                                                          'value': value})
+            return {'success': True}
+        return {'jobid': self._job('createTags', complete)}
+    api_createTags.async_job = True
+
+    def api_deleteTags(self, params):
+        records = self._tagged(params)
+
+        def complete():
+            keys = set(key for key, _value in self._tags(params))
+            for record in records:
+                record['tags'] = [t for t in record.get('tags', [])
+                                  if t['key'] not in keys]
+            return {'success': True}
+        return {'jobid': self._job('deleteTags', complete)}
+    api_deleteTags.async_job = True
+
+    # registered user data
+
+    def api_registerUserData(self, params):
+        if any(u['name'] == params.get('name')
+               for u in self.userdata.values()):
+            raise ApiError(PARAM_ERROR, 'A user data with name %s already '
+                           'exists' % params.get('name'))
+        userdata = {'id': _new_id(), 'name': params.get('name'),
+                    'userdata': params.get('userdata')}
+        self.userdata[userdata['id']] = userdata
+        return {'userdata': userdata}
+
+    def api_listUserData(self, params):
+        records = list(self.userdata.values())
+        if params.get('name'):
+            records = [u for u in records if u['name'] == params['name']]
+        if params.get('id'):
+            records = [u for u in records if u['id'] == params['id']]
+        return self._list('userdata', records, params)
+
+    def api_deleteUserData(self, params):
+        self._get(self.userdata, params.get('id'), 'user data')
+        if any(vm.get('userdataid') == params['id'] and
+               vm['state'] != 'Destroyed' for vm in self.vms.values()):
+            raise ApiError(INTERNAL_ERROR, 'User data is in use')
+        del self.userdata[params['id']]
+        return {'success': True}
+
+    # catalog
+
+    def api_listZones(self, params):
+        return self._list('zone', [self.zone], params)
+
+    def api_listServiceOfferings(self, params):
+        return self._list('serviceoffering', list(self.offerings.values()),
+                          params)
+
+    def api_listTemplates(self, params):
+        return self._list('template', list(self.templates.values()), params)
+
+    def api_listNetworkOfferings(self, params):
+        return self._list('networkoffering', [self.network_offering], params)
+
+    def api_listVPCOfferings(self, params):
+        return self._list('vpcoffering', [self.vpc_offering], params)
+
+    # limits and capacity
+
+    def _usage(self):
+        vms = [vm for vm in self.vms.values() if vm['state'] != 'Destroyed']
+        return {'vms': len(vms),
+                'ips': len(self.ips),
+                'networks': len(self.networks),
+                'vpcs': len(self.vpcs),
+                'cpu': sum(vm['cpunumber'] for vm in vms),
+                'memory': sum(vm['memory'] for vm in vms)}
+
+    def api_listResourceLimits(self, params):
+        limits = [{'account': 'sim-account', 'domainid': 'sim-domain',
+                   'resourcetype': resource_type,
+                   'max': self.limits.get(name, -1)}
+                  for resource_type, name in RESOURCE_TYPES]
+        return self._list('resourcelimit', limits, params)
+
+    def api_listAccounts(self, params):
+        usage = self._usage()
+        account = {'id': 'sim-account', 'name': 'sim-account',
+                   'domainid': 'sim-domain'}
+        for name, used in usage.items():
+            limit = self.limits.get(name, -1)
+            account[ACCOUNT_FIELDS[name] + 'total'] = used
+            account[ACCOUNT_FIELDS[name] + 'limit'] = \
+                'Unlimited' if limit < 0 else limit
+        return self._list('account', [account], params)
+
+    def api_listCapacity(self, params):
+        usage = self._usage()
+        memory = self.limits.get('zone_memory', 1048576)
+        cpu_mhz = self.limits.get('zone_cpu_mhz', 512000)
+        capacities = [
+            {'type': 0, 'zoneid': self.zone['id'],
+             'zonename': self.zone['name'],
+             'capacitytotal': memory * 1024 * 1024,
+             'capacityused': usage['memory'] * 1024 * 1024},
+            {'type': 1, 'zoneid': self.zone['id'],
+             'zonename': self.zone['name'], 'capacitytotal': cpu_mhz,
+             'capacityused': usage['cpu'] * 1000}]
+        return self._list('capacity', capacities, params)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_server(simulator, host='127.0.0.1', port=8080):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _dispatch(self, query):
+            path = urlparse(self.path).path
+            if path == '/_stats':
+                return self._reply(200, simulator.stats())
+            if path == '/_defaults':
+                return self._reply(200, simulator.defaults())
+            if path == '/_reset':
+                simulator.reset()
+                return self._reply(200, simulator.defaults())
+            self._reply(*simulator.call(dict(parse_qsl(query))))
+
+        def do_GET(self):
+            self._dispatch(urlparse(self.path).query)
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            self._dispatch(self.rfile.read(length).decode('utf-8'))
+
+        def log_message(self, format, *args):
+            pass
+
+    return _ThreadingHTTPServer((host, port), Handler)
+
+
+def _limit(value):
+    name, _sep, limit = value.partition('=')
+    return name, int(limit)
+
+
+def _failure(value):
+    command, spec = value.split('=', 1)
+    rate, _sep, code = spec.partition(':')
+    return command, (float(rate), int(code or INTERNAL_ERROR))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--key', default='simulator-key')
+    parser.add_argument('--secret', default='simulator-secret')
+    parser.add_argument('--job-latency', type=float, default=2.0,
+                        help='mean seconds until an async job completes')
+    parser.add_argument('--job-jitter', type=float, default=0.5,
+                        help='relative jitter of the async job latency')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='seconds added to every API request')
+    parser.add_argument('--fail', type=_failure, action='append',
+                        default=[], metavar='COMMAND=RATE[:CODE]',
+                        help='fail a fraction of the calls of a command '
+                             'with the given error code (default 530)')
+    parser.add_argument('--limit', type=_limit, action='append',
+                        default=[], metavar='NAME=LIMIT',
+                        help='account limit of vms, ips, networks, vpcs, '
+                             'cpu (cores) or memory (MB), or zone capacity '
+                             'zone_memory (MB) or zone_cpu_mhz')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    simulator = Simulator(key=args.key, secret=args.secret,
+                          job_latency=args.job_latency,
+                          job_jitter=args.job_jitter,
+                          api_latency=args.api_latency,
+                          failures=dict(args.fail), seed=args.seed,
+                          limits=dict(args.limit))
+    server = make_server(simulator, args.host, args.port)
+    print('CloudStack simulator on http://%s:%d/client/api' %
+          (args.host, args.port))
+    print(json.dumps(simulator.defaults(), indent=2))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Critical path of a stack operation from the plugin's trace files.
+
+The trace files written by every engine worker for the same stack
+operation are merged into one Chrome trace / Perfetto JSON file, and the
+chain of resource operations which set the total wall time is printed with
+the time each resource spent waiting for its dependencies, in API calls,
+in async jobs and between completion checks.
+
+    python tools/trace_report.py --merged stack.json /var/lib/heat/trace/web-*
+"""
+import argparse
+import json
+
+__author__ = 'cima'
+
+
+def load(paths):
+    events = []
+    metadata = {}
+    seen = set()
+    for path in paths:
+        with open(path) as f:
+            trace = json.load(f)
+        metadata.update(trace.get('metadata', {}))
+        for event in trace['traceEvents']:
+            if event['ph'] == 'M':
+                key = (event['name'], event['pid'], event.get('tid'))
+                if key in seen:
+                    continue
+                seen.add(key)
+            events.append(event)
+    return events, metadata
+
+
+def _busy(intervals):
+    """Total length of the union of (start, end) intervals."""
+    total = 0
+    end = None
+    for start, stop in sorted(intervals):
+        if end is None or start > end:
+            total += stop - start
+            end = stop
+        elif stop > end:
+            total += stop - end
+            end = stop
+    return total
+
+
+def critical_path(events):
+    """Return the chain of operations ending with the last one to finish.
+
+    Each operation's predecessor is the dependency which finished last, or
+    without dependency information the operation which finished last
+    before it started.
+    """
+    operations = {}
+    for event in events:
+        if event.get('cat') == 'operation':
+            args = event.get('args', {})
+            operations[args['resource']] = {
+                'resource': args['resource'],
+                'type': args.get('type'),
+                'requires': args.get('requires') or [],
+                'error': args.get('error'),
+                'tid': event['tid'],
+                'start': event['ts'],
+                'end': event['ts'] + event['dur']}
+    if not operations:
+        return []
+
+    path = []
+    op = max(operations.values(), key=lambda o: o['end'])
+    while op is not None:
+        path.append(op)
+        candidates = [operations[name] for name in op['requires']
+                      if name in operations]
+        if not candidates and not op['requires']:
+            candidates = [o for o in operations.values()
+                          if o['end'] <= op['start'] and o not in path]
+        op = max(candidates, key=lambda o: o['end']) if candidates else None
+    path.reverse()
+
+    begin = min(o['start'] for o in operations.values())
+    previous_end = begin
+    for op in path:
+        inside = [e for e in events if e.get('tid') == op['tid'] and
+                  op['start'] <= e.get('ts', -1) <= op['end']]
+        api = [(e['ts'], e['ts'] + e['dur']) for e in inside
+               if e.get('cat') == 'api']
+        calls = [(e['ts'], e['ts'] + e['dur']) for e in inside
+                 if e.get('cat') == 'call']
+        jobs = {}
+        for e in inside:
+            if e.get('cat') == 'job':
+                jobs.setdefault(e['id'], {})[e['ph']] = e['ts']
+        op['wait'] = max(0, op['start'] - previous_end)
+        op['duration'] = op['end'] - op['start']
+        op['api'] = _busy(api)
+        op['jobs'] = _busy([(j['b'], j.get('e', op['end']))
+                            for j in jobs.values() if 'b' in j])
+        op['polling_gaps'] = op['duration'] - _busy(calls)
+        previous_end = op['end']
+    return path
+
+
+def report(path):
+    if not path:
+        print('no completed resource operations')
+        return
+    begin = path[0]['start'] - path[0]['wait']
+    total = path[-1]['end'] - begin
+    print('critical path: %.1f s wall time' % (total / 1e6))
+    print('%-30s %9s %9s %9s %9s %9s' % ('resource', 'wait [s]', 'total',
+                                         'api', 'jobs', 'gaps'))
+    for op in path:
+        print('%-30s %9.1f %9.1f %9.1f %9.1f %9.1f%s' % (
+            op['resource'], op['wait'] / 1e6, op['duration'] / 1e6,
+            op['api'] / 1e6, op['jobs'] / 1e6, op['polling_gaps'] / 1e6,
+            '  FAILED' if op['error'] else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('traces', nargs='+',
+                        help='trace files of one stack operation')
+    parser.add_argument('--merged', help='write the merged trace file')
+    args = parser.parse_args()
+
+    events, metadata = load(args.traces)
+    if args.merged:
+        with open(args.merged, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'metadata': metadata}, f)
+    report(critical_path(events))
+
+
+if __name__ == '__main__':
+    main()